@@ -3,6 +3,11 @@ ASGI config for ecommerce project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+It routes login and registration to their async views (``AUTH_ASYNC_VIEWS``),
+which wait on the password hashing pool without holding a worker, e.g.:
+
+    gunicorn ecommerce.asgi:application -k uvicorn.workers.UvicornWorker
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -12,5 +17,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce.settings')
+os.environ.setdefault('AUTH_ASYNC_VIEWS', 'True')
 
 application = get_asgi_application()
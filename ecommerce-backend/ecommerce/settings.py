@@ -1,7 +1,8 @@
 from pathlib import Path
 import os
 from datetime import timedelta
-from decouple import config
+from decouple import Csv, config
+from corsheaders.defaults import default_headers
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -15,9 +16,27 @@ ALLOWED_HOSTS = ['*']
 CORS_ALLOWED_ORIGINS = [
     config('FRONTEND_URL', default='http://localhost:3000'),
 ]
+CORS_ALLOW_HEADERS = [*default_headers, 'idempotency-key']
 STRIPE_PUBLISHABLE_KEY = config('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET')
+
+# PAYMENTS
+PAYMENT_GATEWAY = config('PAYMENT_GATEWAY', default='stripe')  # 'stripe', 'fake' or 'fake_http'
+PAYMENT_OUTBOX_MAX_ATTEMPTS = config('PAYMENT_OUTBOX_MAX_ATTEMPTS', default=8, cast=int)
+PAYMENT_WEBHOOK_MAX_ATTEMPTS = config('PAYMENT_WEBHOOK_MAX_ATTEMPTS', default=8, cast=int)
+REFUND_MAX_ATTEMPTS = config('REFUND_MAX_ATTEMPTS', default=5, cast=int)
+PAYMENT_GATEWAY_CONNECT_TIMEOUT = config('PAYMENT_GATEWAY_CONNECT_TIMEOUT', default=3.0, cast=float)
+PAYMENT_GATEWAY_TIMEOUT = config('PAYMENT_GATEWAY_TIMEOUT', default=10.0, cast=float)
+PAYMENT_GATEWAY_MAX_CONNECTIONS = config('PAYMENT_GATEWAY_MAX_CONNECTIONS', default=10, cast=int)
+PAYMENT_GATEWAY_BREAKER_THRESHOLD = config('PAYMENT_GATEWAY_BREAKER_THRESHOLD', default=5, cast=int)
+PAYMENT_GATEWAY_BREAKER_RESET = config('PAYMENT_GATEWAY_BREAKER_RESET', default=30, cast=int)
+FAKE_GATEWAY_LATENCY_MS = config('FAKE_GATEWAY_LATENCY_MS', default=0, cast=int)
+FAKE_GATEWAY_FAILURE_RATE = config('FAKE_GATEWAY_FAILURE_RATE', default=0.0, cast=float)
+FAKE_GATEWAY_DECLINE_RATE = config('FAKE_GATEWAY_DECLINE_RATE', default=0.0, cast=float)
+FAKE_GATEWAY_URL = config('FAKE_GATEWAY_URL', default='http://127.0.0.1:12111')
+# Where the fake posts signed webhooks; empty queues them in-process instead
+FAKE_GATEWAY_WEBHOOK_URL = config('FAKE_GATEWAY_WEBHOOK_URL', default='')
 # APPLICATIONS
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -43,6 +62,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'ecommerce_app.ratelimit.RateLimitMiddleware',
 ]
 
 # URL CONFIG
@@ -89,6 +109,25 @@ AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator'},
 ]
 AUTH_USER_MODEL = 'ecommerce_app.User'
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+    # Legacy hashes from import_users, replaced with PBKDF2 at the user's next login
+    'django.contrib.auth.hashers.BCryptPasswordHasher',
+    'ecommerce_app.hashers.PHPassPasswordHasher',
+    'ecommerce_app.hashers.LegacySaltedSHA256PasswordHasher',
+    'ecommerce_app.hashers.LegacySaltedMD5PasswordHasher',
+]
+# Login and registration hash passwords in a pool of this many threads per process
+PASSWORD_HASHING_WORKERS = config('PASSWORD_HASHING_WORKERS', default=4, cast=int)
+PASSWORD_HASHING_QUEUE = config('PASSWORD_HASHING_QUEUE', default=64, cast=int)  # hashes in hand before 503s
+# Also start a session on login; JWT clients do not need one
+AUTH_LOGIN_SESSION = config('AUTH_LOGIN_SESSION', default=False, cast=bool)
+# Route login and registration to the async views; asgi.py turns this on
+AUTH_ASYNC_VIEWS = config('AUTH_ASYNC_VIEWS', default=False, cast=bool)
 
 # INTERNATIONALIZATION
 LANGUAGE_CODE = 'en-us'
@@ -107,29 +146,83 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 # REST FRAMEWORK
 REST_FRAMEWORK = {
-    'DEFAULT_AUTHENTICATION_CLASSES': ['rest_framework_simplejwt.authentication.JWTAuthentication'],
+    'DEFAULT_AUTHENTICATION_CLASSES': ['ecommerce_app.authentication.CachedJWTAuthentication'],
     'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated'],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
 }
 
+# Replayed responses for requests sent with an Idempotency-Key header
+IDEMPOTENCY_KEY_TTL = config('IDEMPOTENCY_KEY_TTL', default=86400, cast=int)  # seconds
+IDEMPOTENCY_WAIT_TIMEOUT = config('IDEMPOTENCY_WAIT_TIMEOUT', default=10, cast=int)  # seconds
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
     'ROTATE_REFRESH_TOKENS': True,
     'BLACKLIST_AFTER_ROTATION': True,
+    # Revokes rotated refresh tokens without the token_blacklist app's tables
+    'TOKEN_REFRESH_SERIALIZER': 'ecommerce_app.serializers.RotatingTokenRefreshSerializer',
 }
 
+# Seconds an authenticated user is served from the cache instead of the database
+AUTH_USER_CACHE_TTL = config('AUTH_USER_CACHE_TTL', default=60, cast=int)
+# Trust the token's claims for GET requests to cart, order, refund and flash-sale views
+AUTH_STATELESS_READS = config('AUTH_STATELESS_READS', default=False, cast=bool)
+
+# RATE LIMITING
+# Requests allowed per user (or per IP for anonymous requests) on each URL name
+RATE_LIMIT_CART = config('RATE_LIMIT_CART', default='60/minute')
+RATE_LIMITS = {
+    'user-login': config('RATE_LIMIT_LOGIN', default='10/minute'),
+    'user-register': config('RATE_LIMIT_REGISTER', default='5/minute'),
+    'token-refresh': config('RATE_LIMIT_TOKEN_REFRESH', default='30/minute'),
+    'cart-add-item': RATE_LIMIT_CART,
+    'cart-update-item': RATE_LIMIT_CART,
+    'cart-remove-item': RATE_LIMIT_CART,
+    'cart-clear': RATE_LIMIT_CART,
+    'cart-reserve': RATE_LIMIT_CART,
+}
+# Cache alias for the counters; bumped on every limited request, so they skip the per-worker L1
+RATE_LIMIT_CACHE = 'shared'
+# Proxies in front of the app that append to X-Forwarded-For, e.g. 1 behind a load balancer;
+# left at 0 behind one, all anonymous clients share the proxy's address and limit
+RATE_LIMIT_PROXY_COUNT = config('RATE_LIMIT_PROXY_COUNT', default=0, cast=int)
+
 # CACHING
+# Each worker keeps its hottest keys in memory (L1) in front of the 'shared' cache (L2):
+# Redis when CACHE_REDIS_URL is set, else an SQLite file shared by the workers of one machine
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default='')
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
-    }
+        'BACKEND': 'ecommerce_app.cache_backends.LayeredCache',
+        'LOCATION': 'shared',
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_L1_MAX_ENTRIES', default=1000, cast=int),
+            'L1_TIMEOUT': config('CACHE_L1_TIMEOUT', default=60, cast=int),  # seconds
+            'SYNC_INTERVAL': config('CACHE_L1_SYNC_INTERVAL', default=1.0, cast=float),  # seconds
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+    } if CACHE_REDIS_URL else {
+        'BACKEND': 'ecommerce_app.cache_backends.SQLiteCache',
+        'LOCATION': config('CACHE_SQLITE_PATH', default=os.path.join(BASE_DIR, 'cache.sqlite3')),
+        # Revoked refresh tokens live here too, so keep this well above what is ever stored
+        'OPTIONS': {'MAX_ENTRIES': config('CACHE_SQLITE_MAX_ENTRIES', default=1000000, cast=int)},
+    },
 }
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 SESSION_CACHE_ALIAS = 'default'
 
+# INVENTORY
+STOCK_HOLD_TTL = config('STOCK_HOLD_TTL', default=900, cast=int)  # seconds
+STOCK_HOLD_BUCKETS = config('STOCK_HOLD_BUCKETS', default=8, cast=int)
+STOCK_SHARDS = config('STOCK_SHARDS', default=8, cast=int)  # counter shards per hot product
+LOW_STOCK_ALERT_EMAILS = config('LOW_STOCK_ALERT_EMAILS', default='', cast=Csv())  # get every category's digest
+LOW_STOCK_DIGEST_DELAY = config('LOW_STOCK_DIGEST_DELAY', default=60, cast=int)  # seconds; longer than any transaction
+
 # LOGGING
 LOGGING = {
     'version': 1,
@@ -156,3 +249,4 @@ EMAIL_PORT = config('EMAIL_PORT', default=587, cast=int)
 EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=True, cast=bool)
 EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
+DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='webmaster@localhost')
@@ -1,14 +1,22 @@
 from django.contrib import admin
+from django import forms
+from django.conf import settings
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Category, Product, Cart, CartItem, Order, OrderItem
+from . import inventory, variants
+from .admin_pagination import LargeTableAdmin
+from .models import User, Category, Product, ProductVariant, Cart, CartItem, Order, OrderItem, OrderStatusHistory, PaymentTransaction, PaymentWebhook, RefundRequest, RefundRequestItem, StockMovement, LowStockDigest, FlashSale
+from .order_status import bulk_transition
+from .refunds import approve, reject
+from .webhooks import retry_dead
 
 
 @admin.register(User)
-class UserAdmin(BaseUserAdmin):
+class UserAdmin(LargeTableAdmin, BaseUserAdmin):
     list_display = ['email', 'first_name', 'last_name', 'is_active', 'is_staff', 'date_joined']
     list_filter = ['is_active', 'is_staff', 'is_verified', 'date_joined']
-    search_fields = ['email', 'first_name', 'last_name']
-    ordering = ['-date_joined']
+    # Prefix match on the indexed email column
+    search_fields = ['email__startswith']
+    search_help_text = 'Email address, or its beginning'
     
     fieldsets = (
         (None, {'fields': ('email', 'password')}),
@@ -30,47 +38,141 @@ class UserAdmin(BaseUserAdmin):
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ['name', 'created_at']
+    list_display = ['name', 'buyer_email', 'created_at']
     search_fields = ['name']
 
 
+class LowStockFilter(admin.SimpleListFilter):
+    title = 'low stock'
+    parameter_name = 'low_stock'
+
+    def lookups(self, request, model_admin):
+        return [('yes', 'Yes')]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'yes':
+            # Served by the partial low_stock_idx
+            return queryset.filter(low_stock_since__isnull=False)
+        return queryset
+
+
+class ProductVariantInline(admin.TabularInline):
+    model = ProductVariant
+    extra = 0
+    fields = ['name', 'sku', 'price', 'stock', 'is_active']
+
+
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ['name', 'category', 'price', 'stock', 'is_active', 'created_at']
-    list_filter = ['category', 'is_active', 'created_at']
-    search_fields = ['name', 'description']
-    list_editable = ['price', 'stock', 'is_active']
+class ProductAdmin(LargeTableAdmin, admin.ModelAdmin):
+    list_display = ['name', 'category', 'price', 'stock', 'min_stock_level', 'is_active', 'created_at']
+    list_filter = [LowStockFilter, 'category', 'is_active', 'created_at']
+    list_select_related = ['category']
+    search_fields = ['name__startswith']
+    search_help_text = 'Product name, or its beginning'
+    list_editable = ['price', 'is_active']
+    actions = ['shard_stock', 'unshard_stock']
+    inlines = [ProductVariantInline]
+
+    def get_readonly_fields(self, request, obj=None):
+        # Existing stock only changes through stock movements
+        return ['stock', 'shard_count'] if obj else ['shard_count']
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            super().save_model(request, obj, form, change)
+            if 'price' in form.changed_data:
+                # Variants without a price of their own sell at this one
+                variants.refresh_aggregates([obj.id])
+        else:
+            receipt, obj.stock = obj.stock, 0
+            super().save_model(request, obj, form, change)
+            if receipt:
+                inventory.adjust(obj.id, 'receipt', receipt, 'initial stock')
+        # min_stock_level may have changed
+        inventory.mark_low_stock([obj.id])
+
+    @admin.action(description='Spread stock of selected hot products over counter shards')
+    def shard_stock(self, request, queryset):
+        for product_id in queryset.values_list('id', flat=True):
+            inventory.compact(product_id, settings.STOCK_SHARDS)
+        self.message_user(request, f'{queryset.count()} products sharded')
+
+    @admin.action(description='Move stock of selected products back into a single counter')
+    def unshard_stock(self, request, queryset):
+        for product_id in queryset.filter(shard_count__gt=0).values_list('id', flat=True):
+            inventory.compact(product_id, 0)
+        self.message_user(request, 'Stock moved back into products')
 
 
 class CartItemInline(admin.TabularInline):
     model = CartItem
     extra = 0
+    raw_id_fields = ['product']
 
 
 @admin.register(Cart)
-class CartAdmin(admin.ModelAdmin):
+class CartAdmin(LargeTableAdmin, admin.ModelAdmin):
     list_display = ['user', 'created_at']
+    list_select_related = ['user']
+    raw_id_fields = ['user']
     inlines = [CartItemInline]
 
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
+    raw_id_fields = ['product']
     readonly_fields = ['total_price']
 
+    def has_add_permission(self, request, obj=None):
+        # Items come from checkout; the order total and stock would not follow
+        return False
+
+
+class OrderStatusHistoryInline(admin.TabularInline):
+    model = OrderStatusHistory
+    extra = 0
+    can_delete = False
+    readonly_fields = ['from_status', 'status', 'notes', 'changed_by', 'created_at']
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+def _status_action(to_status):
+    def change_status(modeladmin, request, queryset):
+        ids = list(queryset.values_list('id', flat=True))
+        moved = bulk_transition(ids, to_status, changed_by=request.user, notes='Changed in admin')
+        modeladmin.message_user(request, f'{len(moved)} of {len(ids)} orders marked {to_status}')
+    change_status.__name__ = f'mark_{to_status}'
+    change_status.short_description = f'Mark selected orders as {to_status}'
+    return change_status
+
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'status', 'total_amount', 'is_paid', 'created_at']
+class OrderAdmin(LargeTableAdmin, admin.ModelAdmin):
+    list_display = ['id', 'order_number', 'user', 'status', 'total_amount', 'is_paid', 'created_at']
     list_filter = ['status', 'is_paid', 'created_at']
-    search_fields = ['user__username', 'user__email']
-    list_editable = ['status']
-    readonly_fields = ['total_amount', 'stripe_payment_intent', 'created_at', 'updated_at']
-    inlines = [OrderItemInline]
+    list_select_related = ['user']
+    raw_id_fields = ['user']
+    search_fields = ['order_number__startswith']
+    search_help_text = 'Order number, or customer email'
+    # Status changes go through the actions so they are validated and recorded
+    readonly_fields = ['order_number', 'status', 'total_amount', 'stripe_payment_intent', 'created_at', 'updated_at']
+    actions = [_status_action(s) for s in ['processing', 'shipped', 'delivered', 'cancelled']]
+    inlines = [OrderItemInline, OrderStatusHistoryInline]
+    
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if '@' in term:
+            # Look the customer up first; OR-ing email and order number
+            # across the join would scan every order
+            return queryset.filter(user__in=User.objects.filter(email__startswith=term)), False
+        return super().get_search_results(request, queryset, term.upper())
     
     fieldsets = (
         ('Order Information', {
-            'fields': ('user', 'status', 'total_amount', 'is_paid')
+            'fields': ('order_number', 'user', 'status', 'total_amount', 'is_paid')
         }),
         ('Payment Information', {
             'fields': ('stripe_payment_intent',)
@@ -82,3 +184,119 @@ class OrderAdmin(admin.ModelAdmin):
             'fields': ('created_at', 'updated_at')
         }),
     )
+
+
+@admin.register(PaymentWebhook)
+class PaymentWebhookAdmin(LargeTableAdmin, admin.ModelAdmin):
+    list_display = ['event_id', 'gateway', 'event_type', 'order_ref', 'status', 'attempts', 'created_at']
+    list_filter = ['status', 'gateway', 'event_type']
+    search_fields = ['event_id__startswith']
+    readonly_fields = [
+        'gateway', 'event_id', 'event_type', 'event_data', 'order_ref', 'event_created',
+        'status', 'attempts', 'available_at', 'processed_at', 'error_message', 'created_at'
+    ]
+    actions = ['retry']
+
+    @admin.action(description='Retry selected dead events')
+    def retry(self, request, queryset):
+        self.message_user(request, f'{retry_dead(queryset)} events queued again')
+
+
+@admin.register(PaymentTransaction)
+class PaymentTransactionAdmin(LargeTableAdmin, admin.ModelAdmin):
+    list_display = ['gateway_transaction_id', 'order_number', 'transaction_type', 'status', 'amount', 'created_at']
+    list_filter = ['status', 'transaction_type', 'gateway']
+    search_fields = ['gateway_transaction_id__startswith', 'order_number__startswith']
+    raw_id_fields = ['order']
+    readonly_fields = ['created_at', 'updated_at', 'processed_at']
+
+
+class RefundRequestItemInline(admin.TabularInline):
+    model = RefundRequestItem
+    extra = 0
+    raw_id_fields = ['order_item', 'product']
+
+
+@admin.register(RefundRequest)
+class RefundRequestAdmin(LargeTableAdmin, admin.ModelAdmin):
+    list_display = ['id', 'order_number', 'user', 'amount_requested', 'reason', 'status', 'restock', 'created_at']
+    list_filter = ['status', 'reason', 'restock']
+    search_fields = ['order_number__startswith']
+    list_select_related = ['user']
+    raw_id_fields = ['order', 'user', 'reviewed_by']
+    readonly_fields = [
+        'status', 'reviewed_by', 'reviewed_at', 'attempts', 'last_error', 'available_at',
+        'processed_at', 'created_at', 'updated_at'
+    ]
+    inlines = [RefundRequestItemInline]
+    actions = ['approve_refunds', 'approve_with_restock', 'reject_refunds']
+
+    @admin.action(description='Approve selected refunds')
+    def approve_refunds(self, request, queryset):
+        approved = approve(queryset.values_list('id', flat=True), reviewed_by=request.user)
+        self.message_user(request, f'{len(approved)} refunds approved')
+
+    @admin.action(description='Approve selected refunds and restock the items')
+    def approve_with_restock(self, request, queryset):
+        approved = approve(queryset.values_list('id', flat=True), reviewed_by=request.user, restock=True)
+        self.message_user(request, f'{len(approved)} refunds approved')
+
+    @admin.action(description='Reject selected refunds')
+    def reject_refunds(self, request, queryset):
+        rejected = reject(list(queryset.values_list('id', flat=True)), reviewed_by=request.user)
+        self.message_user(request, f'{rejected} refunds rejected')
+
+
+class StockMovementForm(forms.ModelForm):
+    kind = forms.ChoiceField(choices=[('receipt', 'Receipt'), ('adjustment', 'Adjustment')])
+
+    class Meta:
+        model = StockMovement
+        fields = ['product', 'kind', 'quantity', 'reference']
+
+    def clean(self):
+        data = super().clean()
+        product = data.get('product')
+        if product and data.get('quantity', 0) < 0 and inventory.on_hand([product])[product.id] < -data['quantity']:
+            raise forms.ValidationError('Not enough stock on hand for this adjustment')
+        return data
+
+
+@admin.register(StockMovement)
+class StockMovementAdmin(LargeTableAdmin, admin.ModelAdmin):
+    """Append-only: receipts and adjustments can be added, nothing edited or deleted"""
+    form = StockMovementForm
+    list_display = ['id', 'product', 'kind', 'quantity', 'reference', 'created_at']
+    list_filter = ['kind']
+    list_select_related = ['product']
+    search_fields = ['reference__startswith']
+    raw_id_fields = ['product']
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def save_model(self, request, obj, form, change):
+        inventory.adjust(obj.product_id, obj.kind, obj.quantity, obj.reference)
+
+
+@admin.register(LowStockDigest)
+class LowStockDigestAdmin(admin.ModelAdmin):
+    list_display = ['cutoff', 'categories', 'products', 'created_at']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(FlashSale)
+class FlashSaleAdmin(admin.ModelAdmin):
+    list_display = ['product', 'is_active', 'admit_rate', 'max_waiting', 'joined', 'admitted', 'admitted_at']
+    list_filter = ['is_active']
+    list_select_related = ['product']
+    raw_id_fields = ['product']
+    readonly_fields = ['joined', 'admitted', 'admitted_at']
@@ -0,0 +1,117 @@
+"""
+Admin changelists for tables too large to count or page through with OFFSET.
+
+``LargeTableAdmin`` swaps in a paginator whose counts come from the
+PostgreSQL planner instead of ``COUNT(*)``, and a changelist that pages by
+primary key (``?after=<pk>``) while the default newest-first ordering is in
+use. Sorting by a column falls back to ordinary numbered pages.
+"""
+import json
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+CURSOR_VAR = 'after'
+
+# Below this many (estimated) rows an exact count is cheap enough
+EXACT_COUNT_THRESHOLD = 10000
+
+
+def _planner_estimate(queryset):
+    connection = connections[queryset.db]
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            # Unfiltered: the row count kept up to date by ANALYZE
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                [connection.ops.quote_name(queryset.model._meta.db_table)]
+            )
+            return cursor.fetchone()[0]
+        sql, params = queryset.order_by().query.get_compiler(queryset.db).as_sql()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+
+def estimated_count(queryset):
+    """Return (count, estimated) for ``queryset``"""
+    if connections[queryset.db].vendor == 'postgresql':
+        estimate = _planner_estimate(queryset)
+        # A table that was never analyzed reports -1 and is counted exactly
+        if estimate >= EXACT_COUNT_THRESHOLD:
+            return estimate, True
+    return queryset.count(), False
+
+
+class EstimatedCountPaginator(Paginator):
+    estimated = False
+
+    @cached_property
+    def count(self):
+        count, self.estimated = estimated_count(self.object_list)
+        return count
+
+
+class KeysetChangeList(ChangeList):
+    keyset = False
+    next_cursor = None
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = request.GET.get(CURSOR_VAR)
+        super().__init__(request, *args, **kwargs)
+        # Keep the cursor out of filter, search and sort links
+        self.params.pop(CURSOR_VAR, None)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        if ORDER_VAR in self.params or self.show_all:
+            return super().get_results(request)
+
+        queryset = self.queryset
+        if self.cursor:
+            try:
+                queryset = queryset.filter(pk__lt=int(self.cursor))
+            except ValueError:
+                raise IncorrectLookupParameters
+        ids = list(queryset.values_list('pk', flat=True)[:self.list_per_page + 1])
+        if len(ids) > self.list_per_page:
+            self.next_cursor = ids[self.list_per_page - 1]
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.keyset = True
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = queryset[:self.list_per_page]
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = paginator
+
+    @property
+    def next_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+    @property
+    def first_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+
+class LargeTableAdmin:
+    """Mixin for ModelAdmins over tables with millions of rows"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Newest first by primary key, so pages can be fetched by key
+    ordering = ['-pk']
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
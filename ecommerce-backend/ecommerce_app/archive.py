@@ -0,0 +1,123 @@
+"""
+Cold storage for old orders.
+
+``archive_orders`` moves delivered orders past a cut-off out of ``Order``,
+``OrderItem`` and ``OrderStatusHistory`` into ``ArchivedOrder``, one row per
+order with the items and status history packed into compressed JSON. On PostgreSQL the archive is partitioned by month and
+the partitions are created here as they are needed.
+"""
+import json
+import zlib
+from datetime import date
+
+from django.db import connection, transaction
+
+from .models import ArchivedOrder, Order, OrderItem, OrderStatusHistory
+
+# Order columns that are only needed when a single archived order is shown
+PACKED_FIELDS = [
+    'stripe_payment_intent', 'shipping_address', 'shipping_city',
+    'shipping_postal_code', 'shipping_country',
+]
+
+
+def _month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def _next_month(value):
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def ensure_partitions(created_ats):
+    """Create the monthly archive partitions covering ``created_ats`` (PostgreSQL only)"""
+    if connection.vendor != 'postgresql':
+        return
+    q = connection.ops.quote_name
+    table = ArchivedOrder._meta.db_table
+    with connection.cursor() as cursor:
+        for month in sorted({_month_start(value) for value in created_ats}):
+            partition = f'{table}_{month:%Y_%m}'
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {q(partition)} PARTITION OF {q(table)} '
+                f'FOR VALUES FROM (%s) TO (%s)',
+                [month, _next_month(month)]
+            )
+
+
+def pack(order, items, history=()):
+    data = {field: getattr(order, field) for field in PACKED_FIELDS}
+    data['items'] = [
+        {
+            'id': item.id,
+            'product': item.product_id,
+            'product_name': item.product.name,
+            'quantity': item.quantity,
+            'price': str(item.price),
+            'total_price': str(item.total_price),
+        }
+        for item in items
+    ]
+    data['status_history'] = [
+        {
+            'from_status': change.from_status,
+            'status': change.status,
+            'notes': change.notes,
+            'changed_by': change.changed_by_id,
+            'created_at': change.created_at.isoformat(),
+        }
+        for change in history
+    ]
+    return zlib.compress(json.dumps(data).encode())
+
+
+def unpack(archived_order):
+    return json.loads(zlib.decompress(bytes(archived_order.data)))
+
+
+def archive_batch(before, batch_size=500):
+    """Archive up to ``batch_size`` delivered orders created before ``before``"""
+    with transaction.atomic():
+        orders = list(
+            Order.objects.select_for_update(skip_locked=True)
+            .filter(status='delivered', created_at__lt=before)
+            .order_by('id')[:batch_size]
+        )
+        if not orders:
+            return 0
+
+        items = {}
+        for item in OrderItem.objects.filter(order__in=orders).select_related('product').order_by('id'):
+            items.setdefault(item.order_id, []).append(item)
+        history = {}
+        for change in OrderStatusHistory.objects.filter(order__in=orders).order_by('created_at', 'id'):
+            history.setdefault(change.order_id, []).append(change)
+
+        ensure_partitions(order.created_at for order in orders)
+        ArchivedOrder.objects.bulk_create([
+            ArchivedOrder(
+                id=order.id,
+                order_number=order.order_number,
+                user_id=order.user_id,
+                status=order.status,
+                total_amount=order.total_amount,
+                item_count=order.item_count,
+                is_paid=order.is_paid,
+                created_at=order.created_at,
+                updated_at=order.updated_at,
+                data=pack(order, items.get(order.id, []), history.get(order.id, [])),
+            )
+            for order in orders
+        ])
+        # Cascades to the items and status history packed above
+        Order.objects.filter(id__in=[order.id for order in orders]).delete()
+    return len(orders)
+
+
+def archive_orders(before, batch_size=500):
+    archived = 0
+    while True:
+        count = archive_batch(before, batch_size)
+        archived += count
+        if count < batch_size:
+            return archived
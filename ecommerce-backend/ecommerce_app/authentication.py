@@ -0,0 +1,141 @@
+"""
+JWT authentication without a user query per request.
+
+``JWTAuthentication`` loads the token's user from the database on every
+authenticated request. ``CachedJWTAuthentication`` keeps each user in the
+cache for ``AUTH_USER_CACHE_TTL`` seconds instead. Only ``CACHED_FIELDS``
+are stored, never the password hash, and the user is rebuilt from them as a
+``partial_copy`` that refuses to be saved until ``refresh_from_db()`` loads
+the whole row, so views that write to it reload it first. Saving or deleting
+a user calls ``invalidate_user`` once the transaction commits, which drops
+the entry and bumps the user's version key. Entries are stored with the version they
+were loaded under and ignored once it moves on, so a request that read the
+user just before a change cannot put the stale copy back for the rest of the
+TTL. Call ``invalidate_user`` after ``QuerySet.update()`` on users, which
+bypasses ``save()``. With a per-process cache such as ``LocMemCache`` other
+processes only see a change once their entry expires, so keep the TTL short.
+
+``StatelessJWTAuthentication`` goes further for views whose reads only need
+to know who the user is: with ``AUTH_STATELESS_READS`` on, GET, HEAD and
+OPTIONS requests get a user built from the token's signed claims with no
+lookup at all. A deactivated user keeps read access until their access token
+expires, and the user is never staff, so staff-only reads still fail closed.
+Unsafe methods, and tokens issued before the claims were added, fall back to
+the cached lookup.
+
+Refresh tokens are single use: ``/auth/token/refresh/`` rotates them, and
+``RotatingRefreshToken.blacklist`` revokes the token being spent with one
+atomic ``cache.add`` of its JTI, which both records the revocation and
+rejects a token that was already spent, including by a concurrent request.
+The key expires with the token, when it would be refused anyway, so the set
+of revoked JTIs prunes itself and holds at most one refresh lifetime of
+rotations. Revocations live in the default cache, which therefore has to be
+shared by all workers and must not evict keys before they expire.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+# What views read from request.user; the password hash stays out of the cache
+CACHED_FIELDS = [
+    'id', 'email', 'first_name', 'last_name', 'phone_number', 'date_of_birth', 'address', 'city',
+    'state', 'postal_code', 'country', 'is_active', 'is_staff', 'is_superuser', 'is_verified',
+    'date_joined', 'last_login',
+]
+
+
+def _keys(user_id):
+    return f'auth-user-fields:{user_id}', f'auth-user-version:{user_id}'
+
+
+def _detached(user_model, fields):
+    """A user built from ``fields`` that behaves as a saved row, e.g. for filter(user=...)"""
+    user = user_model(**fields)
+    user._state.adding = False
+    user._state.db = 'default'
+    user.partial_copy = True
+    return user
+
+
+def invalidate_user(user_id):
+    """Drop the user's cached copy so the next request loads it again"""
+    entry, version = _keys(user_id)
+    cache.delete(entry)
+    try:
+        cache.incr(version)
+    except ValueError:
+        # No version yet (or it was evicted): any new value differs from what entries were stored under
+        cache.set(version, time.time_ns(), timeout=None)
+
+
+class RotatingRefreshToken(RefreshToken):
+    """Refresh token that is revoked once rotated"""
+
+    def blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        ttl = max(1, self.payload['exp'] - int(time.time()))
+        if not cache.add(f'revoked-token:{jti}', True, ttl):
+            raise TokenError(_('Token is blacklisted'))
+
+    def outstand(self):
+        # Only spent tokens are recorded; the token_blacklist tables are not installed
+        return None
+
+
+def tokens_for(user):
+    """Return a refresh token for the user carrying the claims stateless reads rely on"""
+    refresh = RotatingRefreshToken.for_user(user)
+    refresh['email'] = user.email
+    return refresh
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """``JWTAuthentication`` that serves the token's user from the cache"""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        entry_key, version_key = _keys(user_id)
+        cached = cache.get_many([entry_key, version_key])
+        version = cached.get(version_key, 0)
+        entry = cached.get(entry_key)
+        if entry is not None and entry[0] == version:
+            return _detached(self.user_model, entry[1])
+        # Inactive users are never cached: super() refuses them
+        user = super().get_user(validated_token)
+        fields = {field: getattr(user, field) for field in CACHED_FIELDS}
+        cache.set(entry_key, (version, fields), settings.AUTH_USER_CACHE_TTL)
+        return user
+
+
+class StatelessJWTAuthentication(CachedJWTAuthentication):
+    """Trust the token's claims for read-only requests when ``AUTH_STATELESS_READS`` is on"""
+
+    def authenticate(self, request):
+        self.request = request
+        return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        if (
+            settings.AUTH_STATELESS_READS
+            and self.request.method in SAFE_METHODS
+            and api_settings.USER_ID_CLAIM in validated_token
+            and 'email' in validated_token
+        ):
+            return _detached(self.user_model, {
+                api_settings.USER_ID_FIELD: validated_token[api_settings.USER_ID_CLAIM],
+                'email': validated_token['email'],
+                'is_active': True,
+            })
+        return super().get_user(validated_token)
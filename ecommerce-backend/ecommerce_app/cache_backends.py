@@ -0,0 +1,436 @@
+"""
+Cache backends.
+
+``LayeredCache`` puts a small in-process LRU (L1) in front of another cache
+alias that every worker shares (L2, the backend's ``LOCATION``). Reads are
+served from L1 when they can be, and otherwise from L2, filling L1. Writes go
+to L2 first and then update the writer's own L1. ``add`` and ``incr`` always
+run on L2, so they stay atomic across workers.
+
+Other workers learn about a write through an invalidation log kept in L2.
+Each write bumps a sequence number and stores the written keys under it.
+Every worker reads the sequence at most every ``SYNC_INTERVAL`` seconds and
+drops the logged keys from its L1. If it fell further behind than the log
+reaches, or L2 was cleared, it drops its whole L1. A write therefore reaches
+every worker within ``SYNC_INTERVAL``, at the price of two extra L2 calls
+per write, ``add`` and ``incr`` included. Counters bumped on every request
+(the rate limiter's) should therefore use the L2 alias directly. L1 entries also expire after at most ``L1_TIMEOUT`` seconds,
+whatever happens. L1 holds at most ``MAX_ENTRIES`` keys and evicts the least
+recently used.
+
+Each process counts the hits and misses of both tiers, and L1 evictions and
+invalidations. It adds them to shared counters in L2 every
+``STATS_INTERVAL`` seconds; ``manage.py cache_stats`` reports them.
+
+``SQLiteCache`` is an L2 for a single machine: an SQLite file in WAL mode
+that all its workers open, with atomic ``add`` and ``incr``. When workers
+run on several machines, use Django's ``RedisCache`` instead.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import cached_property
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+LOG_PREFIX = 'l1-log'
+# Seconds log entries are kept; a worker that has not synced for longer starts its L1 afresh
+LOG_TIMEOUT = 300
+# Log entries a worker catches up on before it simply clears its L1
+MAX_LOG_LAG = 1000
+STATS_PREFIX = 'cache-stats'
+STATS_INTERVAL = 10
+STATS = ['l1_hits', 'l1_misses', 'l2_hits', 'l2_misses', 'l1_evictions', 'l1_invalidations']
+
+_missing = object()
+
+
+class _Tier:
+    """One process's L1 for one LayeredCache alias, shared by its threads"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.sync_lock = threading.Lock()
+        self.synced_at = None
+        self.flushed_at = time.monotonic()
+        self.seen = 0
+        self.cleared = None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return _missing
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return _missing
+            self.entries.move_to_end(key)
+        return pickle.loads(entry[0])
+
+    def put(self, key, value, timeout):
+        entry = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.monotonic() + timeout)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['l1_evictions'] += 1
+
+    def discard(self, keys, stat=None):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None and stat:
+                    self.stats[stat] += 1
+
+    def clear(self):
+        with self.lock:
+            self.stats['l1_invalidations'] += len(self.entries)
+            self.entries.clear()
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+def _incr(cache, key, delta):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, None):
+            return delta
+        return cache.incr(key, delta)
+
+
+class LayeredCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._l2_alias = location
+        self._l1_timeout = options.get('L1_TIMEOUT', 60)
+        self._sync_interval = options.get('SYNC_INTERVAL', 1.0)
+        with _tiers_lock:
+            self._tier = _tiers.setdefault(location, _Tier(self._max_entries))
+
+    @cached_property
+    def _l2(self):
+        # Backends are per thread, like the L2 instance this picks up
+        return caches[self._l2_alias]
+
+    def _l1_timeout_for(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self._l2.default_timeout
+        return self._l1_timeout if timeout is None else min(timeout, self._l1_timeout)
+
+    def _sync(self):
+        tier = self._tier
+        now = time.monotonic()
+        if tier.synced_at is not None and now - tier.synced_at < self._sync_interval:
+            return tier
+        if not tier.sync_lock.acquire(blocking=False):
+            # Another thread is syncing
+            return tier
+        try:
+            l2 = self._l2
+            state = l2.get_many([f'{LOG_PREFIX}:seq', f'{LOG_PREFIX}:cleared'])
+            seq, cleared = state.get(f'{LOG_PREFIX}:seq', 0), state.get(f'{LOG_PREFIX}:cleared')
+            if tier.synced_at is None:
+                # A new L1 is empty: start from the current end of the log
+                pass
+            elif cleared != tier.cleared or seq < tier.seen or seq - tier.seen > MAX_LOG_LAG:
+                tier.clear()
+            elif seq > tier.seen:
+                logged = l2.get_many([f'{LOG_PREFIX}:{n}' for n in range(tier.seen + 1, seq + 1)])
+                if len(logged) < seq - tier.seen:
+                    # Expired, or still being written: the keys are unknown
+                    tier.clear()
+                else:
+                    tier.discard([key for keys in logged.values() for key in keys], 'l1_invalidations')
+            tier.seen, tier.cleared, tier.synced_at = seq, cleared, now
+
+            if now - tier.flushed_at >= STATS_INTERVAL:
+                self._flush_stats(tier, now)
+        finally:
+            tier.sync_lock.release()
+        return tier
+
+    def _publish(self, keys):
+        l2 = self._l2
+        seq = _incr(l2, f'{LOG_PREFIX}:seq', 1)
+        l2.set(f'{LOG_PREFIX}:{seq}', keys, LOG_TIMEOUT)
+
+    def _flush_stats(self, tier, now):
+        with tier.lock:
+            counts, tier.stats = tier.stats, Counter()
+        tier.flushed_at = now
+        for stat, n in counts.items():
+            if n:
+                _incr(self._l2, f'{STATS_PREFIX}:{stat}', n)
+
+    def get(self, key, default=None, version=None):
+        # L2 validates the key if it gets asked
+        full_key = self._l2.make_key(key, version)
+        tier = self._sync()
+        value = tier.get(full_key)
+        if value is not _missing:
+            tier.count('l1_hits')
+            return value
+        tier.count('l1_misses')
+        value = self._l2.get(key, _missing, version)
+        if value is _missing:
+            tier.count('l2_misses')
+            return default
+        tier.count('l2_hits')
+        tier.put(full_key, value, self._l1_timeout)
+        return value
+
+    def get_many(self, keys, version=None):
+        l2 = self._l2
+        tier = self._sync()
+        found, missing = {}, []
+        for key in keys:
+            value = tier.get(l2.make_key(key, version))
+            if value is _missing:
+                missing.append(key)
+            else:
+                found[key] = value
+        tier.count('l1_hits', len(found))
+        if missing:
+            tier.count('l1_misses', len(missing))
+            fetched = l2.get_many(missing, version)
+            tier.count('l2_hits', len(fetched))
+            tier.count('l2_misses', len(missing) - len(fetched))
+            for key, value in fetched.items():
+                tier.put(l2.make_and_validate_key(key, version), value, self._l1_timeout)
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        l2 = self._l2
+        full_key = l2.make_and_validate_key(key, version)
+        l2.set(key, value, timeout, version)
+        self._publish([full_key])
+        l1_timeout = self._l1_timeout_for(timeout)
+        if l1_timeout > 0:
+            self._tier.put(full_key, value, l1_timeout)
+        else:
+            self._tier.discard([full_key])
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        l2 = self._l2
+        failed = l2.set_many(data, timeout, version)
+        full_keys = {key: l2.make_and_validate_key(key, version) for key in data}
+        self._publish(list(full_keys.values()))
+        l1_timeout = self._l1_timeout_for(timeout)
+        for key, value in data.items():
+            if l1_timeout > 0 and key not in failed:
+                self._tier.put(full_keys[key], value, l1_timeout)
+            else:
+                self._tier.discard([full_keys[key]])
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        l2 = self._l2
+        if not l2.add(key, value, timeout, version):
+            return False
+        # A stale copy may survive elsewhere if L2 dropped the key before it expired there
+        self._publish([l2.make_and_validate_key(key, version)])
+        return True
+
+    def incr(self, key, delta=1, version=None):
+        l2 = self._l2
+        value = l2.incr(key, delta, version)
+        full_key = l2.make_and_validate_key(key, version)
+        self._tier.discard([full_key])
+        self._publish([full_key])
+        return value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._l2.touch(key, timeout, version)
+
+    def delete(self, key, version=None):
+        l2 = self._l2
+        deleted = l2.delete(key, version)
+        full_key = l2.make_and_validate_key(key, version)
+        self._tier.discard([full_key])
+        # Even when L2 had nothing, other workers may still hold a copy
+        self._publish([full_key])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        l2 = self._l2
+        l2.delete_many(keys, version)
+        full_keys = [l2.make_and_validate_key(key, version) for key in keys]
+        self._tier.discard(full_keys)
+        self._publish(full_keys)
+
+    def clear(self):
+        l2 = self._l2
+        l2.clear()
+        # Tells every worker to drop its L1, since the log went with the rest of L2
+        l2.set(f'{LOG_PREFIX}:cleared', time.time_ns(), None)
+        self._tier.clear()
+
+    def stats(self):
+        """Hits and misses of each tier across all workers since the last reset"""
+        counts = self._l2.get_many([f'{STATS_PREFIX}:{stat}' for stat in STATS])
+        with self._tier.lock:
+            unflushed = dict(self._tier.stats)
+        return {stat: counts.get(f'{STATS_PREFIX}:{stat}', 0) + unflushed.get(stat, 0) for stat in STATS}
+
+    def reset_stats(self):
+        self._l2.delete_many([f'{STATS_PREFIX}:{stat}' for stat in STATS])
+        with self._tier.lock:
+            self._tier.stats.clear()
+
+
+def _encode(value):
+    # Integers are stored as such so incr can add to them in SQL
+    if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+        return value
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _decode(value):
+    return value if isinstance(value, int) else pickle.loads(value)
+
+
+class SQLiteCache(BaseCache):
+    # Writes between checks of MAX_ENTRIES
+    CULL_EVERY = 100
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = location
+        self._local = threading.local()
+        self._writes = 0
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            # One connection per thread, and a new one in each forked worker
+            db = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _wrote(self, db):
+        self._writes += 1
+        if self._writes % self.CULL_EVERY:
+            return
+        db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+        count = db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count <= self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            db.execute('DELETE FROM cache')
+            return
+        # Drop the entries closest to expiring, those without a timeout last
+        db.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?)',
+            (max(count - self._max_entries, count // self._cull_frequency),)
+        )
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version)
+        row = self._db().execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time())
+        ).fetchone()
+        return default if row is None else _decode(row[0])
+
+    def get_many(self, keys, version=None):
+        keys = {self.make_and_validate_key(key, version): key for key in keys}
+        found = {}
+        made = list(keys)
+        for start in range(0, len(made), 500):
+            chunk = made[start:start + 500]
+            rows = self._db().execute(
+                f'SELECT key, value FROM cache WHERE key IN ({",".join("?" * len(chunk))}) '
+                'AND (expires IS NULL OR expires > ?)', (*chunk, time.time())
+            )
+            found.update((keys[key], _decode(value)) for key, value in rows)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version)
+        db = self._db()
+        db.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (key, _encode(value), self.get_backend_timeout(timeout))
+        )
+        self._wrote(db)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                [(self.make_and_validate_key(key, version), _encode(value), expires) for key, value in data.items()]
+            )
+        self._wrote(db)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version)
+        db = self._db()
+        # Inserts, or replaces an expired row; a live row is left alone
+        added = db.execute(
+            'INSERT INTO cache (key, value, expires) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE '
+            'SET value = excluded.value, expires = excluded.expires WHERE cache.expires <= ?',
+            (key, _encode(value), self.get_backend_timeout(timeout), time.time())
+        ).rowcount == 1
+        self._wrote(db)
+        return added
+
+    def incr(self, key, delta=1, version=None):
+        made_key = self.make_and_validate_key(key, version)
+        row = self._db().execute(
+            "UPDATE cache SET value = value + ? WHERE key = ? AND typeof(value) = 'integer' "
+            'AND (expires IS NULL OR expires > ?) RETURNING value',
+            (delta, made_key, time.time())
+        ).fetchone()
+        if row is None:
+            raise ValueError(f"Key '{key}' not found or not an integer")
+        return row[0]
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version)
+        now = time.time()
+        return self._db().execute(
+            'UPDATE cache SET expires = ? WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (self.get_backend_timeout(timeout), key, now)
+        ).rowcount == 1
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version)
+        return self._db().execute(
+            'SELECT 1 FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time())
+        ).fetchone() is not None
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version)
+        return self._db().execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount == 1
+
+    def delete_many(self, keys, version=None):
+        made = [self.make_and_validate_key(key, version) for key in keys]
+        for start in range(0, len(made), 500):
+            chunk = made[start:start + 500]
+            self._db().execute(f'DELETE FROM cache WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+
+    def clear(self):
+        self._db().execute('DELETE FROM cache')
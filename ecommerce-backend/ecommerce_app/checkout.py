@@ -0,0 +1,86 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Sum
+
+from . import inventory, reservations
+from .models import Order, OrderItem
+from .reservations import release_user_holds
+
+
+class EmptyCart(Exception):
+    """Raised when checkout is attempted with no items in the cart"""
+
+    def __init__(self):
+        super().__init__('Cart is empty')
+
+
+def place_order(cart, shipping, order_number=''):
+    """Turn ``cart`` into an order, decrementing stock set-wise.
+
+    Must run inside ``transaction.atomic()``. The query count does not depend
+    on the number of cart lines: the products are locked in id order (so two
+    checkouts can never deadlock on each other), stock is decremented with a
+    single conditional UPDATE and the order items and stock movements are
+    bulk inserted. Hot products whose stock is sharded are not locked; each
+    takes its units from one of its shards (see ``inventory``). Units held by
+    other checkouts are off the stock, so the same UPDATEs keep them unsold.
+
+    Pass an ``order_number`` allocated before the transaction was opened;
+    otherwise ``Order.save`` allocates one.
+    """
+    user = cart.user
+
+    quantities = defaultdict(int)
+    for product_id, quantity in cart.items.values_list('product_id', 'quantity'):
+        quantities[product_id] += quantity
+    if not quantities:
+        raise EmptyCart()
+
+    product_ids = sorted(quantities)
+    products = inventory.lock(product_ids)
+
+    # The buyer's holds go back on sale and are taken again with the rest of
+    # the cart; other users' holds are already off the stock
+    release_user_holds(user)
+    reservations.take(quantities, products)
+    products = [products[product_id] for product_id in product_ids]
+
+    total = sum(
+        (product.price * quantities[product.id] for product in products), Decimal('0.00')
+    )
+    order = Order.objects.create(
+        order_number=order_number,
+        user=user,
+        total_amount=total,
+        item_count=sum(quantities.values()),
+        shipping_address=shipping['shipping_address'],
+        shipping_city=shipping['shipping_city'],
+        shipping_postal_code=shipping['shipping_postal_code'],
+        shipping_country=shipping['shipping_country']
+    )
+    OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            product=product,
+            quantity=quantities[product.id],
+            price=product.price
+        )
+        for product in products
+    ])
+    inventory.record(
+        (product_id, 'sale', -quantity, order.order_number) for product_id, quantity in quantities.items()
+    )
+    return order
+
+
+def restore_stock(order_ids):
+    """Put the items of the given orders back on sale and record them as returns"""
+    lines = (
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .values_list('product_id', 'order__order_number')
+        .annotate(total=Sum('quantity'))
+    )
+    return inventory.add(
+        (product_id, 'return', quantity, order_number) for product_id, order_number, quantity in lines
+    )
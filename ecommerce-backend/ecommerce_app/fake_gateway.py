@@ -0,0 +1,281 @@
+"""
+Offline stand-in for the Stripe PaymentIntent API.
+
+``FakeProcessor`` keeps intents in memory and simulates the customer paying
+right after an intent is created: the intent succeeds (or is declined with
+probability ``FAKE_GATEWAY_DECLINE_RATE``) and the matching webhook is sent,
+signed the way Stripe signs them. Every API call sleeps
+``FAKE_GATEWAY_LATENCY_MS`` and fails with probability
+``FAKE_GATEWAY_FAILURE_RATE``.
+
+It is used in-process by ``gateways.FakeGateway`` and over HTTP by
+``run_fake_gateway``, which serves the few ``/v1/payment_intents`` and
+``/v1/refunds`` endpoints the ``stripe`` SDK calls, so the real SDK client
+can be load tested offline.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_ATTEMPTS = 3
+
+
+class SimulatedFailure(Exception):
+    pass
+
+
+class NoSuchIntent(Exception):
+    pass
+
+
+class InvalidRequest(Exception):
+    pass
+
+
+def sign(payload, secret, timestamp=None):
+    """Stripe-Signature header value for ``payload`` (bytes)"""
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def verify(payload, header, secret, tolerance=300):
+    """Check a Stripe-Signature header produced by ``sign``"""
+    try:
+        parts = dict(item.split('=', 1) for item in (header or '').split(','))
+        timestamp = int(parts['t'])
+    except (KeyError, ValueError):
+        return False
+    if abs(time.time() - timestamp) > tolerance:
+        return False
+    expected = sign(payload, secret, timestamp).split('v1=', 1)[1]
+    return hmac.compare_digest(expected, parts.get('v1', ''))
+
+
+class FakeProcessor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._intents = {}
+        self._idempotent = {}
+        self._delivery = None
+
+    def _simulate(self):
+        if settings.FAKE_GATEWAY_LATENCY_MS:
+            time.sleep(settings.FAKE_GATEWAY_LATENCY_MS / 1000)
+        if random.random() < settings.FAKE_GATEWAY_FAILURE_RATE:
+            raise SimulatedFailure('Simulated gateway failure')
+
+    def create_payment_intent(self, amount, currency, metadata, idempotency_key=None):
+        with self._lock:
+            if idempotency_key in self._idempotent:
+                return dict(self._idempotent[idempotency_key])
+        self._simulate()
+
+        intent_id = f'pi_fake_{uuid.uuid4().hex[:24]}'
+        intent = {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': amount,
+            'currency': currency,
+            'metadata': {key: str(value) for key, value in metadata.items()},
+            'client_secret': f'{intent_id}_secret_fake',
+            'status': 'requires_payment_method',
+            'created': int(time.time()),
+        }
+        created = dict(intent)
+        with self._lock:
+            self._intents[intent_id] = intent
+            if idempotency_key:
+                self._idempotent[idempotency_key] = created
+        self._settle(intent)
+        return dict(created)
+
+    def retrieve_payment_intent(self, intent_id):
+        self._simulate()
+        with self._lock:
+            intent = self._intents.get(intent_id)
+        if intent is not None:
+            return dict(intent)
+        if intent_id.startswith('pi_fake_'):
+            # Created by another process's in-process fake
+            return {
+                'id': intent_id, 'object': 'payment_intent',
+                'client_secret': f'{intent_id}_secret_fake', 'status': 'succeeded',
+            }
+        raise NoSuchIntent(f'No such payment_intent: {intent_id}')
+
+    def create_refund(self, payment_intent_id, amount, idempotency_key=None):
+        with self._lock:
+            if idempotency_key in self._idempotent:
+                return dict(self._idempotent[idempotency_key])
+        self._simulate()
+
+        with self._lock:
+            intent = self._intents.get(payment_intent_id)
+            if intent is None and not payment_intent_id.startswith('pi_fake_'):
+                raise NoSuchIntent(f'No such payment_intent: {payment_intent_id}')
+            if intent is not None:
+                if intent['status'] != 'succeeded' or intent.get('amount_refunded', 0) + amount > intent['amount']:
+                    raise InvalidRequest(f'Refund of {amount} exceeds what {payment_intent_id} can refund')
+                intent['amount_refunded'] = intent.get('amount_refunded', 0) + amount
+            refund = {
+                'id': f're_fake_{uuid.uuid4().hex[:24]}',
+                'object': 'refund',
+                'amount': amount,
+                'payment_intent': payment_intent_id,
+                'status': 'succeeded',
+                'created': int(time.time()),
+            }
+            if idempotency_key:
+                self._idempotent[idempotency_key] = refund
+        return dict(refund)
+
+    def list_payment_intents(self, created_gte, created_lt, limit=100, starting_after=None):
+        """A page of intents created in [created_gte, created_lt), newest first like Stripe"""
+        self._simulate()
+        with self._lock:
+            intents = sorted(
+                (intent for intent in self._intents.values() if created_gte <= intent['created'] < created_lt),
+                key=lambda intent: (-intent['created'], intent['id'])
+            )
+        if starting_after:
+            ids = [intent['id'] for intent in intents]
+            intents = intents[ids.index(starting_after) + 1:] if starting_after in ids else []
+        return {
+            'object': 'list',
+            'url': '/v1/payment_intents',
+            'data': [dict(intent) for intent in intents[:limit]],
+            'has_more': len(intents) > limit,
+        }
+
+    def _settle(self, intent):
+        """Have the customer pay (or get declined) and send the webhook"""
+        if random.random() < settings.FAKE_GATEWAY_DECLINE_RATE:
+            intent['status'] = 'requires_payment_method'
+            intent['last_payment_error'] = {'code': 'card_declined', 'message': 'Your card was declined.'}
+            event_type = 'payment_intent.payment_failed'
+        else:
+            intent['status'] = 'succeeded'
+            event_type = 'payment_intent.succeeded'
+        self.deliver({
+            'id': f'evt_fake_{uuid.uuid4().hex[:24]}',
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'data': {'object': dict(intent)},
+        })
+
+    def deliver(self, event):
+        url = settings.FAKE_GATEWAY_WEBHOOK_URL
+        if not url:
+            # No endpoint to call: queue the event directly
+            from .webhooks import ingest
+            ingest(settings.PAYMENT_GATEWAY, event)
+            return
+        with self._lock:
+            if self._delivery is None:
+                self._delivery = ThreadPoolExecutor(max_workers=4, thread_name_prefix='fake-webhook')
+        self._delivery.submit(self._post, url, json.dumps(event).encode())
+
+    def _post(self, url, payload):
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            request = urllib.request.Request(url, data=payload, method='POST', headers={
+                'Content-Type': 'application/json',
+                'Stripe-Signature': sign(payload, settings.STRIPE_WEBHOOK_SECRET),
+            })
+            try:
+                with urllib.request.urlopen(request, timeout=10):
+                    return
+            except OSError as e:
+                logger.warning(f'Fake webhook delivery to {url} failed: {e}')
+                time.sleep(2 ** attempt)
+
+
+processor = FakeProcessor()
+
+
+class FakeGatewayHandler(BaseHTTPRequestHandler):
+    """The subset of the Stripe API that StripeGateway uses"""
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, error_type, message, code=None):
+        self._respond(status, {'error': {'type': error_type, 'message': message, 'code': code}})
+
+    def _handle(self, call):
+        try:
+            self._respond(200, call())
+        except SimulatedFailure as e:
+            self._error(500, 'api_error', str(e))
+        except NoSuchIntent as e:
+            self._error(404, 'invalid_request_error', str(e), 'resource_missing')
+        except InvalidRequest as e:
+            self._error(400, 'invalid_request_error', str(e))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/v1/refunds':
+            return self._handle(lambda: processor.create_refund(
+                form.get('payment_intent', ''),
+                amount=int(form.get('amount', 0)),
+                idempotency_key=self.headers.get('Idempotency-Key')
+            ))
+        if path != '/v1/payment_intents':
+            return self._error(404, 'invalid_request_error', f'Unrecognized request URL: {self.path}')
+        metadata = {
+            key[len('metadata['):-1]: value
+            for key, value in form.items() if key.startswith('metadata[')
+        }
+        self._handle(lambda: processor.create_payment_intent(
+            amount=int(form.get('amount', 0)),
+            currency=form.get('currency', 'usd'),
+            metadata=metadata,
+            idempotency_key=self.headers.get('Idempotency-Key')
+        ))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        prefix = '/v1/payment_intents/'
+        if path == prefix.rstrip('/'):
+            query = dict(parse_qsl(url.query))
+            return self._handle(lambda: processor.list_payment_intents(
+                created_gte=int(query.get('created[gte]', 0)),
+                created_lt=int(query.get('created[lt]', 2 ** 62)),
+                limit=int(query.get('limit', 10)),
+                starting_after=query.get('starting_after')
+            ))
+        if not path.startswith(prefix):
+            return self._error(404, 'invalid_request_error', f'Unrecognized request URL: {self.path}')
+        self._handle(lambda: processor.retrieve_payment_intent(path[len(prefix):]))
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(host='127.0.0.1', port=12111):
+    server = ThreadingHTTPServer((host, port), FakeGatewayHandler)
+    server.daemon_threads = True
+    return server
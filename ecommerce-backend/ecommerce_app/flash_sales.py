@@ -0,0 +1,179 @@
+"""
+Flash-sale admission control.
+
+When a product in flash-sale mode goes live its buyers do not all hit
+checkout at once. Each ``join``s the product's queue and gets a ticket with a
+position and a waiting-room token. ``admit_flash_sales`` admits each queue in
+position order at the sale's ``admit_rate``, and never has more users admitted
+than there are units left, so checkouts arrive at a pace the database can
+sustain and users who could not buy anyway are not let in to try. Clients
+poll their ticket until it is admitted, then check out with the token in the
+``Waiting-Room-Token`` header within ``admission_ttl`` seconds.
+
+The queue is bounded: joins are refused once ``max_waiting`` users are
+waiting, and once the product is sold out, at which point the users still
+waiting are told so. Joining locks the sale row only
+long enough to hand out the next position, and polling is a single read.
+"""
+import secrets
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import inventory
+from .models import FlashSale, FlashSaleTicket
+
+HEADER = 'Waiting-Room-Token'
+
+# Admissions a sale can catch up on after the admitter was paused, in seconds
+MAX_CATCH_UP = 5
+
+
+class QueueFull(Exception):
+    """Raised when a sale's queue already holds ``max_waiting`` users"""
+
+    def __init__(self, sale):
+        self.retry_after = max(1, (sale.joined - sale.admitted) // max(1, sale.admit_rate))
+        super().__init__('The waiting room is full, please try again later')
+
+
+class SoldOut(Exception):
+    """Raised when a flash-sale product has no units left to queue for"""
+
+    def __init__(self, product):
+        super().__init__(f'{product.name} is sold out')
+
+
+class NotAdmitted(Exception):
+    """Raised when a checkout includes a flash-sale product the user was not admitted for"""
+
+    def __init__(self, product):
+        self.product = product
+        super().__init__(f'{product.name} is in a flash sale: join its waiting room and wait to be admitted')
+
+
+def _is_live(ticket, now):
+    return ticket.status == 'waiting' or ticket.status == 'admitted' and ticket.expires_at > now
+
+
+def join(product_id, user):
+    """Return the user's live ticket for the product's flash sale, queueing them if they have none.
+
+    Raises ``FlashSale.DoesNotExist``, ``QueueFull`` or ``SoldOut``.
+    """
+    now = timezone.now()
+    sale = FlashSale.objects.select_related('product').get(product_id=product_id, is_active=True)
+    ticket = FlashSaleTicket.objects.filter(sale=sale, user=user).first()
+    if ticket and _is_live(ticket, now):
+        return ticket
+    # Refuse before taking the lock: these are the common answers once a sale is busy
+    if sale.joined - sale.admitted >= sale.max_waiting:
+        raise QueueFull(sale)
+    if inventory.on_hand([sale.product])[product_id] <= 0:
+        raise SoldOut(sale.product)
+
+    with transaction.atomic():
+        sale = FlashSale.objects.select_for_update().get(id=sale.id)
+        if sale.joined - sale.admitted >= sale.max_waiting:
+            raise QueueFull(sale)
+        FlashSale.objects.filter(id=sale.id).update(joined=F('joined') + 1, updated_at=now)
+        # A user whose admission lapsed or was used goes to the back of the queue
+        ticket = ticket or FlashSaleTicket(sale=sale, user=user)
+        ticket.token = secrets.token_urlsafe(32)
+        ticket.position = sale.joined + 1
+        ticket.status = 'waiting'
+        ticket.expires_at = None
+        ticket.save()
+    return ticket
+
+
+def ticket_status(ticket, now=None):
+    """Return the ticket's status, counting a lapsed admission as expired"""
+    if ticket.status == 'admitted' and ticket.expires_at <= (now or timezone.now()):
+        return 'expired'
+    return ticket.status
+
+
+def ahead(ticket):
+    """Number of waiting users in front of the ticket"""
+    if ticket.status != 'waiting':
+        return 0
+    return max(0, ticket.position - ticket.sale.admitted - 1)
+
+
+def admit(sale_id):
+    """Admit the next users of one sale's queue; returns how many were admitted"""
+    now = timezone.now()
+    with transaction.atomic():
+        sale = FlashSale.objects.select_for_update().select_related('product').get(id=sale_id)
+        elapsed = (now - sale.admitted_at).total_seconds() if sale.admitted_at else 1
+        budget = int(sale.admit_rate * min(elapsed, MAX_CATCH_UP))
+        if budget < 1:
+            # Too soon; let the time add up
+            return 0
+
+        # Lapsed admissions free their place for the next users
+        admitted = FlashSaleTicket.objects.filter(sale=sale, status='admitted')
+        admitted.filter(expires_at__lte=now).update(status='expired', updated_at=now)
+        units = inventory.on_hand([sale.product])[sale.product_id]
+        if units <= 0:
+            # Nobody else can buy: stop the rest of the queue polling
+            FlashSaleTicket.objects.filter(sale=sale, status='waiting').update(status='sold_out', updated_at=now)
+        count = min(budget, max(0, units - admitted.count()))
+
+        # The next tickets still waiting; places no longer waiting are skipped
+        positions = list(
+            FlashSaleTicket.objects.filter(sale=sale, status='waiting', position__gt=sale.admitted)
+            .order_by('position').values_list('position', flat=True)[:count]
+        ) if count else []
+        admitted_count = 0
+        if positions:
+            admitted_count = FlashSaleTicket.objects.filter(
+                sale=sale, status='waiting', position__in=positions
+            ).update(status='admitted', expires_at=now + timedelta(seconds=sale.admission_ttl), updated_at=now)
+        FlashSale.objects.filter(id=sale.id).update(
+            admitted=max(positions, default=sale.admitted), admitted_at=now, updated_at=now
+        )
+    return admitted_count
+
+
+def admit_all():
+    """Run one admission round for every active sale; returns how many users were admitted"""
+    return sum(admit(sale_id) for sale_id in FlashSale.objects.filter(is_active=True).values_list('id', flat=True))
+
+
+def check_admission(user, product_ids, tokens):
+    """Return the admitted tickets covering the flash-sale products among ``product_ids`` (ids or a subquery).
+
+    Raises ``NotAdmitted`` for the first flash-sale product the tokens do not
+    admit the user to. Costs one query for carts without flash-sale products.
+    """
+    sales = list(FlashSale.objects.filter(product_id__in=product_ids, is_active=True).select_related('product'))
+    if not sales:
+        return []
+    tickets = {
+        ticket.sale_id: ticket
+        for ticket in FlashSaleTicket.objects.filter(
+            sale__in=sales, user=user, token__in=list(tokens), status='admitted', expires_at__gt=timezone.now()
+        )
+    }
+    for sale in sales:
+        if sale.id not in tickets:
+            raise NotAdmitted(sale.product)
+    return list(tickets.values())
+
+
+def spend(tickets):
+    """Mark the tickets used by a checkout; must run in the checkout's transaction.
+
+    Raises ``NotAdmitted`` if another checkout spent one of them first.
+    """
+    if not tickets:
+        return
+    used = FlashSaleTicket.objects.filter(
+        id__in=[ticket.id for ticket in tickets], status='admitted'
+    ).update(status='used', updated_at=timezone.now())
+    if used != len(tickets):
+        raise NotAdmitted(tickets[0].sale.product)
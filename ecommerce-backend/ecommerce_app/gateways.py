@@ -0,0 +1,272 @@
+"""
+Payment gateway clients.
+
+Views and workers talk to the gateway returned by ``get_gateway()`` instead of
+calling the ``stripe`` SDK directly. ``PAYMENT_GATEWAY`` selects it:
+
+* ``stripe`` - the real API
+* ``fake`` - an in-process stand-in (see ``fake_gateway``), no network at all
+* ``fake_http`` - the real SDK talking to ``run_fake_gateway`` at
+  ``FAKE_GATEWAY_URL``, for load testing the HTTP client path offline
+
+Every call is bounded: at most ``PAYMENT_GATEWAY_MAX_CONNECTIONS`` run at once
+per process over a pool of kept-alive connections, each with connect and read
+timeouts, and a circuit breaker fails calls fast for
+``PAYMENT_GATEWAY_BREAKER_RESET`` seconds after
+``PAYMENT_GATEWAY_BREAKER_THRESHOLD`` consecutive outages.
+"""
+import json
+import logging
+import threading
+import time
+
+import requests
+import stripe
+from django.conf import settings
+
+from . import fake_gateway
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayError(Exception):
+    """A gateway call failed; ``retryable`` tells whether trying again may help"""
+
+    def __init__(self, message, retryable=False):
+        self.retryable = retryable
+        super().__init__(message)
+
+
+class CircuitOpen(GatewayError):
+    """The gateway is failing; calls are refused until the breaker resets"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__('Payment gateway unavailable', retryable=True)
+
+
+class InvalidWebhook(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def retry_after(self):
+        """Seconds until calls are let through again; 0 when closed"""
+        if self._opened_at is None:
+            return 0
+        return max(0, self._opened_at + self.reset_after - time.monotonic())
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._trial or self.retry_after():
+                raise CircuitOpen(self.retry_after() or self.reset_after)
+            # Half open: let a single call find out whether the gateway is back
+            self._trial = True
+
+    def record(self, success):
+        with self._lock:
+            self._trial = False
+            if success:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logger.error(f'Payment gateway circuit opened after {self._failures} failures')
+                self._opened_at = time.monotonic()
+
+
+def _intent(intent):
+    """The PaymentIntent fields callers use, from a Stripe object or a fake's dict"""
+    fields = ['id', 'client_secret', 'status', 'amount', 'currency', 'created']
+    return {field: intent[field] if field in intent else None for field in fields}
+
+
+class BaseGateway:
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            settings.PAYMENT_GATEWAY_BREAKER_THRESHOLD, settings.PAYMENT_GATEWAY_BREAKER_RESET
+        )
+        self._slots = threading.BoundedSemaphore(settings.PAYMENT_GATEWAY_MAX_CONNECTIONS)
+
+    def _invoke(self, method, *args, **kwargs):
+        raise NotImplementedError
+
+    def _call(self, method, *args, **kwargs):
+        if not self._slots.acquire(timeout=settings.PAYMENT_GATEWAY_CONNECT_TIMEOUT):
+            raise GatewayError('Too many concurrent payment gateway calls', retryable=True)
+        try:
+            self.breaker.before_call()
+            try:
+                result = self._invoke(method, *args, **kwargs)
+            except GatewayError as e:
+                # Declines and bad requests mean the gateway is up
+                self.breaker.record(success=not e.retryable)
+                raise
+            except Exception:
+                # Anything unexpected counts as an outage, and ends a half-open trial
+                self.breaker.record(success=False)
+                raise
+            self.breaker.record(success=True)
+            return result
+        finally:
+            self._slots.release()
+
+
+class StripeGateway(BaseGateway):
+    name = 'stripe'
+
+    def __init__(self):
+        super().__init__()
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        # Failed calls are retried by the callers (e.g. the payment outbox)
+        stripe.max_network_retries = 0
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=settings.PAYMENT_GATEWAY_MAX_CONNECTIONS, max_retries=0
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        stripe.default_http_client = stripe.RequestsClient(
+            timeout=(settings.PAYMENT_GATEWAY_CONNECT_TIMEOUT, settings.PAYMENT_GATEWAY_TIMEOUT),
+            session=session
+        )
+
+    def _invoke(self, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError) as e:
+            raise GatewayError(str(e), retryable=True) from e
+        except stripe.error.StripeError as e:
+            raise GatewayError(str(e)) from e
+
+    def create_payment_intent(self, amount, currency, metadata, idempotency_key=None):
+        intent = self._call(
+            stripe.PaymentIntent.create,
+            amount=amount,
+            currency=currency,
+            metadata=metadata,
+            idempotency_key=idempotency_key
+        )
+        return _intent(intent)
+
+    def retrieve_payment_intent(self, intent_id):
+        return _intent(self._call(stripe.PaymentIntent.retrieve, intent_id))
+
+    def create_refund(self, payment_intent_id, amount, idempotency_key=None):
+        refund = self._call(
+            stripe.Refund.create,
+            payment_intent=payment_intent_id,
+            amount=amount,
+            idempotency_key=idempotency_key
+        )
+        return {'id': refund.id, 'status': refund.status, 'amount': refund.amount}
+
+    def list_payment_intents(self, created_gte, created_lt, page_size=100):
+        """Every PaymentIntent created in [created_gte, created_lt) (unix times), newest first"""
+        starting_after = None
+        while True:
+            params = {'created': {'gte': created_gte, 'lt': created_lt}, 'limit': page_size}
+            if starting_after:
+                params['starting_after'] = starting_after
+            page = self._call(stripe.PaymentIntent.list, **params)
+            for intent in page.data:
+                yield _intent(intent)
+            if not page.has_more or not page.data:
+                return
+            starting_after = page.data[-1].id
+
+    def parse_webhook(self, payload, signature):
+        """Verify a webhook request and return its event"""
+        try:
+            stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+        except ValueError:
+            raise InvalidWebhook('Invalid payload')
+        except stripe.error.SignatureVerificationError:
+            raise InvalidWebhook('Invalid signature')
+        return json.loads(payload)
+
+
+class LocalHTTPGateway(StripeGateway):
+    """The Stripe SDK pointed at the fake gateway server"""
+    name = 'fake_http'
+
+    def __init__(self):
+        super().__init__()
+        stripe.api_base = settings.FAKE_GATEWAY_URL
+
+
+class FakeGateway(BaseGateway):
+    """In-process stand-in for Stripe, backed by ``fake_gateway.processor``"""
+    name = 'fake'
+
+    def _invoke(self, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except fake_gateway.SimulatedFailure as e:
+            raise GatewayError(str(e), retryable=True) from e
+        except (fake_gateway.NoSuchIntent, fake_gateway.InvalidRequest) as e:
+            raise GatewayError(str(e)) from e
+
+    def create_payment_intent(self, amount, currency, metadata, idempotency_key=None):
+        intent = self._call(
+            fake_gateway.processor.create_payment_intent, amount, currency, metadata, idempotency_key
+        )
+        return _intent(intent)
+
+    def retrieve_payment_intent(self, intent_id):
+        return _intent(self._call(fake_gateway.processor.retrieve_payment_intent, intent_id))
+
+    def create_refund(self, payment_intent_id, amount, idempotency_key=None):
+        refund = self._call(
+            fake_gateway.processor.create_refund, payment_intent_id, amount, idempotency_key
+        )
+        return {'id': refund['id'], 'status': refund['status'], 'amount': refund['amount']}
+
+    def list_payment_intents(self, created_gte, created_lt, page_size=100):
+        starting_after = None
+        while True:
+            page = self._call(
+                fake_gateway.processor.list_payment_intents, created_gte, created_lt, page_size, starting_after
+            )
+            for intent in page['data']:
+                yield _intent(intent)
+            if not page['has_more'] or not page['data']:
+                return
+            starting_after = page['data'][-1]['id']
+
+    def parse_webhook(self, payload, signature):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            raise InvalidWebhook('Invalid payload')
+        if not fake_gateway.verify(payload, signature, settings.STRIPE_WEBHOOK_SECRET):
+            raise InvalidWebhook('Invalid signature')
+        return event
+
+
+GATEWAYS = {
+    'stripe': StripeGateway,
+    'fake': FakeGateway,
+    'fake_http': LocalHTTPGateway,
+}
+
+_gateway = None
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None or _gateway.name != settings.PAYMENT_GATEWAY:
+        _gateway = GATEWAYS[settings.PAYMENT_GATEWAY]()
+    return _gateway
@@ -0,0 +1,126 @@
+"""
+Password hashers for accounts imported from other platforms.
+
+``import_users`` stores a legacy password hash as it is, wrapped in one of
+these formats, so customers keep their passwords without anyone knowing
+them. They are listed after the preferred hasher in ``PASSWORD_HASHERS``:
+Django verifies against the legacy hash on the user's next login and, the
+hasher not being the preferred one, saves a PBKDF2 hash in its place. None
+of them is ever used to hash a new password.
+"""
+import hashlib
+
+from django.contrib.auth.hashers import BasePasswordHasher, mask_hash
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import gettext_noop as _
+
+
+class _SaltedDigestPasswordHasher(BasePasswordHasher):
+    """``<algorithm>$<salt>$<hexdigest of salt + password>``"""
+
+    digest = None
+
+    def encode(self, password, salt):
+        self._check_encode_args(password, salt)
+        hash = self.digest((salt + password).encode()).hexdigest()
+        return f'{self.algorithm}${salt}${hash}'
+
+    def decode(self, encoded):
+        algorithm, salt, hash = encoded.split('$', 2)
+        assert algorithm == self.algorithm
+        return {'algorithm': algorithm, 'hash': hash, 'salt': salt}
+
+    def verify(self, password, encoded):
+        decoded = self.decode(encoded)
+        return constant_time_compare(decoded['hash'], self.encode(password, decoded['salt']).split('$', 2)[2])
+
+    def safe_summary(self, encoded):
+        decoded = self.decode(encoded)
+        return {
+            _('algorithm'): decoded['algorithm'],
+            _('salt'): mask_hash(decoded['salt'], show=2),
+            _('hash'): mask_hash(decoded['hash']),
+        }
+
+    def harden_runtime(self, password, encoded):
+        pass
+
+
+class LegacySaltedMD5PasswordHasher(_SaltedDigestPasswordHasher):
+    """md5(salt + password), as stored by Magento 1 and many PHP shops"""
+
+    algorithm = 'legacy_md5'
+    digest = hashlib.md5
+
+
+class LegacySaltedSHA256PasswordHasher(_SaltedDigestPasswordHasher):
+    """sha256(salt + password), as stored by Magento 2 before Argon2"""
+
+    algorithm = 'legacy_sha256'
+    digest = hashlib.sha256
+
+
+ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def _encode64(data, count):
+    # phpass's own base64 variant
+    output = []
+    i = 0
+    while i < count:
+        value = data[i]
+        i += 1
+        output.append(ITOA64[value & 0x3f])
+        if i < count:
+            value |= data[i] << 8
+        output.append(ITOA64[(value >> 6) & 0x3f])
+        if i >= count:
+            break
+        i += 1
+        if i < count:
+            value |= data[i] << 16
+        output.append(ITOA64[(value >> 12) & 0x3f])
+        if i >= count:
+            break
+        i += 1
+        output.append(ITOA64[(value >> 18) & 0x3f])
+    return ''.join(output)
+
+
+class PHPassPasswordHasher(BasePasswordHasher):
+    """phpass portable hashes (``$P$``/``$H$``), as stored by WordPress and WooCommerce"""
+
+    algorithm = 'phpass'
+
+    def _hash(self, password, setting):
+        rounds = 1 << ITOA64.index(setting[3])
+        salt = setting[4:12].encode()
+        password = password.encode()
+        hash = hashlib.md5(salt + password).digest()
+        for _round in range(rounds):
+            hash = hashlib.md5(hash + password).digest()
+        return setting[:12] + _encode64(hash, 16)
+
+    def encode(self, password, salt):
+        raise NotImplementedError('phpass hashes are only verified, never created')
+
+    def decode(self, encoded):
+        algorithm, hash = encoded.split('$', 1)
+        assert algorithm == self.algorithm
+        return {'algorithm': algorithm, 'hash': hash, 'salt': hash[4:12], 'rounds': 1 << ITOA64.index(hash[3])}
+
+    def verify(self, password, encoded):
+        hash = self.decode(encoded)['hash']
+        return constant_time_compare(hash, self._hash(password, hash))
+
+    def safe_summary(self, encoded):
+        decoded = self.decode(encoded)
+        return {
+            _('algorithm'): decoded['algorithm'],
+            _('iterations'): decoded['rounds'],
+            _('salt'): mask_hash(decoded['salt'], show=2),
+            _('hash'): mask_hash(decoded['hash'][12:]),
+        }
+
+    def harden_runtime(self, password, encoded):
+        pass
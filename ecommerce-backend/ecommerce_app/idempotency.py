@@ -0,0 +1,148 @@
+"""
+``Idempotency-Key`` support for retried API calls.
+
+The first request with a given key runs normally and its response is stored
+against the user and key. Repeats return the stored response (from the cache
+when possible, otherwise from ``IdempotencyKey``) without running the view
+again; a repeat that arrives while the first is still running waits for it.
+Server errors and the transient 409 and 429 answers (stock conflicts, a
+flash sale not yet admitting the user) are not stored, so a retry with the
+same key runs the view again.
+"""
+import hashlib
+import json
+import time
+import zlib
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+POLL_INTERVAL = 0.1
+# Answers that may change if the same request is simply tried again
+TRANSIENT = {status.HTTP_409_CONFLICT, status.HTTP_429_TOO_MANY_REQUESTS}
+
+
+def _digest(value):
+    return hashlib.blake2b(value.encode(), digest_size=16).digest()
+
+
+def _cache_key(user_id, key_hash):
+    return f'idempotency:{user_id}:{key_hash.hex()}'
+
+
+def _replay(status_code, body):
+    response = Response(json.loads(zlib.decompress(body)), status=status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(user, key_hash, request_hash):
+    """Insert the in-flight record; returns (record, created)"""
+    expires_at = timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    user=user, key_hash=key_hash, request_hash=request_hash, expires_at=expires_at
+                ), True
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(user=user, key_hash=key_hash).first()
+            if record is None:
+                continue
+            if record.expires_at > timezone.now():
+                return record, False
+            # An expired key may be used again
+            record.delete()
+    raise IntegrityError('Could not claim idempotency key')
+
+
+def _wait(record):
+    """Wait for the request holding ``record`` to finish; None on timeout"""
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while record is not None and record.status_code is None:
+        if time.monotonic() > deadline:
+            return None
+        time.sleep(POLL_INTERVAL)
+        record = IdempotencyKey.objects.filter(id=record.id).first()
+    return record
+
+
+def idempotent(view):
+    """Make a DRF view method safe to retry with an ``Idempotency-Key`` header"""
+
+    @wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response(
+                {'error': f'{HEADER} must be at most 255 characters'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        user = request.user
+        key_hash = _digest(f'{request.path}\n{key}')
+        request_hash = _digest(json.dumps(request.data, sort_keys=True, cls=JSONEncoder))
+        cache_key = _cache_key(user.id, key_hash)
+
+        cached = cache.get(cache_key)
+        if cached is None:
+            record, created = _claim(user, key_hash, request_hash)
+        else:
+            record, created = None, False
+
+        if created:
+            try:
+                response = view(self, request, *args, **kwargs)
+            except Exception:
+                record.delete()
+                raise
+            if response.status_code >= 500 or response.status_code in TRANSIENT:
+                # Not final; let the client retry for real
+                record.delete()
+                return response
+
+            body = zlib.compress(json.dumps(response.data, cls=JSONEncoder).encode())
+            record.status_code = response.status_code
+            record.response = body
+            record.save(update_fields=['status_code', 'response'])
+            cache.set(
+                cache_key,
+                (bytes(request_hash), response.status_code, body),
+                timeout=settings.IDEMPOTENCY_KEY_TTL
+            )
+            return response
+
+        if cached is None:
+            record = _wait(record)
+            if record is None:
+                return Response(
+                    {'error': 'A request with this idempotency key is still in progress'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            cached = (bytes(record.request_hash), record.status_code, bytes(record.response))
+
+        stored_hash, status_code, body = cached
+        if stored_hash != request_hash:
+            return Response(
+                {'error': f'{HEADER} was already used for a different request'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY
+            )
+        return _replay(status_code, body)
+
+    return wrapper
+
+
+def purge_expired(now=None):
+    return IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()[0]
@@ -0,0 +1,301 @@
+"""
+Stock ledger and counter shards.
+
+Every change to a product's stock is appended to ``StockMovement``
+(receipts, sales, returns and adjustments, plus checkout holds as
+reservations and releases), so its stock movements always add up to the
+units on hand and any figure can be traced back to the orders behind it.
+Units held for a checkout are taken off the stock like sold ones (see
+``reservations``), so on hand means on sale.
+
+Most products keep their stock in ``Product.stock``. A hot product can be
+spread over ``shard_count`` ``StockShard`` rows instead (``compact`` with a
+shard count): a sale then takes its units from one random shard with a
+conditional UPDATE and never locks the product row, so concurrent checkouts
+of the product do not queue behind each other. ``compact_stock`` periodically
+folds the shards back into ``Product.stock``, which listings show, and
+spreads the units evenly again.
+
+The UPDATEs that change ``Product.stock`` also set ``low_stock_since`` on
+products that fall to their ``min_stock_level`` and clear it on those back
+above, which is what the low-stock digests are built from. The time comes
+from the database clock, so flags set from different servers compare
+consistently. Hot products cross the threshold when they are compacted.
+"""
+import random
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Now
+from django.db.models.lookups import LessThanOrEqual
+from django.utils import timezone
+
+from .models import Product, StockMovement, StockShard
+
+class InsufficientStock(Exception):
+    """Raised when a product cannot cover the requested quantity"""
+
+    def __init__(self, product):
+        self.product = product
+        super().__init__(f'Insufficient stock for {product.name}')
+
+
+def quantity_case(quantities, field='id'):
+    """CASE expression mapping each product id to its quantity"""
+    return Case(
+        *[When(**{field: product_id}, then=Value(quantity)) for product_id, quantity in sorted(quantities.items())],
+        output_field=IntegerField()
+    )
+
+
+def record(movements):
+    """Append ``(product_id, kind, quantity, reference)`` tuples to the ledger"""
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=product_id, kind=kind, quantity=quantity, reference=reference or '')
+        for product_id, kind, quantity, reference in movements
+    ])
+
+
+def low_stock_since(stock):
+    """``low_stock_since`` for a product whose stock becomes ``stock``, to set in the same UPDATE"""
+    return Case(
+        When(LessThanOrEqual(stock, F('min_stock_level')), then=Coalesce(F('low_stock_since'), Now())),
+        default=None,
+        output_field=DateTimeField()
+    )
+
+
+def mark_low_stock(product_ids):
+    """Flag or unflag the given products after their ``min_stock_level`` changed.
+
+    Only rows whose flag is out of date are written. Returns how many changed.
+    """
+    low = Q(stock__lte=F('min_stock_level'))
+    return Product.objects.filter(id__in=list(product_ids)).filter(
+        (low & Q(low_stock_since__isnull=True)) | (~low & Q(low_stock_since__isnull=False))
+    ).update(low_stock_since=Case(When(low, then=Now()), default=None, output_field=DateTimeField()))
+
+
+def on_hand(products):
+    """Return {product_id: units on hand} for the given products, summing the shards of hot ones"""
+    units = {product.id: 0 if product.shard_count else product.stock for product in products}
+    sharded = [product.id for product in products if product.shard_count]
+    if sharded:
+        units.update(
+            StockShard.objects.filter(product_id__in=sharded)
+            .values_list('product_id')
+            .annotate(total=Sum('quantity'))
+        )
+    return units
+
+
+def lock(product_ids):
+    """Return {product_id: Product}, locking the unsharded ones in id order.
+
+    Hot products whose stock is sharded are not locked; ``take`` and
+    ``put_back`` work on their shards with conditional UPDATEs instead.
+    """
+    product_ids = sorted(product_ids)
+    products = {
+        product.id: product
+        for product in Product.objects.select_for_update().filter(id__in=product_ids, shard_count=0).order_by('id')
+    }
+    products.update(Product.objects.in_bulk([
+        product_id for product_id in product_ids if product_id not in products
+    ]))
+    return products
+
+
+def _take_from_shards(product, quantity):
+    """Take units of a sharded product; returns False if it cannot cover them"""
+    shards = StockShard.objects.filter(product_id=product.id)
+    # PostgreSQL keeps a shard locked when its UPDATE waited for another
+    # checkout and then no longer matched; roll such locks back before taking
+    # the product lock below, or two checkouts can wait on each other
+    savepoint = transaction.savepoint()
+    # A single conditional UPDATE of a random shard is the common case
+    first = random.randrange(product.shard_count)
+    if shards.filter(shard=first, quantity__gte=quantity).update(quantity=F('quantity') - quantity):
+        transaction.savepoint_commit(savepoint)
+        return True
+    for shard in list(shards.filter(quantity__gte=quantity).values_list('shard', flat=True)):
+        if shards.filter(shard=shard, quantity__gte=quantity).update(quantity=F('quantity') - quantity):
+            transaction.savepoint_commit(savepoint)
+            return True
+    transaction.savepoint_rollback(savepoint)
+
+    # No shard can cover the line alone: lock the product and all its shards
+    product = Product.objects.select_for_update().get(id=product.id)
+    if not product.shard_count:
+        # Compacted back into Product.stock in the meantime
+        return bool(Product.objects.filter(id=product.id, stock__gte=quantity).update(
+            stock=F('stock') - quantity, low_stock_since=low_stock_since(F('stock') - quantity)
+        ))
+    locked = list(shards.select_for_update().order_by('shard'))
+    if sum(shard.quantity for shard in locked) < quantity:
+        return False
+    remaining = quantity
+    for shard in locked:
+        taken = min(shard.quantity, remaining)
+        shard.quantity -= taken
+        remaining -= taken
+    StockShard.objects.bulk_update(locked, ['quantity'])
+    return True
+
+
+def take(quantities, products):
+    """Remove sold or held units; ``quantities`` is {product_id: units}, ``products`` {product_id: Product}.
+
+    Must run inside ``transaction.atomic()`` with the unsharded products
+    locked by the caller (see ``lock``); one conditional UPDATE covers all of
+    them. Raises ``InsufficientStock``. The caller records the movements once
+    it has a reference.
+    """
+    plain = {product_id: quantity for product_id, quantity in quantities.items() if not products[product_id].shard_count}
+    if plain:
+        line_quantity = quantity_case(plain)
+        updated = Product.objects.filter(
+            id__in=list(plain), shard_count=0, stock__gte=line_quantity
+        ).update(stock=F('stock') - line_quantity, low_stock_since=low_stock_since(F('stock') - line_quantity))
+        if updated != len(plain):
+            short = next(
+                (products[product_id] for product_id in sorted(plain) if products[product_id].stock < plain[product_id]),
+                products[min(plain)]
+            )
+            raise InsufficientStock(short)
+    for product_id in sorted(quantities):
+        product = products[product_id]
+        if product.shard_count and not _take_from_shards(product, quantities[product_id]):
+            raise InsufficientStock(product)
+
+
+def _add_units(totals):
+    """Add ``{product_id: units}`` to the stock, locking the products; returns the products updated"""
+    with transaction.atomic():
+        # Locked so a product cannot be sharded or compacted under us; sales of
+        # sharded products never lock the product row
+        shard_counts = dict(
+            Product.objects.select_for_update().filter(id__in=list(totals)).order_by('id')
+            .values_list('id', 'shard_count')
+        )
+        plain = {product_id: totals[product_id] for product_id, count in shard_counts.items() if not count}
+        sharded = {product_id: count for product_id, count in shard_counts.items() if count}
+        updated = 0
+        if plain:
+            returned = quantity_case(plain)
+            updated += Product.objects.filter(id__in=list(plain)).update(
+                stock=F('stock') + returned, low_stock_since=low_stock_since(F('stock') + returned)
+            )
+        if sharded:
+            matches = Q()
+            for product_id, count in sorted(sharded.items()):
+                matches |= Q(product_id=product_id, shard=random.randrange(count))
+            updated += StockShard.objects.filter(matches).update(
+                quantity=F('quantity') + quantity_case({product_id: totals[product_id] for product_id in sharded}, 'product_id')
+            )
+    return shard_counts, updated
+
+
+def add(movements):
+    """Put units back on sale and record them.
+
+    ``movements`` are ``(product_id, kind, quantity, reference)`` tuples with
+    positive quantities. Costs one locking SELECT of the products, one grouped
+    UPDATE for unsharded products and one for the shards of hot ones.
+    Returns the number of products updated.
+    """
+    movements = list(movements)
+    totals = defaultdict(int)
+    for product_id, _, quantity, _ in movements:
+        totals[product_id] += quantity
+    if not totals:
+        return 0
+
+    with transaction.atomic():
+        shard_counts, updated = _add_units(totals)
+        record(movement for movement in movements if movement[0] in shard_counts)
+    return updated
+
+
+def put_back(totals):
+    """Return ``{product_id: units}`` taken by ``take`` without recording them, e.g. released holds.
+
+    Hot products get the units on a random shard without locking the product
+    row; the rest, and hot products sharded or compacted since their shard
+    count was read, go through ``add``'s locking path.
+    """
+    rest = {}
+    shard_counts = Product.objects.filter(id__in=list(totals)).values_list('id', 'shard_count')
+    for product_id, count in sorted(shard_counts):
+        if count and StockShard.objects.filter(product_id=product_id, shard=random.randrange(count)).update(
+            quantity=F('quantity') + totals[product_id]
+        ):
+            continue
+        rest[product_id] = totals[product_id]
+    if rest:
+        _add_units(rest)
+
+
+def adjust(product_id, kind, quantity, reference=''):
+    """Apply a receipt or a manual adjustment (negative quantities remove units) and record it"""
+    if quantity >= 0:
+        add([(product_id, kind, quantity, reference)])
+        return
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(id=product_id)
+        take({product_id: -quantity}, {product_id: product})
+        record([(product_id, kind, quantity, reference)])
+
+
+def compact(product_id, shard_count=None):
+    """Fold a product's shards into ``Product.stock`` and spread the units evenly again.
+
+    ``shard_count`` changes the number of shards; 0 keeps the stock in
+    ``Product.stock`` only. Returns the units on hand.
+    """
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(id=product_id)
+        shards = {
+            shard.shard: shard
+            for shard in StockShard.objects.select_for_update().filter(product=product).order_by('shard')
+        }
+        total = sum(shard.quantity for shard in shards.values()) if product.shard_count else product.stock
+        count = product.shard_count if shard_count is None else shard_count
+
+        StockShard.objects.filter(product=product, shard__gte=count).delete()
+        share, extra = divmod(total, count) if count else (0, 0)
+        rows = [
+            shards.get(shard) or StockShard(product=product, shard=shard)
+            for shard in range(count)
+        ]
+        for shard, row in enumerate(rows):
+            row.quantity = share + (1 if shard < extra else 0)
+        StockShard.objects.bulk_update([row for row in rows if row.pk], ['quantity'])
+        StockShard.objects.bulk_create([row for row in rows if not row.pk])
+        Product.objects.filter(id=product.id).update(
+            stock=total, shard_count=count, low_stock_since=low_stock_since(Value(total)), updated_at=timezone.now()
+        )
+    return total
+
+
+def compact_all():
+    """Compact every sharded product, one transaction each; returns how many"""
+    product_ids = list(Product.objects.filter(shard_count__gt=0).values_list('id', flat=True))
+    for product_id in product_ids:
+        compact(product_id)
+    return len(product_ids)
+
+
+def audit(products):
+    """Return ``(product_id, ledger total, on hand)`` for the products whose ledger does not add up"""
+    ledger = dict(
+        StockMovement.objects.filter(product__in=products)
+        .values_list('product_id')
+        .annotate(total=Sum('quantity'))
+    )
+    return [
+        (product_id, ledger.get(product_id, 0), units)
+        for product_id, units in sorted(on_hand(products).items())
+        if ledger.get(product_id, 0) != units
+    ]
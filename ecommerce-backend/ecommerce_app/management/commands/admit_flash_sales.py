@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from ecommerce_app.flash_sales import admit_all
+
+
+class Command(BaseCommand):
+    help = 'Admit the next users from the waiting rooms of active flash sales'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep admitting every INTERVAL seconds instead of once (1 is a good value during a sale)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            admitted = admit_all()
+            if admitted or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(f'Admitted {admitted} users'))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ecommerce_app.archive import archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Move delivered orders older than N months to the order archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=6)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=30 * options['months'])
+        archived = archive_orders(before, batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f'Archived {archived} orders created before {before:%Y-%m-%d}')
+        )
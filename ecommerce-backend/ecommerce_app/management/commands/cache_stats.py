@@ -0,0 +1,33 @@
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from ecommerce_app.cache_backends import LayeredCache
+
+
+def _rate(hits, misses):
+    return f'{hits / (hits + misses):.1%}' if hits + misses else 'n/a'
+
+
+class Command(BaseCommand):
+    help = 'Report the hit rates of the in-process (L1) and shared (L2) tiers of the default cache across all workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after reporting them')
+
+    def handle(self, *args, **options):
+        cache = caches['default']
+        if not isinstance(cache, LayeredCache):
+            raise CommandError('The default cache is not a LayeredCache')
+
+        stats = cache.stats()
+        self.stdout.write(
+            f"L1: {stats['l1_hits']} hits, {stats['l1_misses']} misses, "
+            f"hit rate {_rate(stats['l1_hits'], stats['l1_misses'])}; "
+            f"{stats['l1_evictions']} evicted, {stats['l1_invalidations']} invalidated"
+        )
+        self.stdout.write(
+            f"L2: {stats['l2_hits']} hits, {stats['l2_misses']} misses, "
+            f"hit rate {_rate(stats['l2_hits'], stats['l2_misses'])}"
+        )
+        if options['reset']:
+            cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
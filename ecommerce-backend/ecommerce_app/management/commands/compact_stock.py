@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+from ecommerce_app import inventory
+from ecommerce_app.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Fold the stock shards of hot products back into Product.stock'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep compacting every INTERVAL seconds instead of once'
+        )
+        parser.add_argument(
+            '--audit', action='store_true',
+            help='Also check that the stock ledger adds up to the stock on hand'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            compacted = inventory.compact_all()
+            self.stdout.write(f'Compacted {compacted} sharded products')
+            if options['audit']:
+                self.audit()
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def audit(self):
+        mismatches = 0
+        products = Product.objects.only('id', 'stock', 'shard_count').order_by('id')
+        last_id = 0
+        while True:
+            batch = list(products.filter(id__gt=last_id)[:1000])
+            if not batch:
+                break
+            for product_id, ledger, units in inventory.audit(batch):
+                mismatches += 1
+                self.stdout.write(f'Product {product_id}: ledger says {ledger}, {units} on hand')
+            last_id = batch[-1].id
+        if mismatches:
+            self.stdout.write(self.style.WARNING(f'{mismatches} products do not match their ledger'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Stock ledger matches the stock on hand'))
@@ -0,0 +1,130 @@
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from ecommerce_app.authentication import tokens_for
+from ecommerce_app.flash_sales import HEADER
+from ecommerce_app.models import Cart, CartItem, Product, User
+
+SHIPPING = {
+    'shipping_address': '1 Load Street',
+    'shipping_city': 'Testville',
+    'shipping_postal_code': '00000',
+    'shipping_country': 'Testland',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate a flash sale against a running server: many users add a product to their cart, '
+        'queue in its waiting room and check out once admitted'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_id', type=int)
+        parser.add_argument('--base-url', default='http://localhost:8000')
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--quantity', type=int, default=1, help='Units each user buys')
+        parser.add_argument('--poll-interval', type=float, default=0.5)
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds a user waits for admission')
+        parser.add_argument(
+            '--skip-queue', action='store_true',
+            help='Check out straight away without the waiting room, for comparison'
+        )
+
+    def handle(self, *args, **options):
+        if not Product.objects.filter(id=options['product_id']).exists():
+            raise CommandError(f'Product {options["product_id"]} does not exist')
+        self.options = options
+        self.outcomes = Counter()
+        self.checkout_times = []
+        self.lock = threading.Lock()
+
+        users = self.users(options['users'])
+        CartItem.objects.filter(cart__user__in=users).delete()
+        Cart.objects.bulk_create([Cart(user=user) for user in users], ignore_conflicts=True)
+        tokens = [str(tokens_for(user).access_token) for user in users]
+
+        self.stdout.write(f'Starting {len(users)} buyers of product {options["product_id"]}')
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(users)) as executor:
+            list(executor.map(self.buyer, tokens))
+        elapsed = time.monotonic() - started
+
+        for outcome, count in sorted(self.outcomes.items()):
+            self.stdout.write(f'{outcome:>24}: {count}')
+        if self.checkout_times:
+            times = sorted(self.checkout_times)
+            self.stdout.write(
+                f'create_order: median {statistics.median(times) * 1000:.0f} ms, '
+                f'p95 {times[int(len(times) * 0.95) - 1 if len(times) > 1 else 0] * 1000:.0f} ms, '
+                f'max {times[-1] * 1000:.0f} ms'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Finished in {elapsed:.1f}s'))
+
+    def users(self, count):
+        emails = [f'flash-load-{number}@example.com' for number in range(count)]
+        existing = set(User.objects.filter(email__in=emails).values_list('email', flat=True))
+        for email in emails:
+            if email not in existing:
+                User.objects.create_user(email=email, password=None, first_name='Load', last_name='Test')
+        return list(User.objects.filter(email__in=emails).order_by('id'))
+
+    def record(self, outcome, checkout_time=None):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            if checkout_time is not None:
+                self.checkout_times.append(checkout_time)
+
+    def url(self, name, **kwargs):
+        return self.options['base_url'].rstrip('/') + reverse(name, kwargs=kwargs)
+
+    def buyer(self, access_token):
+        session = requests.Session()
+        session.headers['Authorization'] = f'Bearer {access_token}'
+        # A development server drops connections beyond its accept backlog; those requests were never sent
+        session.mount('http://', HTTPAdapter(max_retries=Retry(total=None, connect=10, read=0, backoff_factor=0.2)))
+        try:
+            self.buy(session)
+        except requests.RequestException as e:
+            self.record(f'error ({type(e).__name__})')
+
+    def buy(self, session):
+        product_id = self.options['product_id']
+        response = session.post(self.url('cart-add-item'), json={
+            'product_id': product_id, 'quantity': self.options['quantity']
+        })
+        if not response.ok:
+            self.record(f'add to cart {response.status_code}')
+            return
+
+        headers = {}
+        if not self.options['skip_queue']:
+            response = session.post(self.url('flash-sale-join', pk=product_id))
+            if response.status_code != 201:
+                self.record(f'join {response.status_code}')
+                return
+            ticket = response.json()
+            deadline = time.monotonic() + self.options['timeout']
+            while ticket['status'] == 'waiting' and time.monotonic() < deadline:
+                time.sleep(self.options['poll_interval'])
+                response = session.get(self.url('flash-sale-ticket', token=ticket['token']))
+                if not response.ok:
+                    self.record(f'poll {response.status_code}')
+                    return
+                ticket = response.json()
+            if ticket['status'] != 'admitted':
+                self.record(f'not admitted ({ticket["status"]})')
+                return
+            headers[HEADER] = ticket['token']
+
+        started = time.monotonic()
+        response = session.post(self.url('order-create'), json=SHIPPING, headers=headers)
+        self.record(f'checkout {response.status_code}', time.monotonic() - started)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from ecommerce_app.user_import import PASSWORD_FORMATS, import_users, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Import customer accounts from a CSV or NDJSON export, with a cart each. Columns: email, '
+        'password (the legacy hash), password_format, first_name, last_name, phone_number, '
+        'date_of_birth, address, city, state, postal_code, country'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument(
+            '--format', choices=['csv', 'ndjson'],
+            help='Defaults to ndjson for .ndjson/.jsonl files and csv otherwise'
+        )
+        parser.add_argument(
+            '--password-format', choices=sorted(PASSWORD_FORMATS), default='django',
+            help='Format of the password column for rows without a password_format of their own'
+        )
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        format = options['format'] or ('ndjson' if options['path'].endswith(('.ndjson', '.jsonl')) else 'csv')
+        try:
+            file = open(options['path'], newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(e)
+
+        with file:
+            stats = import_users(
+                read_rows(file, format),
+                password_format=options['password_format'],
+                batch_size=options['batch_size'],
+                progress=lambda stats: self.stdout.write(f'{stats.created} users imported so far'),
+            )
+
+        for line, reason in stats.errors:
+            self.stdout.write(self.style.WARNING(f'Line {line}: {reason}'))
+        if stats.rejected > len(stats.errors):
+            self.stdout.write(self.style.WARNING(f'... and {stats.rejected - len(stats.errors)} more rejected rows'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {stats.created} users; skipped {stats.duplicates} duplicates and {stats.rejected} rejected rows'
+        ))
@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from ecommerce_app import inventory
 from ecommerce_app.models import Category, Product
 
 
@@ -58,11 +59,13 @@ class Command(BaseCommand):
         ]
         
         for product_data in products_data:
+            stock = product_data.pop('stock')
             product, created = Product.objects.get_or_create(
                 name=product_data['name'],
                 defaults=product_data
             )
             if created:
+                inventory.adjust(product.id, 'receipt', stock, 'sample data')
                 self.stdout.write(
                     self.style.SUCCESS(f'Created product: {product.name}')
                 )
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+from ecommerce_app.outbox import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Perform the payment gateway calls queued by checkout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=4, help='Concurrent gateway calls')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep polling every INTERVAL seconds instead of draining the queue once'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            claimed = process_batch(options['batch_size'], options['workers'])
+            if claimed:
+                self.stdout.write(f'Processed {claimed} outbox entries')
+            elif not options['interval']:
+                break
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from ecommerce_app.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Delete stored idempotent responses whose keys have expired'
+
+    def handle(self, *args, **options):
+        deleted = purge_expired()
+        self.stdout.write(
+            self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys')
+        )
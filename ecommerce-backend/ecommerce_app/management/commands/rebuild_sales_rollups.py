@@ -0,0 +1,48 @@
+from datetime import date, datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+from ecommerce_app.models import ArchivedOrder, Order
+from ecommerce_app.rollups import rebuild
+
+
+def _parse_day(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+
+
+def _first_day():
+    firsts = [
+        model.objects.aggregate(first=Min('created_at'))['first']
+        for model in (Order, ArchivedOrder)
+    ]
+    firsts = [first for first in firsts if first]
+    return timezone.localdate(min(firsts)) if firsts else None
+
+
+class Command(BaseCommand):
+    help = 'Recompute the hourly and daily sales rollups from the orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day to rebuild, YYYY-MM-DD (default: first order)')
+        parser.add_argument('--end', help='Last day to rebuild, YYYY-MM-DD (default: today)')
+
+    def handle(self, *args, **options):
+        start = _parse_day(options['start']) if options['start'] else _first_day()
+        end = _parse_day(options['end']) if options['end'] else timezone.localdate()
+        if start is None:
+            self.stdout.write('No orders to aggregate')
+            return
+
+        # One day per transaction so a long backfill never holds locks for long
+        day = start
+        while day <= end:
+            midnight = timezone.make_aware(datetime.combine(day, time()))
+            with transaction.atomic():
+                rebuild(midnight, midnight + timedelta(days=1))
+            day += timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt sales rollups from {start} to {end}'))
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Min
+from django.utils import timezone
+from ecommerce_app.models import PaymentTransaction
+from ecommerce_app.reconciliation import reconcile
+
+
+def _parse_day(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+
+
+def _midnight(day):
+    return timezone.make_aware(datetime.combine(day, time()))
+
+
+def _shards(start, end, count):
+    """Split the days start..end into ``count`` contiguous (first, last) ranges"""
+    days = (end - start).days + 1
+    size = -(-days // count)
+    return [
+        (start + timedelta(days=offset), min(end, start + timedelta(days=offset + size - 1)))
+        for offset in range(0, days, size)
+    ]
+
+
+def run_shard(first, last, export, output_dir):
+    """Reconcile the days first..last into their own report file"""
+    path = os.path.join(output_dir, f'payment-reconciliation-{first}-{last}.csv')
+    try:
+        with open(path, 'w', newline='') as report:
+            counts = reconcile(_midnight(first), _midnight(last + timedelta(days=1)), report, export)
+    finally:
+        connections.close_all()
+    return path, counts
+
+
+class Command(BaseCommand):
+    help = 'Check payment transactions and paid flags against the payment gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day to check, YYYY-MM-DD (default: first transaction)')
+        parser.add_argument('--end', help='Last day to check, YYYY-MM-DD (default: today)')
+        parser.add_argument('--csv', dest='export', help='Settlement export to read instead of the gateway API')
+        parser.add_argument('--shards', type=int, default=1, help='Date ranges to split the period into')
+        parser.add_argument('--processes', type=int, default=1, help='Shards reconciled concurrently')
+        parser.add_argument('--output-dir', default='.', help='Where the mismatch reports are written')
+
+    def handle(self, *args, **options):
+        end = _parse_day(options['end']) if options['end'] else timezone.localdate()
+        if options['start']:
+            start = _parse_day(options['start'])
+        else:
+            first = PaymentTransaction.objects.aggregate(first=Min('created_at'))['first']
+            start = timezone.localdate(first) if first else end
+        if start > end:
+            raise CommandError('--start is after --end')
+
+        shards = _shards(start, end, max(1, options['shards']))
+        jobs = [(first, last, options['export'], options['output_dir']) for first, last in shards]
+        if options['processes'] > 1 and len(jobs) > 1:
+            # Children must not share the parent's database connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=options['processes'], mp_context=multiprocessing.get_context('fork')
+            ) as executor:
+                results = list(executor.map(run_shard, *zip(*jobs)))
+        else:
+            results = [run_shard(*job) for job in jobs]
+
+        totals = Counter()
+        for path, counts in results:
+            totals.update(counts)
+            self.stdout.write(f'{path}: {counts["matched"]} matched, {sum(counts.values()) - counts["matched"]} mismatches')
+        mismatches = sum(totals.values()) - totals['matched']
+        summary = f'Reconciled {start} to {end}: {totals["matched"]} matched, {mismatches} mismatches'
+        if mismatches:
+            details = ', '.join(f'{kind} {count}' for kind, count in sorted(totals.items()) if kind != 'matched')
+            self.stdout.write(self.style.WARNING(f'{summary} ({details})'))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+from ecommerce_app.reservations import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Return the stock of expired checkout holds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep sweeping every INTERVAL seconds instead of running once'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired(batch_size=options['batch_size'])
+            self.stdout.write(
+                self.style.SUCCESS(f'Released {released} expired holds')
+            )
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from ecommerce_app.fake_gateway import serve
+
+
+class Command(BaseCommand):
+    help = 'Serve the fake payment gateway over HTTP (use with PAYMENT_GATEWAY=fake_http)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+
+    def handle(self, *args, **options):
+        server = serve(options['host'], options['port'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Fake gateway listening on http://{options["host"]}:{options["port"]}'
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+from ecommerce_app.stock_alerts import send_digests
+
+
+class Command(BaseCommand):
+    help = 'Email buyers the products that ran low on stock since the last digest'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep sending a digest every INTERVAL seconds instead of once'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            digest = send_digests()
+            self.stdout.write(self.style.SUCCESS(
+                f'Sent {digest.categories} category digests covering {digest.products} low-stock products'
+            ))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:06
+
+from django.db import migrations, models
+
+BLOCK_SIZE = 1000
+SEQUENCE = 'ecommerce_app_order_number_block_seq'
+
+
+def number_existing_orders(apps, schema_editor):
+    Order = apps.get_model('ecommerce_app', 'Order')
+    OrderNumberCounter = apps.get_model('ecommerce_app', 'OrderNumberCounter')
+
+    last_id = 0
+    for order in Order.objects.order_by('id').only('id').iterator():
+        Order.objects.filter(id=order.id).update(order_number=f'ORD-{order.id:010d}')
+        last_id = order.id
+
+    # New blocks start above every number handed out here
+    first_block = last_id // BLOCK_SIZE + 1
+    OrderNumberCounter.objects.create(name='order', next_block=first_block)
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'CREATE SEQUENCE IF NOT EXISTS {SEQUENCE} START WITH {first_block + 1}')
+
+
+def drop_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP SEQUENCE IF EXISTS {SEQUENCE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0005_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderNumberCounter',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('next_block', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.RunPython(number_existing_orders, drop_sequence),
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(blank=True, max_length=50, unique=True),
+        ),
+    ]
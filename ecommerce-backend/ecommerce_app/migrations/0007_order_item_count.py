@@ -0,0 +1,37 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:07
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_items(apps, schema_editor):
+    Order = apps.get_model('ecommerce_app', 'Order')
+    OrderItem = apps.get_model('ecommerce_app', 'OrderItem')
+    units = (
+        OrderItem.objects.filter(order=OuterRef('pk'))
+        .values('order')
+        .annotate(total=Sum('quantity'))
+        .values('total')
+    )
+    Order.objects.update(item_count=Coalesce(Subquery(units), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0006_order_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_items, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-created_at'], name='ecommerce_a_user_id_a5d5c6_idx'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:09
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.backends.ddl_references import Statement
+import django.db.models.deletion
+
+
+def partition_archive(apps, schema_editor):
+    """Rebuild the archive as a table partitioned by month of created_at"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    ArchivedOrder = apps.get_model('ecommerce_app', 'ArchivedOrder')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    q = schema_editor.quote_name
+    table = ArchivedOrder._meta.db_table
+
+    schema_editor.execute(f'ALTER TABLE {q(table)} RENAME TO {q(table + "_template")}')
+    schema_editor.execute(
+        f'CREATE TABLE {q(table)} (LIKE {q(table + "_template")} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+        f'PARTITION BY RANGE (created_at)'
+    )
+    schema_editor.execute(f'DROP TABLE {q(table + "_template")}')
+    # The partition key has to be part of the primary key
+    schema_editor.execute(f'ALTER TABLE {q(table)} ADD PRIMARY KEY (id, created_at)')
+    schema_editor.execute(
+        f'ALTER TABLE {q(table)} ADD CONSTRAINT {q(table + "_user_id_fk")} '
+        f'FOREIGN KEY (user_id) REFERENCES {q(User._meta.db_table)} (id) DEFERRABLE INITIALLY DEFERRED'
+    )
+    for index in ArchivedOrder._meta.indexes:
+        schema_editor.add_index(ArchivedOrder, index)
+    # CreateModel deferred order_number's indexes to the end of the migration, where
+    # they would only land on this table by name; create them here with the others
+    for statement in [sql for sql in schema_editor.deferred_sql if isinstance(sql, Statement)]:
+        if statement.references_table(table):
+            schema_editor.deferred_sql.remove(statement)
+            schema_editor.execute(statement)
+    # Catches rows for months archive_orders has not created a partition for
+    schema_editor.execute(f'CREATE TABLE {q(table + "_default")} PARTITION OF {q(table)} DEFAULT')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0007_order_item_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('order_number', models.CharField(db_index=True, max_length=50)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('total_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('item_count', models.PositiveIntegerField(default=0)),
+                ('is_paid', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status__in', ['delivered', 'cancelled']), _negated=True), fields=['status'], name='order_open_status_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedorder',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_orders', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['user', '-created_at'], name='ecommerce_a_user_id_7f4327_idx'),
+        ),
+        migrations.RunPython(partition_archive, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def opening_balances(apps, schema_editor):
+    """Start every product's ledger with the stock it has now"""
+    Product = apps.get_model('ecommerce_app', 'Product')
+    StockMovement = apps.get_model('ecommerce_app', 'StockMovement')
+    products = Product.objects.filter(stock__gt=0).values_list('id', 'stock').iterator(chunk_size=5000)
+    batch = []
+    for product_id, stock in products:
+        batch.append(StockMovement(product_id=product_id, kind='adjustment', quantity=stock, reference='opening balance'))
+        if len(batch) == 5000:
+            StockMovement.objects.bulk_create(batch)
+            batch = []
+    StockMovement.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0013_refundrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='ecommerce_app.product')),
+            ],
+            options={
+                'unique_together': {('product', 'shard')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('receipt', 'Receipt'), ('sale', 'Sale'), ('return', 'Return'), ('adjustment', 'Adjustment'), ('reservation', 'Reservation'), ('release', 'Release')], max_length=20)),
+                ('quantity', models.IntegerField()),
+                ('reference', models.CharField(blank=True, max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='ecommerce_app.product')),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['product', '-created_at'], name='ecommerce_a_product_ebc9d8_idx')],
+            },
+        ),
+        migrations.RunPython(opening_balances, migrations.RunPython.noop),
+    ]
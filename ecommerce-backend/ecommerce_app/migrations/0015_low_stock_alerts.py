@@ -0,0 +1,54 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:49
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def flag_low_stock(apps, schema_editor):
+    """Flag the products already at or below their minimum"""
+    Product = apps.get_model('ecommerce_app', 'Product')
+    Product.objects.filter(stock__lte=F('min_stock_level')).update(low_stock_since=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0014_inventory_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LowStockDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cutoff', models.DateTimeField(unique=True)),
+                ('categories', models.IntegerField(default=0)),
+                ('products', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-cutoff'],
+            },
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='buyer_email',
+            field=models.EmailField(blank=True, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='low_stock_since',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='min_stock_level',
+            field=models.PositiveIntegerField(default=5),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('low_stock_since__isnull', False)), fields=['low_stock_since'], name='low_stock_idx'),
+        ),
+        migrations.RunPython(flag_low_stock, migrations.RunPython.noop),
+    ]
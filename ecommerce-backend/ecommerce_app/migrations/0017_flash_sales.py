@@ -0,0 +1,49 @@
+# Generated by Django 4.2.23 on 2026-10-19 11:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0016_product_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlashSale',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_active', models.BooleanField(default=True)),
+                ('admit_rate', models.PositiveIntegerField(default=20)),
+                ('max_waiting', models.PositiveIntegerField(default=10000)),
+                ('admission_ttl', models.PositiveIntegerField(default=300)),
+                ('joined', models.PositiveIntegerField(default=0, editable=False)),
+                ('admitted', models.PositiveIntegerField(default=0, editable=False)),
+                ('admitted_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='flash_sale', to='ecommerce_app.product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FlashSaleTicket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('position', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('admitted', 'Admitted'), ('used', 'Used'), ('expired', 'Expired'), ('sold_out', 'Sold out')], default='waiting', max_length=10)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('sale', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tickets', to='ecommerce_app.flashsale')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='flash_sale_tickets', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'admitted')), fields=['sale', 'expires_at'], name='flash_admitted_idx')],
+                'unique_together': {('sale', 'position'), ('sale', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.23 on 2026-10-19 15:12
+
+from django.db import migrations
+
+
+def release_holds(apps, schema_editor):
+    # Holds used to leave the stock alone; they now take their units off it,
+    # so ones placed before cannot be released the new way
+    StockHold = apps.get_model('ecommerce_app', 'StockHold')
+    StockHoldBucket = apps.get_model('ecommerce_app', 'StockHoldBucket')
+    StockMovement = apps.get_model('ecommerce_app', 'StockMovement')
+    StockMovement.objects.bulk_create(
+        (
+            StockMovement(product_id=hold.product_id, kind='release', quantity=hold.quantity, reference=f'hold {hold.id}')
+            for hold in StockHold.objects.iterator()
+        ),
+        batch_size=1000,
+    )
+    StockHold.objects.all().delete()
+    StockHoldBucket.objects.update(quantity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0019_user_email_lower_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(release_holds, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.db.models import F, Sum, Case, When, DecimalField
+from django.db.models.functions import Lower
+from django.utils import timezone
 
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -59,6 +61,10 @@ class User(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = 'User'
         verbose_name_plural = 'Users'
+        constraints = [
+            # Registration, login and import_users match emails whatever their case
+            models.UniqueConstraint(Lower('email'), name='user_email_lower_uniq'),
+        ]
 
     def __str__(self):
         return self.email
@@ -71,9 +77,38 @@ class User(AbstractBaseUser, PermissionsMixin):
     def username(self):
         return self.email
 
+    # Set on users authentication rebuilt from cached fields or token claims,
+    # which lack the password hash and whatever else was left out
+    partial_copy = False
+
+    def save(self, *args, **kwargs):
+        if self.partial_copy:
+            raise ValueError('Cannot save a partial copy of a user; call refresh_from_db() first')
+        super().save(*args, **kwargs)
+        self._invalidate_auth_cache(self.pk)
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is None:
+            self.partial_copy = False
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        result = super().delete(*args, **kwargs)
+        self._invalidate_auth_cache(pk)
+        return result
+
+    @staticmethod
+    def _invalidate_auth_cache(pk):
+        # After commit, so a request cannot cache the row as it was before this change
+        from .authentication import invalidate_user
+        transaction.on_commit(lambda: invalidate_user(pk))
+
 
 class Category(models.Model):
     name = models.CharField(max_length=255)
+    # Receives the category's low-stock digests, in addition to LOW_STOCK_ALERT_EMAILS
+    buyer_email = models.EmailField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -90,6 +125,17 @@ class Product(models.Model):
     category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE, db_index=True)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
     stock = models.PositiveIntegerField(default=0, db_index=True)
+    # Hot products keep their stock in this many StockShard rows; see ecommerce_app.inventory
+    shard_count = models.PositiveSmallIntegerField(default=0)
+    min_stock_level = models.PositiveIntegerField(default=5)
+    # When stock last fell to min_stock_level; cleared once it is back above
+    low_stock_since = models.DateTimeField(null=True, blank=True, editable=False)
+    # Aggregates of the active variants for listings, kept current by ecommerce_app.variants
+    variant_count = models.PositiveIntegerField(default=0, editable=False)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, editable=False)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, editable=False)
+    variant_stock = models.PositiveIntegerField(default=0, editable=False)
+    variant_in_stock = models.BooleanField(default=False, editable=False)
     is_active = models.BooleanField(default=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -101,6 +147,11 @@ class Product(models.Model):
             models.Index(fields=['is_active', 'price']),
             models.Index(fields=['name', 'is_active']),
             models.Index(fields=['category', 'is_active', 'stock']),
+            # Holds only the low-stock products, so alerts never scan the catalogue
+            models.Index(
+                fields=['low_stock_since'], name='low_stock_idx',
+                condition=models.Q(low_stock_since__isnull=False)
+            ),
         ]
 
     def __str__(self):
@@ -108,8 +159,43 @@ class Product(models.Model):
 
     @property
     def is_in_stock(self):
+        # Carts and orders sell the product's own stock; variant stock is only shown
         return self.stock > 0
 
+    @property
+    def is_low_stock(self):
+        return self.stock <= self.min_stock_level
+
+class ProductVariant(models.Model):
+    """A variant of a product (size, color, etc.) with its own price and stock"""
+    product = models.ForeignKey(Product, related_name='variants', on_delete=models.CASCADE)
+    name = models.CharField(max_length=100)  # e.g., "Red - Large"
+    sku = models.CharField(max_length=100, unique=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)  # None: the product's price
+    stock = models.PositiveIntegerField(default=0)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.product.name} - {self.name}"
+
+    @property
+    def effective_price(self):
+        return self.price if self.price is not None else self.product.price
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from .variants import refresh_aggregates
+        refresh_aggregates([self.product_id])
+
+    def delete(self, *args, **kwargs):
+        product_id = self.product_id
+        result = super().delete(*args, **kwargs)
+        from .variants import refresh_aggregates
+        refresh_aggregates([product_id])
+        return result
+
 class Cart(models.Model):
     user = models.OneToOneField(User, related_name='cart', on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -154,9 +240,12 @@ class Order(models.Model):
         ('cancelled', 'Cancelled'),
     ]
     
+    order_number = models.CharField(max_length=50, unique=True, blank=True)
     user = models.ForeignKey(User, related_name='orders', on_delete=models.CASCADE)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # Units across all items, kept so order lists never touch OrderItem
+    item_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_paid = models.BooleanField(default=False)
@@ -170,9 +259,24 @@ class Order(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at']),
+            # Only orders still moving through fulfilment are looked up by status
+            models.Index(
+                fields=['status'],
+                name='order_open_status_idx',
+                condition=~models.Q(status__in=['delivered', 'cancelled']),
+            ),
+        ]
 
     def __str__(self):
-        return f'Order {self.id} by {self.user.username}'
+        return f'Order {self.order_number or self.id} by {self.user.username}'
+
+    def save(self, *args, **kwargs):
+        if not self.order_number:
+            from .order_numbers import allocate
+            self.order_number = allocate()
+        super().save(*args, **kwargs)
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
@@ -186,3 +290,438 @@ class OrderItem(models.Model):
     @property
     def total_price(self):
         return self.quantity * self.price
+
+
+class OrderStatusHistory(models.Model):
+    """Track status changes for orders"""
+    order = models.ForeignKey(Order, related_name='status_history', on_delete=models.CASCADE)
+    from_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    notes = models.TextField(blank=True)
+    changed_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name_plural = 'Order Status Histories'
+
+    def __str__(self):
+        return f'{self.order_id}: {self.from_status} -> {self.status}'
+
+
+class ArchivedOrder(models.Model):
+    """Delivered order moved out of the hot order tables by archive_orders.
+
+    The columns needed to list and find orders are kept as-is; everything
+    else, items included, is stored as zlib-compressed JSON in ``data``. On
+    PostgreSQL the table is range-partitioned by month of ``created_at``.
+    """
+    id = models.BigIntegerField(primary_key=True)  # id the order had in Order
+    order_number = models.CharField(max_length=50, db_index=True)
+    user = models.ForeignKey(User, related_name='archived_orders', on_delete=models.CASCADE, db_index=False)
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    item_count = models.PositiveIntegerField(default=0)
+    is_paid = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    data = models.BinaryField()
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at']),
+        ]
+
+    def __str__(self):
+        return f'Archived order {self.order_number}'
+
+
+class OrderNumberCounter(models.Model):
+    """Source of order number blocks on databases without sequences"""
+    name = models.CharField(max_length=50, primary_key=True)
+    next_block = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name}: {self.next_block}'
+
+
+class PaymentOutbox(models.Model):
+    """Gateway call recorded in the checkout transaction and performed by a worker"""
+    ACTION_CHOICES = [
+        ('create_payment_intent', 'Create Payment Intent'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+
+    order = models.ForeignKey(Order, related_name='payment_outbox', on_delete=models.CASCADE)
+    action = models.CharField(max_length=30, choices=ACTION_CHOICES)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    result = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # A claimed row is pushed into the future for the length of its lease
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['available_at']
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.action} for order {self.order_id} ({self.status})'
+
+
+class PaymentWebhook(models.Model):
+    """Payment gateway event, stored on receipt and processed later by process_webhooks"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processed', 'Processed'),
+        ('dead', 'Dead'),
+    ]
+
+    gateway = models.CharField(max_length=50)  # stripe, fake, ...
+    event_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=100)
+    event_data = models.JSONField(default=dict)
+    # Order id from the event metadata; events for one order are handled in order
+    order_ref = models.BigIntegerField(blank=True, null=True)
+    event_created = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    error_message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['gateway', 'event_id']
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['available_at'], name='webhook_due_idx', condition=models.Q(status='pending')),
+            models.Index(
+                fields=['order_ref', 'event_created'],
+                name='webhook_pending_order_idx',
+                condition=models.Q(status='pending'),
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.gateway} webhook {self.event_type}'
+
+
+class PaymentTransaction(models.Model):
+    """Money movement at the payment gateway, one row per gateway object (PaymentIntent, refund)"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    TRANSACTION_TYPE_CHOICES = [
+        ('payment', 'Payment'),
+        ('refund', 'Refund'),
+    ]
+
+    # Kept when the order is archived; order_number still identifies it
+    order = models.ForeignKey(Order, related_name='transactions', on_delete=models.SET_NULL, blank=True, null=True)
+    order_number = models.CharField(max_length=50, db_index=True)
+    transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPE_CHOICES, default='payment')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, default='usd')
+    gateway = models.CharField(max_length=50)
+    gateway_transaction_id = models.CharField(max_length=255)
+    # When the gateway created the object, so both sides shard on the same clock
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        unique_together = ('gateway', 'gateway_transaction_id')
+        indexes = [
+            models.Index(fields=['gateway', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.transaction_type} {self.gateway_transaction_id} ({self.status})'
+
+
+class RefundRequest(models.Model):
+    """Customer refund request, paid out by process_refunds once staff approve it"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('approved', 'Approved'),
+        ('rejected', 'Rejected'),
+        ('processing', 'Processing'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed'),
+    ]
+    REASON_CHOICES = [
+        ('defective_product', 'Defective Product'),
+        ('wrong_item', 'Wrong Item Received'),
+        ('not_as_described', 'Not as Described'),
+        ('changed_mind', 'Changed Mind'),
+        ('duplicate_order', 'Duplicate Order'),
+        ('other', 'Other'),
+    ]
+
+    order = models.ForeignKey(Order, related_name='refund_requests', on_delete=models.SET_NULL, blank=True, null=True)
+    order_number = models.CharField(max_length=50, db_index=True)
+    user = models.ForeignKey(User, related_name='refund_requests', on_delete=models.CASCADE)
+    amount_requested = models.DecimalField(max_digits=10, decimal_places=2)
+    reason = models.CharField(max_length=30, choices=REASON_CHOICES)
+    description = models.TextField(blank=True)
+    # The goods came back: put the returned items on sale again once refunded
+    restock = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    reviewed_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    admin_notes = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # A claimed request is pushed into the future for the length of its lease
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    reviewed_at = models.DateTimeField(blank=True, null=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['available_at'],
+                name='refund_queue_idx',
+                condition=models.Q(status__in=['approved', 'processing']),
+            ),
+        ]
+
+    def __str__(self):
+        return f'Refund request {self.amount_requested} for {self.order_number}'
+
+
+class RefundRequestItem(models.Model):
+    """Units of an order line being returned, put back on sale if the refund is restocked"""
+    refund_request = models.ForeignKey(RefundRequest, related_name='items', on_delete=models.CASCADE)
+    # Null once the order is archived
+    order_item = models.ForeignKey(OrderItem, related_name='+', on_delete=models.SET_NULL, blank=True, null=True)
+    product = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} returned for refund request {self.refund_request_id}'
+
+
+class IdempotencyKey(models.Model):
+    """Response stored for a request made with an Idempotency-Key header"""
+    user = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    # 16-byte digests of the endpoint + client key and of the request body
+    key_hash = models.BinaryField(max_length=16)
+    request_hash = models.BinaryField(max_length=16)
+    # Empty until the first request has finished
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True)
+    response = models.BinaryField(blank=True, default=b'')  # zlib-compressed JSON
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'key_hash')
+
+    def __str__(self):
+        return f'Idempotency key {bytes(self.key_hash).hex()} for {self.user_id}'
+
+
+class StockHoldBucket(models.Model):
+    """One of several counters that together hold the reserved quantity of a product.
+
+    Spreading the held quantity over a few rows lets concurrent checkouts of the
+    same product update different rows instead of queueing on a single lock.
+    """
+    product = models.ForeignKey(Product, related_name='hold_buckets', on_delete=models.CASCADE)
+    bucket = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'bucket')
+
+    def __str__(self):
+        return f'{self.product_id}[{self.bucket}] = {self.quantity}'
+
+
+class StockShard(models.Model):
+    """Part of the stock of a hot product.
+
+    Checkouts take units from one shard, so sales of the same product do not
+    queue on its row lock; ``Product.stock`` is refreshed from the shards by
+    ``compact_stock``.
+    """
+    product = models.ForeignKey(Product, related_name='stock_shards', on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'shard')
+
+    def __str__(self):
+        return f'{self.product_id}[{self.shard}] = {self.quantity}'
+
+
+class StockMovement(models.Model):
+    """Append-only ledger of every change to a product's stock, and of checkout holds"""
+    KIND_CHOICES = [
+        ('receipt', 'Receipt'),
+        ('sale', 'Sale'),
+        ('return', 'Return'),
+        ('adjustment', 'Adjustment'),
+        ('reservation', 'Reservation'),
+        ('release', 'Release'),
+    ]
+
+    product = models.ForeignKey(Product, related_name='stock_movements', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    quantity = models.IntegerField()  # Units added (positive) or removed (negative)
+    reference = models.CharField(max_length=100, blank=True)  # Order number, refund, note...
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['product', '-created_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} {self.quantity:+d} x {self.product_id}'
+
+
+class StockHold(models.Model):
+    """Time-limited reservation of product units placed when checkout starts"""
+    user = models.ForeignKey(User, related_name='stock_holds', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='stock_holds', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    bucket = models.PositiveSmallIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'product']),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} held for {self.user_id}'
+
+
+class SalesRollup(models.Model):
+    """Sales totals per hour or day of order creation, kept current by ecommerce_app.rollups"""
+    PERIOD_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    period_start = models.DateTimeField()
+    order_count = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['period', 'period_start']
+        unique_together = ('period', 'period_start')
+
+    def __str__(self):
+        return f'{self.period} {self.period_start:%Y-%m-%d %H:00}: {self.revenue}'
+
+
+class ProductSalesRollup(models.Model):
+    """Units and revenue per product (and its category) per hour or day"""
+    period = models.CharField(max_length=4, choices=SalesRollup.PERIOD_CHOICES)
+    period_start = models.DateTimeField()
+    product = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, related_name='+', on_delete=models.CASCADE)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('period', 'period_start', 'product')
+        indexes = [
+            models.Index(fields=['period', 'period_start', 'category']),
+        ]
+
+    def __str__(self):
+        return f'{self.period} {self.period_start:%Y-%m-%d %H:00} {self.product_id}: {self.units}'
+
+
+class LowStockDigest(models.Model):
+    """A run of the low-stock digests; the next run reports products that ran low after ``cutoff``"""
+    cutoff = models.DateTimeField(unique=True)
+    categories = models.IntegerField(default=0)
+    products = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-cutoff']
+
+    def __str__(self):
+        return f'Low-stock digest up to {self.cutoff:%Y-%m-%d %H:%M}: {self.products} products'
+
+
+class FlashSale(models.Model):
+    """Flash-sale mode for a product: checkouts of it go through a waiting-room queue.
+
+    Positions are handed out in join order; ``admit_flash_sales`` admits the
+    queue in that order at ``admit_rate`` users per second. See
+    ecommerce_app.flash_sales.
+    """
+    product = models.OneToOneField(Product, related_name='flash_sale', on_delete=models.CASCADE)
+    is_active = models.BooleanField(default=True)
+    admit_rate = models.PositiveIntegerField(default=20)  # Users admitted per second
+    max_waiting = models.PositiveIntegerField(default=10000)  # Joins are refused beyond this
+    admission_ttl = models.PositiveIntegerField(default=300)  # Seconds an admitted user has to check out
+    joined = models.PositiveIntegerField(default=0, editable=False)  # Last position handed out
+    admitted = models.PositiveIntegerField(default=0, editable=False)  # Positions up to this one are admitted
+    admitted_at = models.DateTimeField(null=True, blank=True, editable=False)  # Last admission run
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Flash sale of {self.product}'
+
+
+class FlashSaleTicket(models.Model):
+    """A user's place in a flash sale's queue; the token is the waiting-room token"""
+    STATUS_CHOICES = [
+        ('waiting', 'Waiting'),
+        ('admitted', 'Admitted'),
+        ('used', 'Used'),
+        ('expired', 'Expired'),
+        ('sold_out', 'Sold out'),
+    ]
+
+    sale = models.ForeignKey(FlashSale, related_name='tickets', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='flash_sale_tickets', on_delete=models.CASCADE)
+    token = models.CharField(max_length=64, unique=True)
+    position = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='waiting')
+    expires_at = models.DateTimeField(null=True, blank=True)  # Set on admission
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('sale', 'user'), ('sale', 'position')]
+        indexes = [
+            models.Index(
+                fields=['sale', 'expires_at'], name='flash_admitted_idx',
+                condition=models.Q(status='admitted')
+            ),
+        ]
+
+    def __str__(self):
+        return f'#{self.position} in {self.sale} for {self.user_id}'
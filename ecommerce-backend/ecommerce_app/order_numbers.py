@@ -0,0 +1,86 @@
+"""
+Order number allocation.
+
+Each process reserves a block of ``BLOCK_SIZE`` numbers at a time and hands
+them out from memory, so placing an order costs no extra query most of the
+time. Blocks come from a Postgres sequence where available (``nextval`` is not
+rolled back with the caller's transaction) and from the ``OrderNumberCounter``
+row elsewhere; there, allocate outside the checkout transaction where possible.
+Numbers are unique across processes and nodes and increase with the time
+their block was reserved.
+"""
+import os
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .models import OrderNumberCounter
+
+BLOCK_SIZE = 1000
+SEQUENCE = 'ecommerce_app_order_number_block_seq'
+COUNTER = 'order'
+
+
+def format_order_number(number):
+    return f'ORD-{number:010d}'
+
+
+def _next_counter_block(connection):
+    """Increment the counter row; commits at once unless inside a transaction"""
+    table = connection.ops.quote_name(OrderNumberCounter._meta.db_table)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {table} SET next_block = next_block + 1 WHERE name = %s', [COUNTER])
+            cursor.execute(f'SELECT next_block FROM {table} WHERE name = %s', [COUNTER])
+            return cursor.fetchone()[0]
+
+
+class OrderNumberAllocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = self._end = 0
+        self._confirmed = True
+
+    def _confirm(self):
+        self._confirmed = True
+
+    def _reserve_block(self):
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT nextval(%s)', [SEQUENCE])
+                block = cursor.fetchone()[0]
+        else:
+            block = _next_counter_block(connection)
+            if connection.in_atomic_block:
+                # A rollback would undo the counter while this process kept
+                # the block; only trust it once the transaction commits.
+                self._confirmed = False
+                transaction.on_commit(self._confirm)
+        self._next = block * BLOCK_SIZE
+        self._end = self._next + BLOCK_SIZE
+
+    def allocate(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Never share a block with the process we were forked from
+                self._pid = os.getpid()
+                self._next = self._end = 0
+            if not self._confirmed and not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+                # The transaction that reserved the block was rolled back
+                self._next = self._end = 0
+                self._confirmed = True
+            if self._next >= self._end:
+                self._reserve_block()
+            number = self._next
+            self._next += 1
+        return format_order_number(number)
+
+
+allocator = OrderNumberAllocator()
+
+
+def allocate():
+    """Return a new unique order number"""
+    return allocator.allocate()
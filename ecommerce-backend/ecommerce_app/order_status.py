@@ -0,0 +1,109 @@
+"""
+Order status transitions.
+
+Every status change goes through ``transition`` (one order) or
+``bulk_transition`` (many orders), which only allow the moves listed in
+``TRANSITIONS`` and record each one in ``OrderStatusHistory``. Moving a
+batch costs one locking SELECT, one UPDATE and one bulk INSERT of history
+rows, however many orders it holds, plus the sales rollup update when orders
+start or stop counting as sales.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from .checkout import restore_stock
+from .models import Order, OrderStatusHistory
+from .rollups import record_transition
+
+TRANSITIONS = {
+    'pending': {'processing', 'cancelled'},
+    'processing': {'shipped', 'cancelled'},
+    'shipped': {'delivered'},
+    'delivered': set(),
+    'cancelled': set(),
+}
+
+BATCH_SIZE = 5000
+
+
+class InvalidTransition(Exception):
+    def __init__(self, from_status, to_status):
+        self.from_status = from_status
+        self.to_status = to_status
+        super().__init__(f'Cannot change order status from {from_status} to {to_status}')
+
+
+def sources(to_status):
+    """Statuses an order may be moved to ``to_status`` from"""
+    if to_status not in TRANSITIONS:
+        raise ValueError(f'Unknown order status: {to_status}')
+    return [status for status, targets in TRANSITIONS.items() if to_status in targets]
+
+
+def _apply(orders, to_status, changed_by, notes, updates):
+    """Move the locked ``(id, status)`` pairs in ``orders`` to ``to_status``"""
+    ids = [order_id for order_id, _ in orders]
+    Order.objects.filter(id__in=ids).update(
+        status=to_status, updated_at=timezone.now(), **updates
+    )
+    OrderStatusHistory.objects.bulk_create([
+        OrderStatusHistory(
+            order_id=order_id,
+            from_status=from_status,
+            status=to_status,
+            notes=notes,
+            changed_by=changed_by,
+        )
+        for order_id, from_status in orders
+    ])
+    record_transition(orders, to_status)
+    if to_status == 'cancelled':
+        # Cancelled orders give their units back
+        restore_stock(ids)
+
+
+def bulk_transition(order_ids, to_status, changed_by=None, notes='', batch_size=BATCH_SIZE, **updates):
+    """Move the given orders to ``to_status``.
+
+    Orders that cannot make the move (already there, further along, or
+    missing) are left alone. Extra ``updates`` are written in the same
+    UPDATE, e.g. ``is_paid=True``. Returns the ids that were moved.
+    """
+    allowed = sources(to_status)
+    order_ids = sorted(set(order_ids))
+    moved = []
+    for start in range(0, len(order_ids), batch_size):
+        chunk = order_ids[start:start + batch_size]
+        with transaction.atomic():
+            orders = list(
+                Order.objects.select_for_update()
+                .filter(id__in=chunk, status__in=allowed)
+                .order_by('id')
+                .values_list('id', 'status')
+            )
+            if orders:
+                _apply(orders, to_status, changed_by, notes, updates)
+        moved.extend(order_id for order_id, _ in orders)
+    return moved
+
+
+def transition(order, to_status, changed_by=None, notes='', **updates):
+    """Move a single order to ``to_status``.
+
+    Returns False if the order is already there, so repeated notifications are
+    harmless, and raises ``InvalidTransition`` for any move not allowed.
+    """
+    allowed = sources(to_status)
+    with transaction.atomic():
+        current = Order.objects.select_for_update().values_list('status', flat=True).get(id=order.id)
+        if current == to_status:
+            order.status = current
+            return False
+        if current not in allowed:
+            raise InvalidTransition(current, to_status)
+        _apply([(order.id, current)], to_status, changed_by, notes, updates)
+
+    order.status = to_status
+    for field, value in updates.items():
+        setattr(order, field, value)
+    return True
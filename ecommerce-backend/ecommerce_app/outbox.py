@@ -0,0 +1,154 @@
+"""
+Transactional outbox for payment gateway calls.
+
+Checkout records a ``PaymentOutbox`` row in the same transaction as the order,
+so no row lock or connection is held while the gateway answers. The
+``process_payment_outbox`` command claims due rows, performs the call and
+stores the result on the order, where the client picks it up by polling
+``/api/orders/<id>/payment/``.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .gateways import CircuitOpen, GatewayError, get_gateway
+from .models import Order, PaymentOutbox
+from .order_status import transition
+from .transactions import record_payment_intent
+
+logger = logging.getLogger(__name__)
+
+LEASE = timedelta(seconds=60)
+
+
+def enqueue_payment_intent(order, currency='usd'):
+    """Queue the PaymentIntent for ``order``; call inside the checkout transaction"""
+    return PaymentOutbox.objects.create(
+        order=order,
+        action='create_payment_intent',
+        payload={
+            'amount': int(order.total_amount * 100),  # Convert to cents
+            'currency': currency,
+        }
+    )
+
+
+def claim(batch_size):
+    """Lease up to ``batch_size`` due rows to this worker"""
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            PaymentOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', available_at__lte=now)
+            .order_by('available_at')[:batch_size]
+        )
+        PaymentOutbox.objects.filter(id__in=[entry.id for entry in entries]).update(
+            available_at=now + LEASE, attempts=F('attempts') + 1
+        )
+    for entry in entries:
+        entry.attempts += 1
+    return entries
+
+
+def _fail(entry, error):
+    """Give up on ``entry`` and cancel its still-pending order"""
+    with transaction.atomic():
+        entry.status = 'failed'
+        entry.last_error = error
+        entry.save(update_fields=['status', 'last_error', 'updated_at'])
+
+        order = Order.objects.select_for_update().get(id=entry.order_id)
+        if order.status == 'pending' and not order.is_paid:
+            transition(order, 'cancelled', notes='Payment could not be set up')
+    logger.error(f'Payment intent for order {entry.order_id} failed: {error}')
+
+
+def process_entry(entry):
+    payload = entry.payload
+    gateway = get_gateway()
+    try:
+        intent = gateway.create_payment_intent(
+            amount=payload['amount'],
+            currency=payload['currency'],
+            metadata={'order_id': entry.order_id},
+            # Retries after a lost response must not create a second intent
+            idempotency_key=f'order-{entry.order_id}-payment-intent'
+        )
+    except CircuitOpen as e:
+        # Not the entry's fault: wait for the breaker without using up an attempt
+        entry.attempts -= 1
+        entry.last_error = str(e)
+        entry.available_at = timezone.now() + timedelta(seconds=e.retry_after)
+        entry.save(update_fields=['attempts', 'last_error', 'available_at', 'updated_at'])
+        return False
+    except GatewayError as e:
+        if e.retryable and entry.attempts < settings.PAYMENT_OUTBOX_MAX_ATTEMPTS:
+            entry.last_error = str(e)
+            entry.available_at = timezone.now() + timedelta(seconds=2 ** entry.attempts)
+            entry.save(update_fields=['last_error', 'available_at', 'updated_at'])
+        else:
+            _fail(entry, str(e))
+        return False
+
+    with transaction.atomic():
+        # An order cancelled in the meantime must not be handed a client secret
+        # to pay with; one already carrying the intent was attached by an
+        # earlier run of this entry whose lease ran out
+        attached = Order.objects.filter(
+            Q(status='pending') | Q(stripe_payment_intent=intent['id']), id=entry.order_id
+        ).update(stripe_payment_intent=intent['id'], updated_at=timezone.now())
+        if attached:
+            entry.status = 'completed'
+            entry.result = {
+                'payment_intent_id': intent['id'],
+                'client_secret': intent['client_secret'],
+            }
+        else:
+            entry.status = 'failed'
+            entry.last_error = 'Order is no longer pending'
+        entry.save(update_fields=['status', 'result', 'last_error', 'updated_at'])
+        record_payment_intent(entry.order, gateway.name, intent)
+    if not attached:
+        logger.warning(f'Payment intent {intent["id"]} not attached: order {entry.order_id} is no longer pending')
+    return bool(attached)
+
+
+def _process_in_thread(entry):
+    try:
+        return process_entry(entry)
+    finally:
+        connections.close_all()
+
+
+def process_batch(batch_size=100, workers=1):
+    """Claim and process one batch; returns the number of rows claimed"""
+    if get_gateway().breaker.retry_after():
+        return 0
+    entries = claim(batch_size)
+    if workers > 1 and len(entries) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_process_in_thread, entries))
+    else:
+        for entry in entries:
+            process_entry(entry)
+    return len(entries)
+
+
+def payment_status(order):
+    """What the client polling for its payment details should be told"""
+    entry = order.payment_outbox.filter(action='create_payment_intent').order_by('-id').first()
+    if entry is None or entry.status == 'pending':
+        return {'status': 'pending'}
+    if entry.status == 'failed':
+        return {'status': 'failed', 'error': 'Payment processing error'}
+    return {
+        'status': 'ready',
+        'payment_intent_id': entry.result['payment_intent_id'],
+        'client_secret': entry.result['client_secret'],
+        'amount': order.total_amount,
+    }
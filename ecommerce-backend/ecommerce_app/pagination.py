@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OrderHistoryPagination(CursorPagination):
+    """Keyset paging over a user's orders, newest first.
+
+    Each page is an index range scan on (user, -created_at), so deep pages
+    cost the same as the first one.
+    """
+    ordering = '-created_at'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
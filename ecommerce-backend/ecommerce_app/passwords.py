@@ -0,0 +1,123 @@
+"""
+Password hashing in a bounded pool.
+
+Password hashes are slow on purpose, hundreds of milliseconds each, and a
+login burst that hashes on the request thread holds up every other request
+the worker could be serving. Login and registration hash through
+``authenticate`` and ``make_password`` here, which run the hashing in a
+thread pool of ``PASSWORD_HASHING_WORKERS`` threads. Threads are enough: the
+PBKDF2, bcrypt and Argon2 hashers all release the GIL while they hash. The
+DRF views served over WSGI wait for the pool; the async views that
+``asgi.py`` routes instead await ``aauthenticate`` and ``amake_password``,
+so the event loop keeps serving other requests in the meantime.
+
+The pool is bounded in both directions: at most ``PASSWORD_HASHING_QUEUE``
+hashes may be running or waiting in each process, and beyond that ``Busy``
+is raised so a burst is turned away quickly instead of queueing without
+limit.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.db.models.functions import Lower
+
+from .models import User
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+
+class Busy(Exception):
+    """Raised when the process already has ``PASSWORD_HASHING_QUEUE`` hashes in hand"""
+
+    retry_after = 1
+
+    def __init__(self):
+        super().__init__('Too many logins in progress, please try again shortly')
+
+
+def _pool():
+    global _executor, _slots
+    # Created on first use, i.e. after the server has forked its workers
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(settings.PASSWORD_HASHING_WORKERS, thread_name_prefix='password-hashing')
+            _slots = threading.BoundedSemaphore(settings.PASSWORD_HASHING_QUEUE)
+    return _executor, _slots
+
+
+def _run(function, *args):
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        raise Busy()
+    try:
+        return executor.submit(function, *args).result()
+    finally:
+        slots.release()
+
+
+async def _arun(function, *args):
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        raise Busy()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    finally:
+        slots.release()
+
+
+def _by_email(email):
+    # Any case matches, so imported accounts (stored lower-cased) can log in
+    # as typed; emails are unique whatever their case
+    return User.objects.annotate(email_lower=Lower('email')).filter(email_lower=email.lower())
+
+
+def make_password(password):
+    """Hash a password with the preferred hasher"""
+    return _run(hashers.make_password, password)
+
+
+async def amake_password(password):
+    return await _arun(hashers.make_password, password)
+
+
+def authenticate(email, password):
+    """Return the active user with this email and password, or None
+
+    Like ``ModelBackend`` it hashes even when the email is unknown, so the
+    response time does not give away which accounts exist, and rehashes
+    passwords stored with an outdated hasher or iteration count.
+    """
+    user = _by_email(email).first()
+    if user is None:
+        _run(hashers.make_password, password)
+        return None
+
+    outdated = []
+    if not _run(hashers.check_password, password, user.password, outdated.append):
+        return None
+    if outdated:
+        user.password = make_password(password)
+        user.save(update_fields=['password'])
+    return user if user.is_active else None
+
+
+async def aauthenticate(email, password):
+    """``authenticate`` for async views"""
+    user = await _by_email(email).afirst()
+    if user is None:
+        await _arun(hashers.make_password, password)
+        return None
+
+    outdated = []
+    if not await _arun(hashers.check_password, password, user.password, outdated.append):
+        return None
+    if outdated:
+        user.password = await amake_password(password)
+        await sync_to_async(user.save)(update_fields=['password'])
+    return user if user.is_active else None
@@ -0,0 +1,101 @@
+"""
+Per-route rate limiting in front of the views.
+
+``RATE_LIMITS`` maps URL names to a rate such as ``'10/minute'``.
+``RateLimitMiddleware`` applies it in ``process_view``, once the URL is
+resolved but before the view runs, so a throttled request costs a couple of
+cache operations and no user lookup, body parsing or serializer work.
+Requests carrying a valid access token are counted per user; the token's
+signature is checked, which needs no query. Anonymous requests, such as
+logins, are counted per client IP.
+
+Counts are sliding windows kept in the cache. There is one counter per route,
+client and window; it is created with ``add`` and bumped with ``incr`` so
+concurrent workers never lose a count, and it expires after two windows.
+Nothing is written to the database. A client's rate is its count in the
+current window plus the previous window's count, weighted by how much of the
+previous window still overlaps the last period. Like a token bucket this
+refills smoothly, so a client cannot burst twice the limit across a window
+boundary. The counters must live in a cache shared by all workers for the
+limits to hold across them: ``RATE_LIMIT_CACHE`` names the alias, the shared
+L2 rather than the layered default cache, whose ``add`` and ``incr`` would
+log an L1 invalidation for every request.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework import status
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """Return (requests, seconds) for a rate like '10/minute'"""
+    count, period = rate.split('/')
+    return int(count), PERIODS[period[0]]
+
+
+def client_ip(request):
+    proxies = settings.RATE_LIMIT_PROXY_COUNT
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if proxies and forwarded:
+        # Each trusted proxy appended the address it received the request from
+        addresses = [address.strip() for address in forwarded.split(',')]
+        return addresses[-min(proxies, len(addresses))]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def client_key(request):
+    header = request.META.get(api_settings.AUTH_HEADER_NAME, '').split()
+    if len(header) == 2 and header[0] in api_settings.AUTH_HEADER_TYPES:
+        try:
+            return f'user:{AccessToken(header[1])[api_settings.USER_ID_CLAIM]}'
+        except (TokenError, KeyError):
+            pass
+    return f'ip:{client_ip(request)}'
+
+
+def hit(route, client, rate):
+    """Count a request; returns 0 if it is within the rate, else the seconds to wait"""
+    limit, period = parse_rate(rate)
+    now = time.time()
+    window, into = divmod(now, period)
+    key = f'ratelimit:{route}:{client}:{int(window)}'
+    cache = caches[settings.RATE_LIMIT_CACHE]
+    if cache.add(key, 1, period * 2):
+        count = 1
+    else:
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired between the add and the incr
+            cache.add(key, 1, period * 2)
+            count = 1
+    previous = cache.get(f'ratelimit:{route}:{client}:{int(window) - 1}', 0)
+    if count + previous * (1 - into / period) <= limit:
+        return 0
+    # Rejected requests count too, so a client that keeps hammering stays throttled
+    return max(1, math.ceil(period - into))
+
+
+class RateLimitMiddleware(MiddlewareMixin):
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        route = request.resolver_match.url_name
+        rate = settings.RATE_LIMITS.get(route)
+        if not rate:
+            return None
+        retry_after = hit(route, client_key(request), rate)
+        if retry_after:
+            return JsonResponse(
+                {'error': 'Too many requests, please slow down'},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(retry_after)},
+            )
+        return None
@@ -0,0 +1,176 @@
+"""
+Payment reconciliation.
+
+Checks the gateway's record of every PaymentIntent created in a time window
+against the ``PaymentTransaction`` rows and ``Order.is_paid`` flags for the
+same window. Both sides are read in ``gateway_transaction_id`` order and
+merge-joined, so memory stays flat however many months are checked: the
+database sorts its side, and the gateway side (the paged API or a CSV
+settlement export, neither ordered by id) goes through ``external_sort``,
+which spills sorted runs to temporary files.
+
+Mismatch kinds written to the report:
+
+* ``missing_locally`` - the gateway has an intent with no transaction row
+* ``missing_at_gateway`` - a transaction row the gateway does not know
+* ``amount`` - the amounts differ
+* ``status`` - settled at the gateway but not completed locally, or the reverse
+* ``order_flag`` - ``Order.is_paid`` disagrees with the gateway
+"""
+import csv
+import heapq
+import json
+import tempfile
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.functions import Collate
+
+from .gateways import get_gateway
+from .models import PaymentTransaction
+from .transactions import to_amount
+
+SORT_CHUNK = 50000
+
+REPORT_FIELDS = [
+    'kind', 'gateway_transaction_id', 'order_number', 'local_status', 'gateway_status',
+    'local_amount', 'gateway_amount', 'is_paid',
+]
+
+
+def external_sort(rows, key, chunk_size=SORT_CHUNK):
+    """Yield the JSON-serialisable dicts in ``rows`` sorted by ``key``, holding at most ``chunk_size``"""
+    rows = iter(rows)
+    runs = []
+    try:
+        while True:
+            chunk = sorted(islice(rows, chunk_size), key=lambda row: row[key])
+            if not runs and len(chunk) < chunk_size:
+                # Everything fitted in one chunk
+                yield from chunk
+                return
+            if not chunk:
+                break
+            run = tempfile.TemporaryFile('w+')
+            run.writelines(json.dumps(row) + '\n' for row in chunk)
+            run.seek(0)
+            runs.append(run)
+        yield from heapq.merge(*((json.loads(line) for line in run) for run in runs), key=lambda row: row[key])
+    finally:
+        for run in runs:
+            run.close()
+
+
+def api_rows(start, end):
+    """Intents created in [start, end) according to the gateway API"""
+    for intent in get_gateway().list_payment_intents(int(start.timestamp()), int(end.timestamp())):
+        yield {
+            'id': intent['id'],
+            'status': intent['status'],
+            'amount': str(to_amount(intent['amount'] or 0)),
+        }
+
+
+def _parse_created(value):
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value), tz=dt_timezone.utc)
+    created = datetime.fromisoformat(value)
+    return created if created.tzinfo else created.replace(tzinfo=dt_timezone.utc)
+
+
+def csv_rows(path, start, end):
+    """Intents created in [start, end) from a settlement export.
+
+    The export needs ``id``, ``amount`` (in major units, e.g. 12.50),
+    ``status`` and ``created`` (unix time or ISO 8601) columns.
+    """
+    with open(path, newline='') as export:
+        for row in csv.DictReader(export):
+            if start <= _parse_created(row['created']) < end:
+                yield {
+                    'id': row['id'],
+                    'status': row['status'],
+                    'amount': str(Decimal(row['amount']).quantize(Decimal('0.01'))),
+                }
+
+
+def local_rows(start, end):
+    """Payment transactions created in [start, end), ordered by id byte for byte like Python strings"""
+    ordering = 'gateway_transaction_id'
+    if connection.vendor == 'postgresql':
+        ordering = Collate(ordering, 'C')
+    return (
+        PaymentTransaction.objects
+        .filter(
+            gateway=settings.PAYMENT_GATEWAY, transaction_type='payment',
+            created_at__gte=start, created_at__lt=end
+        )
+        .order_by(ordering)
+        .values('gateway_transaction_id', 'order_number', 'status', 'amount', 'order__is_paid')
+        .iterator(chunk_size=2000)
+    )
+
+
+def _mismatch(kind, local, remote):
+    local, remote = local or {}, remote or {}
+    return {
+        'kind': kind,
+        'gateway_transaction_id': local.get('gateway_transaction_id') or remote.get('id'),
+        'order_number': local.get('order_number', ''),
+        'local_status': local.get('status', ''),
+        'gateway_status': remote.get('status', ''),
+        'local_amount': local.get('amount', ''),
+        'gateway_amount': remote.get('amount', ''),
+        'is_paid': local.get('order__is_paid', ''),
+    }
+
+
+def _compare(local, remote):
+    settled = remote['status'] == 'succeeded'
+    if local['amount'] != Decimal(remote['amount']):
+        yield _mismatch('amount', local, remote)
+    if settled != (local['status'] == 'completed'):
+        yield _mismatch('status', local, remote)
+    # Archived orders no longer have a row to check
+    if local['order__is_paid'] is not None and local['order__is_paid'] != settled:
+        yield _mismatch('order_flag', local, remote)
+
+
+def merge_join(local, remote):
+    """Yield the mismatches between two id-ordered streams, and None for each clean match"""
+    local, remote = iter(local), iter(remote)
+    ours, theirs = next(local, None), next(remote, None)
+    while ours is not None or theirs is not None:
+        if theirs is None or (ours is not None and ours['gateway_transaction_id'] < theirs['id']):
+            yield _mismatch('missing_at_gateway', ours, None)
+            ours = next(local, None)
+        elif ours is None or theirs['id'] < ours['gateway_transaction_id']:
+            yield _mismatch('missing_locally', None, theirs)
+            theirs = next(remote, None)
+        else:
+            mismatches = list(_compare(ours, theirs))
+            yield from mismatches or [None]
+            ours, theirs = next(local, None), next(remote, None)
+
+
+def reconcile(start, end, report, export=None):
+    """Reconcile [start, end), writing mismatches as CSV to the ``report`` file.
+
+    Reads the gateway side from the CSV ``export`` when given, otherwise from
+    the gateway API. Returns a Counter of mismatch kinds plus ``matched``.
+    """
+    remote = csv_rows(export, start, end) if export else api_rows(start, end)
+    writer = csv.DictWriter(report, fieldnames=REPORT_FIELDS)
+    writer.writeheader()
+    counts = Counter()
+    for mismatch in merge_join(local_rows(start, end), external_sort(remote, 'id')):
+        if mismatch is None:
+            counts['matched'] += 1
+            continue
+        counts[mismatch['kind']] += 1
+        writer.writerow(mismatch)
+    return counts
@@ -0,0 +1,259 @@
+"""
+Refund pipeline.
+
+Staff ``approve`` (or ``reject``) pending ``RefundRequest`` rows in batches.
+``process_refunds`` then claims approved requests, issues the gateway refunds
+concurrently (at most ``workers`` at once, and never more than the gateway's
+connection limit), and settles the whole batch in one transaction: the
+requests are marked processed with one UPDATE and the returned items of
+restocked requests go back on sale with one grouped UPDATE. Each refund is
+recorded as a ``PaymentTransaction`` of type refund, pending before the
+gateway is called and completed or failed afterwards.
+
+Only the lines listed as a request's ``items`` are restocked, never more
+units of a line than were sold. A request that refunds the whole order may
+be restocked without listing them; approving it lists every line.
+"""
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from . import inventory
+from .gateways import CircuitOpen, GatewayError, get_gateway
+from .models import OrderItem, PaymentTransaction, RefundRequest, RefundRequestItem
+
+logger = logging.getLogger(__name__)
+
+LEASE = timedelta(minutes=5)
+
+BATCH_SIZE = 1000
+
+# Requests that count against the order total
+COMMITTED = ['approved', 'processing', 'processed']
+
+
+def _key(request_id):
+    """Idempotency key of the gateway refund, also the pending transaction's id"""
+    return f'refund-request-{request_id}'
+
+
+def approve(request_ids, reviewed_by=None, notes='', restock=False, batch_size=BATCH_SIZE):
+    """Approve pending requests on paid orders whose refunds stay within the order total.
+
+    With ``restock``, requests that refund part of the order must list the
+    returned items. Returns the ids approved; the others are left pending.
+    """
+    request_ids = sorted(set(request_ids))
+    approved = []
+    for start in range(0, len(request_ids), batch_size):
+        chunk = request_ids[start:start + batch_size]
+        with transaction.atomic():
+            requests = list(
+                RefundRequest.objects.select_for_update(of=('self',))
+                .filter(id__in=chunk, status='pending', order__is_paid=True)
+                .exclude(order__stripe_payment_intent__isnull=True)
+                .select_related('order')
+                .order_by('id')
+            )
+            committed = defaultdict(Decimal, (
+                RefundRequest.objects
+                .filter(order_id__in={request.order_id for request in requests}, status__in=COMMITTED)
+                .values_list('order_id')
+                .annotate(total=Sum('amount_requested'))
+            ))
+            itemized = set()
+            if restock:
+                itemized = set(
+                    RefundRequestItem.objects.filter(refund_request_id__in=[request.id for request in requests])
+                    .values_list('refund_request_id', flat=True)
+                )
+            ids = []
+            whole = {}
+            for request in requests:
+                if committed[request.order_id] + request.amount_requested > request.order.total_amount:
+                    continue
+                if restock and request.id not in itemized:
+                    if request.amount_requested < request.order.total_amount:
+                        # Which goods came back is unknown
+                        continue
+                    whole[request.id] = request.order_id
+                committed[request.order_id] += request.amount_requested
+                ids.append(request.id)
+            # A whole-order refund returns every line
+            lines = defaultdict(list)
+            for order_id, *line in OrderItem.objects.filter(order_id__in=set(whole.values())).values_list(
+                'order_id', 'id', 'product_id', 'quantity'
+            ):
+                lines[order_id].append(line)
+            RefundRequestItem.objects.bulk_create([
+                RefundRequestItem(
+                    refund_request_id=request_id, order_item_id=item_id, product_id=product_id, quantity=quantity
+                )
+                for request_id, order_id in whole.items()
+                for item_id, product_id, quantity in lines[order_id]
+            ])
+            RefundRequest.objects.filter(id__in=ids).update(
+                status='approved', reviewed_by=reviewed_by, reviewed_at=timezone.now(),
+                admin_notes=notes, restock=restock, updated_at=timezone.now()
+            )
+        approved.extend(ids)
+    return approved
+
+
+def reject(request_ids, reviewed_by=None, notes=''):
+    """Reject pending requests; returns how many were rejected"""
+    return RefundRequest.objects.filter(id__in=request_ids, status='pending').update(
+        status='rejected', reviewed_by=reviewed_by, reviewed_at=timezone.now(),
+        admin_notes=notes, updated_at=timezone.now()
+    )
+
+
+def claim(batch_size):
+    """Lease up to ``batch_size`` approved requests, or ones whose worker died mid-batch"""
+    now = timezone.now()
+    with transaction.atomic():
+        requests = list(
+            RefundRequest.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(status__in=['approved', 'processing'], available_at__lte=now)
+            .select_related('order')
+            .order_by('available_at')[:batch_size]
+        )
+        RefundRequest.objects.filter(id__in=[request.id for request in requests]).update(
+            status='processing', attempts=F('attempts') + 1, available_at=now + LEASE, updated_at=now
+        )
+        # Record the refunds about to be attempted; a retried request keeps its row
+        gateway = get_gateway().name
+        PaymentTransaction.objects.bulk_create([
+            PaymentTransaction(
+                order_id=request.order_id,
+                order_number=request.order_number,
+                transaction_type='refund',
+                status='pending',
+                amount=request.amount_requested,
+                gateway=gateway,
+                gateway_transaction_id=_key(request.id),
+            )
+            for request in requests
+        ], ignore_conflicts=True)
+    for request in requests:
+        request.attempts += 1
+    return requests
+
+
+def _issue(request):
+    """Call the gateway for one request; returns (request, refund or None, error or None)"""
+    if request.order is None:
+        return request, None, GatewayError('The order was archived before the refund was issued')
+    try:
+        refund = get_gateway().create_refund(
+            request.order.stripe_payment_intent,
+            int(request.amount_requested * 100),  # Convert to cents
+            # A retried request must not refund twice
+            idempotency_key=_key(request.id)
+        )
+    except GatewayError as e:
+        return request, None, e
+    if refund['status'] in ('failed', 'canceled'):
+        return request, None, GatewayError(f'Refund {refund["id"]} {refund["status"]}')
+    return request, refund, None
+
+
+def _restock(request_ids):
+    """Put the returned items of the given requests back on sale"""
+    items = list(
+        RefundRequestItem.objects.filter(refund_request_id__in=request_ids)
+        .order_by('id')
+        .values_list('order_item_id', 'product_id', 'quantity', 'refund_request__order_number')
+    )
+    line_ids = sorted({item[0] for item in items if item[0] is not None})
+    # Locked so concurrent batches restocking the same line take turns
+    sold = dict(OrderItem.objects.select_for_update().filter(id__in=line_ids).order_by('id').values_list('id', 'quantity'))
+    restocked = defaultdict(int, (
+        RefundRequestItem.objects
+        .filter(order_item_id__in=line_ids, refund_request__status='processed', refund_request__restock=True)
+        .values_list('order_item_id')
+        .annotate(total=Sum('quantity'))
+    ))
+    movements = []
+    for order_item_id, product_id, quantity, order_number in items:
+        if order_item_id is not None:
+            quantity = min(quantity, sold.get(order_item_id, 0) - restocked[order_item_id])
+            restocked[order_item_id] += max(quantity, 0)
+        if quantity > 0:
+            movements.append((product_id, 'return', quantity, order_number))
+    return inventory.add(movements)
+
+
+def _settle(results):
+    """Write the outcome of a batch of gateway calls"""
+    now = timezone.now()
+    done = {request.id: (request, refund) for request, refund, error in results if refund}
+    retry = [request.id for request, _, error in results if error and (
+        isinstance(error, CircuitOpen)
+        or error.retryable and request.attempts < settings.REFUND_MAX_ATTEMPTS
+    )]
+    failed = {request.id: error for request, _, error in results if error and request.id not in retry}
+
+    with transaction.atomic():
+        _restock([request.id for request, _ in done.values() if request.restock])
+
+        RefundRequest.objects.filter(id__in=list(done)).update(
+            status='processed', processed_at=now, last_error='', updated_at=now
+        )
+        transactions = list(PaymentTransaction.objects.filter(
+            gateway=get_gateway().name, gateway_transaction_id__in=[_key(request_id) for request_id in done]
+        ))
+        for row in transactions:
+            request, refund = done[int(row.gateway_transaction_id.rsplit('-', 1)[1])]
+            row.gateway_transaction_id = refund['id']
+            row.status = 'completed'
+            row.processed_at = now
+            row.updated_at = now
+        PaymentTransaction.objects.bulk_update(
+            transactions, ['gateway_transaction_id', 'status', 'processed_at', 'updated_at']
+        )
+
+        for request, _, error in results:
+            if isinstance(error, CircuitOpen):
+                # Not the request's fault: wait for the breaker without using up an attempt
+                RefundRequest.objects.filter(id=request.id).update(
+                    status='approved', last_error=str(error), attempts=F('attempts') - 1,
+                    available_at=now + timedelta(seconds=error.retry_after), updated_at=now
+                )
+            elif request.id in retry:
+                RefundRequest.objects.filter(id=request.id).update(
+                    status='approved', last_error=str(error),
+                    available_at=now + timedelta(seconds=2 ** request.attempts), updated_at=now
+                )
+            elif request.id in failed:
+                RefundRequest.objects.filter(id=request.id).update(
+                    status='failed', last_error=str(error), updated_at=now
+                )
+        PaymentTransaction.objects.filter(
+            gateway=get_gateway().name, gateway_transaction_id__in=[_key(request_id) for request_id in failed]
+        ).update(status='failed', processed_at=now, updated_at=now)
+
+    for request_id, error in failed.items():
+        logger.error(f'Refund request {request_id} failed: {error}')
+    return len(done)
+
+
+def process_batch(batch_size=100, workers=1):
+    """Claim and refund one batch; returns the number of requests claimed"""
+    if get_gateway().breaker.retry_after():
+        return 0
+    requests = claim(batch_size)
+    if not requests:
+        return 0
+    # The gateway calls need no database connection, so threads are enough
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(_issue, requests))
+    _settle(results)
+    return len(requests)
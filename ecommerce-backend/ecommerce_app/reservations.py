@@ -0,0 +1,146 @@
+"""
+Checkout stock reservations.
+
+A hold keeps units of a product aside for one user for ``STOCK_HOLD_TTL``
+seconds. Placing it takes the units off the stock with the same conditional
+UPDATE a sale uses (``inventory.take``), on one random shard for hot
+products, so concurrent holds and sales of a product can never cover more
+units than are on hand and hot products are never locked. Releasing a hold
+puts its units back; checkout releases the buyer's holds and takes their
+units again in the same transaction. Holds past their expiry are released by
+the ``release_expired_holds`` command, or as soon as a hold or checkout of
+their product comes up short. The held total of each product is kept over
+``STOCK_HOLD_BUCKETS`` counter rows so concurrent holds update different rows.
+"""
+import random
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+
+from . import inventory
+from .inventory import InsufficientStock, record
+from .models import StockHold, StockHoldBucket
+
+
+def hold_ttl():
+    return timedelta(seconds=settings.STOCK_HOLD_TTL)
+
+
+def available_stock(product, exclude_user=None):
+    """Units ``exclude_user`` could buy: those on hand, plus their own holds and expired ones"""
+    reclaimable = Q(expires_at__lte=timezone.now())
+    if exclude_user is not None:
+        reclaimable |= Q(user=exclude_user)
+    held = StockHold.objects.filter(reclaimable, product=product).aggregate(total=Sum('quantity'))['total']
+    return inventory.on_hand([product])[product.id] + (held or 0)
+
+
+def take(quantities, products):
+    """``inventory.take``, releasing the expired holds of the products and retrying once when it comes up short"""
+    try:
+        with transaction.atomic():
+            inventory.take(quantities, products)
+    except InsufficientStock:
+        if not release_expired(product_ids=list(quantities)):
+            raise
+        inventory.take(quantities, products)
+
+
+def _add_to_bucket(product_id, bucket, quantity):
+    updated = StockHoldBucket.objects.filter(
+        product_id=product_id, bucket=bucket
+    ).update(quantity=F('quantity') + quantity)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            StockHoldBucket.objects.create(product_id=product_id, bucket=bucket, quantity=quantity)
+    except IntegrityError:
+        # Another checkout created the bucket first
+        StockHoldBucket.objects.filter(
+            product_id=product_id, bucket=bucket
+        ).update(quantity=F('quantity') + quantity)
+
+
+def _release(holds):
+    """Put the units of ``holds`` back on sale, take them out of their buckets and delete them"""
+    if not holds:
+        return 0
+    totals = defaultdict(int)
+    units = defaultdict(int)
+    for hold in holds:
+        totals[(hold.product_id, hold.bucket)] += hold.quantity
+        units[hold.product_id] += hold.quantity
+    # One UPDATE for every touched bucket
+    matches = Q()
+    whens = []
+    for (product_id, bucket), quantity in sorted(totals.items()):
+        matches |= Q(product_id=product_id, bucket=bucket)
+        whens.append(When(product_id=product_id, bucket=bucket, then=Value(quantity)))
+    StockHoldBucket.objects.filter(matches).update(
+        quantity=F('quantity') - Case(*whens, output_field=IntegerField())
+    )
+    StockHold.objects.filter(id__in=[hold.id for hold in holds]).delete()
+    inventory.put_back(units)
+    record((hold.product_id, 'release', hold.quantity, f'hold {hold.id}') for hold in holds)
+    return len(holds)
+
+
+def release_user_holds(user):
+    with transaction.atomic():
+        holds = list(StockHold.objects.select_for_update().filter(user=user))
+        return _release(holds)
+
+
+def reserve_cart(cart):
+    """Replace the cart owner's holds with holds covering the cart.
+
+    Raises ``InsufficientStock`` (rolling back every hold placed so far) when
+    a product cannot cover its line.
+    """
+    user = cart.user
+    expires_at = timezone.now() + hold_ttl()
+    buckets = settings.STOCK_HOLD_BUCKETS
+
+    with transaction.atomic():
+        quantities = defaultdict(int)
+        for product_id, quantity in cart.items.values_list('product_id', 'quantity'):
+            quantities[product_id] += quantity
+        products = inventory.lock(quantities)
+        release_user_holds(user)
+        take(quantities, products)
+
+        holds = []
+        for product_id in sorted(quantities):
+            bucket = random.randrange(buckets)
+            _add_to_bucket(product_id, bucket, quantities[product_id])
+            holds.append(StockHold(
+                user=user,
+                product_id=product_id,
+                quantity=quantities[product_id],
+                bucket=bucket,
+                expires_at=expires_at,
+            ))
+        StockHold.objects.bulk_create(holds)
+        record((hold.product_id, 'reservation', -hold.quantity, f'hold {hold.id}') for hold in holds)
+
+    return holds, expires_at
+
+
+def release_expired(batch_size=1000, now=None, product_ids=None):
+    """Release holds past their expiry (of ``product_ids`` only, if given), ``batch_size`` rows per transaction"""
+    now = now or timezone.now()
+    expired = StockHold.objects.select_for_update(skip_locked=True).filter(expires_at__lte=now)
+    if product_ids is not None:
+        expired = expired.filter(product_id__in=product_ids)
+    released = 0
+    while True:
+        with transaction.atomic():
+            holds = list(expired.order_by('id')[:batch_size])
+            released += _release(holds)
+        if len(holds) < batch_size:
+            return released
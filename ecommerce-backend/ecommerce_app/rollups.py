@@ -0,0 +1,172 @@
+"""
+Hourly and daily sales rollups.
+
+An order counts as a sale while it is processing, shipped or delivered.
+``record_transition`` is called by ``order_status`` in the same transaction as
+every status change and adds (or, on cancellation, subtracts) the orders it
+moved, bucketed by the hour and day they were placed. Reports then read
+``SalesRollup`` and ``ProductSalesRollup`` instead of scanning orders.
+``rebuild`` recomputes a date range from scratch for backfills.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Count, DecimalField, F, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .archive import unpack
+from .models import ArchivedOrder, Order, OrderItem, Product, ProductSalesRollup, SalesRollup
+
+COUNTED = {'processing', 'shipped', 'delivered'}
+
+TRUNCATE = {
+    'hour': TruncHour,
+    'day': TruncDay,
+}
+
+
+def _upsert(model, key_columns, counters, rows):
+    """Add ``rows`` (dicts of column values, unique on ``key_columns``) onto the matching rollup rows.
+
+    A single multi-row INSERT ... ON CONFLICT DO UPDATE, which both PostgreSQL
+    and SQLite understand, split only where the database limits the number of
+    query parameters; ``counters`` are incremented, other columns overwritten.
+    """
+    if not rows:
+        return
+    q = connection.ops.quote_name
+    columns = list(rows[0])
+    table = q(model._meta.db_table)
+    assignments = [
+        f'{q(c)} = {table}.{q(c)} + EXCLUDED.{q(c)}' if c in counters else f'{q(c)} = EXCLUDED.{q(c)}'
+        for c in columns if c not in key_columns
+    ]
+    placeholders = f'({", ".join(["%s"] * len(columns))})'
+    fields = {field.column: field for field in model._meta.concrete_fields}
+    max_params = connection.features.max_query_params
+    batch_size = max(1, max_params // len(columns)) if max_params else len(rows)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cursor.execute(
+                f'INSERT INTO {table} ({", ".join(q(c) for c in columns)}) '
+                f'VALUES {", ".join([placeholders] * len(batch))} '
+                f'ON CONFLICT ({", ".join(q(c) for c in key_columns)}) DO UPDATE SET {", ".join(assignments)}',
+                [fields[column].get_db_prep_save(row[column], connection) for row in batch for column in columns]
+            )
+
+
+def _add(orders, items, sign=1):
+    """Fold aggregated order and item rows into the rollup tables"""
+    _upsert(SalesRollup, ['period', 'period_start'], ['order_count', 'units', 'revenue'], [
+        {
+            'period': row['period'],
+            'period_start': row['period_start'],
+            'order_count': sign * row['order_count'],
+            'units': sign * (row['units'] or 0),
+            'revenue': sign * (row['revenue'] or Decimal('0.00')),
+        }
+        for row in orders
+    ])
+    _upsert(ProductSalesRollup, ['period', 'period_start', 'product_id'], ['units', 'revenue'], [
+        {
+            'period': row['period'],
+            'period_start': row['period_start'],
+            'product_id': row['product_id'],
+            'category_id': row['product__category_id'],
+            'units': sign * row['units'],
+            'revenue': sign * row['revenue'],
+        }
+        for row in items
+    ])
+
+
+def _aggregate(orders):
+    """Per-period totals for the ``orders`` queryset, computed in the database"""
+    order_rows, item_rows = [], []
+    for period, trunc in TRUNCATE.items():
+        for row in (
+            orders.annotate(period_start=trunc('created_at'))
+            .values('period_start')
+            .annotate(order_count=Count('id'), units=Sum('item_count'), revenue=Sum('total_amount'))
+            .order_by()
+        ):
+            order_rows.append({'period': period, **row})
+        for row in (
+            OrderItem.objects.filter(order__in=orders)
+            .annotate(period_start=trunc('order__created_at'))
+            .values('period_start', 'product_id', 'product__category_id')
+            .annotate(
+                units=Sum('quantity'),
+                revenue=Sum(F('quantity') * F('price'), output_field=DecimalField(max_digits=14, decimal_places=2))
+            )
+            .order_by()
+        ):
+            item_rows.append({'period': period, **row})
+    return order_rows, item_rows
+
+
+def record_transition(orders, to_status):
+    """Update the rollups for the locked ``(id, from_status)`` pairs moved to ``to_status``"""
+    if to_status in COUNTED:
+        ids, sign = [order_id for order_id, from_status in orders if from_status not in COUNTED], 1
+    else:
+        ids, sign = [order_id for order_id, from_status in orders if from_status in COUNTED], -1
+    if ids:
+        _add(*_aggregate(Order.objects.filter(id__in=ids)), sign=sign)
+
+
+def _truncate(value, period):
+    value = timezone.localtime(value).replace(minute=0, second=0, microsecond=0)
+    return value.replace(hour=0) if period == 'day' else value
+
+
+def _aggregate_archived(archived_orders):
+    """Same as ``_aggregate`` for archived orders, whose items are packed JSON"""
+    totals = defaultdict(lambda: {'order_count': 0, 'units': 0, 'revenue': Decimal('0.00')})
+    lines = defaultdict(lambda: {'units': 0, 'revenue': Decimal('0.00')})
+    categories = {}
+    for archived in archived_orders.iterator(chunk_size=1000):
+        items = unpack(archived)['items']
+        for period in TRUNCATE:
+            period_start = _truncate(archived.created_at, period)
+            total = totals[period, period_start]
+            total['order_count'] += 1
+            total['units'] += archived.item_count
+            total['revenue'] += archived.total_amount
+            for item in items:
+                line = lines[period, period_start, item['product']]
+                line['units'] += item['quantity']
+                line['revenue'] += Decimal(item['price']) * item['quantity']
+                categories[item['product']] = None
+
+    # Archived lines are attributed to their product's current category
+    categories.update(
+        Product.objects.filter(id__in=list(categories)).values_list('id', 'category_id')
+    )
+    order_rows = [
+        {'period': period, 'period_start': period_start, **total}
+        for (period, period_start), total in totals.items()
+    ]
+    item_rows = [
+        {
+            'period': period, 'period_start': period_start, 'product_id': product_id,
+            'product__category_id': categories[product_id], **line
+        }
+        for (period, period_start, product_id), line in lines.items()
+        if categories[product_id] is not None
+    ]
+    return order_rows, item_rows
+
+
+def rebuild(start, end):
+    """Recompute the rollups for orders placed in whole days ``start`` <= day < ``end``"""
+    start, end = _truncate(start, 'day'), _truncate(end, 'day')
+    for model in (SalesRollup, ProductSalesRollup):
+        model.objects.filter(period_start__gte=start, period_start__lt=end).delete()
+
+    window = {'created_at__gte': start, 'created_at__lt': end}
+    _add(*_aggregate(Order.objects.filter(status__in=COUNTED, **window)))
+    _add(*_aggregate_archived(ArchivedOrder.objects.filter(status__in=COUNTED, **window)))
@@ -1,8 +1,14 @@
+from collections import defaultdict
+from decimal import Decimal
 from rest_framework import serializers
-from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
-from .models import User, Category, Product, Cart, CartItem, Order, OrderItem
+from django.db import transaction
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from .models import User, Category, Product, ProductVariant, Cart, CartItem, Order, OrderItem, ArchivedOrder, RefundRequest, RefundRequestItem, SalesRollup, FlashSaleTicket
+from .archive import unpack
+from . import flash_sales
+from .authentication import RotatingRefreshToken
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -17,12 +23,29 @@ class ProductSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Product
+        # Variant products are described by their stored aggregates; no variant rows are read
         fields = [
             'id', 'name', 'description', 'price', 'category', 'category_name',
-            'image', 'stock', 'is_active', 'is_in_stock', 'created_at', 'updated_at'
+            'image', 'stock', 'is_active', 'is_in_stock', 'variant_count',
+            'min_price', 'max_price', 'variant_stock', 'created_at', 'updated_at'
         ]
 
 
+class ProductVariantSerializer(serializers.ModelSerializer):
+    effective_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = ProductVariant
+        fields = ['id', 'name', 'sku', 'price', 'effective_price', 'stock']
+
+
+class ProductDetailSerializer(ProductSerializer):
+    variants = ProductVariantSerializer(many=True, read_only=True)
+
+    class Meta(ProductSerializer.Meta):
+        fields = ProductSerializer.Meta.fields + ['variants']
+
+
 class CartItemSerializer(serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_id = serializers.IntegerField(write_only=True)
@@ -79,11 +102,137 @@ class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = [
-            'id', 'user', 'user_email', 'status', 'total_amount', 'created_at',
-            'updated_at', 'is_paid', 'stripe_payment_intent', 'shipping_address',
-            'shipping_city', 'shipping_postal_code', 'shipping_country', 'items'
+            'id', 'order_number', 'user', 'user_email', 'status', 'total_amount',
+            'created_at', 'updated_at', 'is_paid', 'stripe_payment_intent',
+            'shipping_address', 'shipping_city', 'shipping_postal_code',
+            'shipping_country', 'items'
+        ]
+        # Status and payment only change through ecommerce_app.order_status
+        read_only_fields = ['order_number', 'user', 'status', 'total_amount', 'is_paid', 'stripe_payment_intent']
+
+
+class OrderSummarySerializer(serializers.ModelSerializer):
+    """Order history row; no nested items"""
+
+    class Meta:
+        model = Order
+        fields = [
+            'id', 'order_number', 'created_at', 'status', 'total_amount',
+            'is_paid', 'item_count'
+        ]
+        read_only_fields = fields
+
+
+class ArchivedOrderSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchivedOrder
+        fields = OrderSummarySerializer.Meta.fields
+        read_only_fields = fields
+
+
+class ArchivedOrderSerializer(serializers.ModelSerializer):
+    """Renders an archived order in the same shape as OrderSerializer"""
+    user_email = serializers.CharField(source='user.email', read_only=True)
+
+    class Meta:
+        model = ArchivedOrder
+        fields = [
+            'id', 'order_number', 'user', 'user_email', 'status', 'total_amount',
+            'created_at', 'updated_at', 'is_paid'
+        ]
+        read_only_fields = fields
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data.update(unpack(instance))
+        # Kept for audit; live orders do not show it either
+        data.pop('status_history', None)
+        for item in data['items']:
+            # Stored as a string; rendered like OrderItem.total_price
+            item['total_price'] = Decimal(str(item['total_price']))
+        return data
+
+
+class BulkOrderStatusSerializer(serializers.Serializer):
+    order_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=50000)
+    status = serializers.ChoiceField(choices=Order.STATUS_CHOICES)
+    notes = serializers.CharField(required=False, allow_blank=True, default='')
+
+
+class RefundRequestItemSerializer(serializers.ModelSerializer):
+    quantity = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = RefundRequestItem
+        fields = ['order_item', 'product', 'quantity']
+        read_only_fields = ['product']
+
+
+class RefundRequestSerializer(serializers.ModelSerializer):
+    # The lines being sent back, restocked if the refund is approved with restock
+    items = RefundRequestItemSerializer(many=True, required=False)
+
+    class Meta:
+        model = RefundRequest
+        fields = [
+            'id', 'order', 'order_number', 'amount_requested', 'reason', 'description', 'items',
+            'status', 'restock', 'admin_notes', 'created_at', 'processed_at'
         ]
-        read_only_fields = ['user', 'total_amount', 'stripe_payment_intent']
+        read_only_fields = ['order_number', 'status', 'restock', 'admin_notes', 'created_at', 'processed_at']
+
+    def validate_order(self, order):
+        if order.user_id != self.context['request'].user.id:
+            raise serializers.ValidationError('Order not found')
+        if not order.is_paid:
+            raise serializers.ValidationError('Only paid orders can be refunded')
+        return order
+
+    def validate(self, data):
+        if not 0 < data['amount_requested'] <= data['order'].total_amount:
+            raise serializers.ValidationError('amount_requested must be positive and at most the order total')
+        returned = defaultdict(int)
+        for item in data.get('items', []):
+            order_item = item['order_item']
+            if order_item.order_id != data['order'].id:
+                raise serializers.ValidationError({'items': 'Order item not found in this order'})
+            returned[order_item.id] += item['quantity']
+            if returned[order_item.id] > order_item.quantity:
+                raise serializers.ValidationError({'items': 'quantity is more than was ordered'})
+        return data
+
+    def create(self, validated_data):
+        items = validated_data.pop('items', [])
+        validated_data['order_number'] = validated_data['order'].order_number
+        validated_data['user'] = self.context['request'].user
+        with transaction.atomic():
+            refund_request = super().create(validated_data)
+            RefundRequestItem.objects.bulk_create([
+                RefundRequestItem(
+                    refund_request=refund_request, order_item=item['order_item'],
+                    product_id=item['order_item'].product_id, quantity=item['quantity']
+                )
+                for item in items
+            ])
+        return refund_request
+
+
+class BulkRefundReviewSerializer(serializers.Serializer):
+    request_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=50000)
+    notes = serializers.CharField(required=False, allow_blank=True, default='')
+    # Approving only: the goods were returned and go back on sale
+    restock = serializers.BooleanField(required=False, default=False)
+
+
+class SalesReportQuerySerializer(serializers.Serializer):
+    period = serializers.ChoiceField(choices=SalesRollup.PERIOD_CHOICES, default='day')
+    start = serializers.DateField()
+    end = serializers.DateField()
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+    def validate(self, data):
+        if data['start'] > data['end']:
+            raise serializers.ValidationError('start must not be after end')
+        return data
 
 
 class CreateOrderSerializer(serializers.Serializer):
@@ -125,7 +274,7 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         }
 
     def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
+        if User.objects.filter(email__iexact=value).exists():
             raise serializers.ValidationError("A user with this email already exists.")
         return value
 
@@ -145,35 +294,28 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         validated_data.pop('password_confirm')
-        user = User.objects.create_user(**validated_data)
+        # UserRegistrationView hashes the password in the hashing pool and passes the result in
+        encoded_password = validated_data.pop('encoded_password', None)
+        if encoded_password:
+            validated_data.pop('password')
+            email = User.objects.normalize_email(validated_data.pop('email'))
+            user = User.objects.create(email=email, password=encoded_password, **validated_data)
+        else:
+            user = User.objects.create_user(**validated_data)
         # Create cart for new user
         Cart.objects.create(user=user)
         return user
 
 
 class UserLoginSerializer(serializers.Serializer):
+    """Login fields; the login views check the credentials with passwords.authenticate"""
     email = serializers.EmailField()
     password = serializers.CharField(style={'input_type': 'password'})
 
-    def validate(self, data):
-        email = data.get('email')
-        password = data.get('password')
-
-        if email and password:
-            user = authenticate(request=self.context.get('request'),
-                              username=email, password=password)
-            
-            if not user:
-                raise serializers.ValidationError('Invalid email or password.')
-            
-            if not user.is_active:
-                raise serializers.ValidationError('User account is disabled.')
-            
-            data['user'] = user
-        else:
-            raise serializers.ValidationError('Must include "email" and "password".')
-        
-        return data
+
+class RotatingTokenRefreshSerializer(TokenRefreshSerializer):
+    """Refresh that revokes the spent refresh token, so each can be used once"""
+    token_class = RotatingRefreshToken
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -196,3 +338,24 @@ class UserProfileUpdateSerializer(serializers.ModelSerializer):
             'first_name', 'last_name', 'phone_number', 'date_of_birth',
             'address', 'city', 'state', 'postal_code', 'country'
         ]
+
+
+class FlashSaleTicketSerializer(serializers.ModelSerializer):
+    product_id = serializers.IntegerField(source='sale.product_id', read_only=True)
+    status = serializers.SerializerMethodField()
+    ahead = serializers.SerializerMethodField()
+    estimated_wait = serializers.SerializerMethodField()
+
+    class Meta:
+        model = FlashSaleTicket
+        fields = ['token', 'product_id', 'status', 'position', 'ahead', 'estimated_wait', 'expires_at']
+
+    def get_status(self, obj):
+        return flash_sales.ticket_status(obj)
+
+    def get_ahead(self, obj):
+        return flash_sales.ahead(obj)
+
+    def get_estimated_wait(self, obj):
+        """Seconds until admission at the sale's admission rate"""
+        return -(-flash_sales.ahead(obj) // max(1, obj.sale.admit_rate))
@@ -0,0 +1,85 @@
+"""
+Low-stock digests.
+
+``Product.low_stock_since`` is kept current by the same UPDATEs that change
+stock (see ``inventory``), and the ``low_stock_idx`` partial index covers only
+the products where it is set, so digests are built without reading the rest
+of the catalogue. Each run reports the active products that ran low since the
+previous run (the last ``LowStockDigest.cutoff``), grouped by category: one
+email per category to its buyer and to ``LOW_STOCK_ALERT_EMAILS``. The cutoff
+trails the clock by ``LOW_STOCK_DIGEST_DELAY`` seconds: a flag is stamped when
+its transaction writes it, not when it commits, so one committed just after a
+run could otherwise carry a time before that run's cutoff and be skipped.
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Category, LowStockDigest, Product
+
+# Products listed per category email; the rest are only counted
+MAX_LINES = 200
+
+
+def _body(category, products, new, low):
+    lines = [
+        f'{new} products in {category.name} ran low on stock since the last digest '
+        f'({low} are low in total).',
+        '',
+    ]
+    lines.extend(
+        f'- {product.name} (#{product.id}): {product.stock} left, minimum {product.min_stock_level}, '
+        f'low since {timezone.localtime(product.low_stock_since):%Y-%m-%d %H:%M}'
+        for product in products
+    )
+    if new > len(products):
+        lines.append(f'... and {new - len(products)} more')
+    return '\n'.join(lines)
+
+
+def send_digests():
+    """Email the products that ran low since the last digest; returns the LowStockDigest recorded"""
+    cutoff = timezone.now() - timedelta(seconds=settings.LOW_STOCK_DIGEST_DELAY)
+    last = LowStockDigest.objects.values_list('cutoff', flat=True).first()
+    crossed = Product.objects.filter(is_active=True, low_stock_since__isnull=False, low_stock_since__lte=cutoff)
+    if last:
+        crossed = crossed.filter(low_stock_since__gt=last)
+
+    listed = defaultdict(list)
+    new = Counter()
+    for product in (
+        crossed.only('id', 'name', 'category_id', 'stock', 'min_stock_level', 'low_stock_since')
+        .order_by('category_id', 'low_stock_since')
+        .iterator(chunk_size=2000)
+    ):
+        new[product.category_id] += 1
+        if len(listed[product.category_id]) < MAX_LINES:
+            listed[product.category_id].append(product)
+
+    low = dict(
+        Product.objects.filter(is_active=True, low_stock_since__isnull=False, category_id__in=list(new))
+        .values_list('category_id')
+        .annotate(count=Count('id'))
+    )
+    messages = []
+    for category in Category.objects.filter(id__in=list(new)).order_by('name'):
+        recipients = [email for email in [category.buyer_email, *settings.LOW_STOCK_ALERT_EMAILS] if email]
+        if not recipients:
+            continue
+        messages.append(EmailMessage(
+            subject=f'Low stock in {category.name}: {new[category.id]} products',
+            body=_body(category, listed[category.id], new[category.id], low.get(category.id, 0)),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=sorted(set(recipients)),
+        ))
+    if messages:
+        # One connection for the whole run
+        get_connection().send_messages(messages)
+
+    return LowStockDigest.objects.create(
+        cutoff=cutoff, categories=len(messages), products=sum(new.values())
+    )
@@ -1,3 +1,515 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import transaction
+from django.core import mail
+from django.db.models import F, Sum
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import checkout, flash_sales, gateways, idempotency, inventory, refunds, reservations, stock_alerts
+from .inventory import InsufficientStock
+from .models import (
+    Cart, CartItem, Category, FlashSale, FlashSaleTicket, IdempotencyKey, LowStockDigest, Order, Product,
+    RefundRequest, RefundRequestItem, StockHold, StockHoldBucket, StockMovement, User
+)
+
+SHIPPING = {
+    'shipping_address': '1 Main St',
+    'shipping_city': 'Springfield',
+    'shipping_postal_code': '12345',
+    'shipping_country': 'USA',
+}
+
+
+class ShopTestCase(TestCase):
+    """A user with an empty cart and a category to add products to"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer@example.com', 'pw', first_name='Buy', last_name='Er')
+        self.cart = Cart.objects.create(user=self.user)
+        self.category = Category.objects.create(name='Gadgets')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_product(self, stock, price='10.00', shard_count=0, **fields):
+        product = Product.objects.create(name=f'Product {Product.objects.count()}', price=Decimal(price),
+                                         category=self.category, **fields)
+        inventory.adjust(product.id, 'receipt', stock)
+        if shard_count:
+            inventory.compact(product.id, shard_count=shard_count)
+        product.refresh_from_db()
+        return product
+
+    def make_buyer(self, email):
+        user = User.objects.create_user(email, 'pw', first_name='Other', last_name='Buyer')
+        return user, Cart.objects.create(user=user)
+
+    def add_to_cart(self, product, quantity, cart=None):
+        return CartItem.objects.create(cart=cart or self.cart, product=product, quantity=quantity)
+
+    def place_order(self, cart=None):
+        with transaction.atomic():
+            return checkout.place_order(cart or self.cart, SHIPPING)
+
+    def on_hand(self, product):
+        product.refresh_from_db()
+        return inventory.on_hand([product])[product.id]
+
+    def assertLedgerBalanced(self, *products):
+        for product in products:
+            product.refresh_from_db()
+        self.assertEqual(inventory.audit(products), [])
+
+
+class CheckoutTests(ShopTestCase):
+    def test_decrements_stock_and_records_sales(self):
+        first, second = self.make_product(5), self.make_product(8, price='2.50')
+        self.add_to_cart(first, 2)
+        self.add_to_cart(second, 3)
+
+        order = self.place_order()
+
+        self.assertEqual((self.on_hand(first), self.on_hand(second)), (3, 5))
+        self.assertEqual(order.total_amount, Decimal('27.50'))
+        self.assertEqual(order.item_count, 5)
+        self.assertEqual(
+            sorted(order.items.values_list('product_id', 'quantity')), [(first.id, 2), (second.id, 3)]
+        )
+        self.assertEqual(
+            StockMovement.objects.filter(kind='sale', reference=order.order_number).count(), 2
+        )
+        self.assertLedgerBalanced(first, second)
+
+    def test_insufficient_stock_changes_nothing(self):
+        plenty, scarce = self.make_product(5), self.make_product(1)
+        self.add_to_cart(plenty, 2)
+        self.add_to_cart(scarce, 2)
+
+        with self.assertRaises(InsufficientStock) as raised:
+            self.place_order()
+
+        self.assertEqual(raised.exception.product.id, scarce.id)
+        self.assertEqual((self.on_hand(plenty), self.on_hand(scarce)), (5, 1))
+        self.assertFalse(Order.objects.exists())
+        self.assertLedgerBalanced(plenty, scarce)
+
+    def test_sharded_product_takes_from_its_shards(self):
+        hot = self.make_product(8, shard_count=4)
+        self.add_to_cart(hot, 2)
+        self.place_order()
+
+        self.assertEqual(self.on_hand(hot), 6)
+        self.assertLedgerBalanced(hot)
+
+    def test_sharded_product_cannot_oversell(self):
+        hot = self.make_product(3, shard_count=4)
+        self.add_to_cart(hot, 4)
+
+        with self.assertRaises(InsufficientStock):
+            self.place_order()
+        self.assertEqual(self.on_hand(hot), 3)
+
+    def test_empty_cart(self):
+        with self.assertRaises(checkout.EmptyCart):
+            self.place_order()
+
+    def test_create_order_endpoint(self):
+        product = self.make_product(1)
+        self.add_to_cart(product, 2)
+
+        response = self.client.post('/api/orders/create_order/', SHIPPING, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.cart.items.count(), 1)
+
+        self.cart.items.update(quantity=1)
+        response = self.client.post('/api/orders/create_order/', SHIPPING, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(self.on_hand(product), 0)
+        self.assertFalse(self.cart.items.exists())
+
+
+class StockHoldTests(ShopTestCase):
+    def held(self, product):
+        return StockHold.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+
+    def bucketed(self, product):
+        return StockHoldBucket.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+
+    def expire_holds(self):
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_hold_takes_units_off_sale(self):
+        product = self.make_product(5)
+        self.add_to_cart(product, 3)
+
+        holds, expires_at = reservations.reserve_cart(self.cart)
+
+        self.assertEqual([(hold.product_id, hold.quantity) for hold in holds], [(product.id, 3)])
+        self.assertGreater(expires_at, timezone.now())
+        self.assertEqual(self.on_hand(product), 2)
+        self.assertEqual((self.held(product), self.bucketed(product)), (3, 3))
+        self.assertEqual(reservations.available_stock(product), 2)
+        self.assertEqual(reservations.available_stock(product, exclude_user=self.user), 5)
+        self.assertLedgerBalanced(product)
+
+    def test_reserving_again_replaces_the_holds(self):
+        product = self.make_product(5)
+        item = self.add_to_cart(product, 3)
+        reservations.reserve_cart(self.cart)
+        item.quantity = 4
+        item.save()
+
+        reservations.reserve_cart(self.cart)
+
+        self.assertEqual(self.on_hand(product), 1)
+        self.assertEqual((self.held(product), self.bucketed(product)), (4, 4))
+        self.assertLedgerBalanced(product)
+
+    def test_held_units_cannot_be_bought_by_others(self):
+        product = self.make_product(5, shard_count=2)
+        self.add_to_cart(product, 4)
+        reservations.reserve_cart(self.cart)
+        other, other_cart = self.make_buyer('other@example.com')
+        self.add_to_cart(product, 2, cart=other_cart)
+
+        with self.assertRaises(InsufficientStock):
+            reservations.reserve_cart(other_cart)
+        with self.assertRaises(InsufficientStock):
+            self.place_order(other_cart)
+        self.assertEqual(self.on_hand(product), 1)
+
+        # The holder's checkout turns their hold into the sale
+        self.place_order()
+        self.assertEqual(self.on_hand(product), 1)
+        self.assertEqual((self.held(product), self.bucketed(product)), (0, 0))
+        self.assertLedgerBalanced(product)
+
+    def test_release_expired(self):
+        product = self.make_product(5)
+        self.add_to_cart(product, 3)
+        reservations.reserve_cart(self.cart)
+
+        self.assertEqual(reservations.release_expired(), 0)
+        self.expire_holds()
+        self.assertEqual(reservations.release_expired(), 1)
+
+        self.assertEqual(self.on_hand(product), 5)
+        self.assertEqual((self.held(product), self.bucketed(product)), (0, 0))
+        self.assertLedgerBalanced(product)
+
+    def test_checkout_reclaims_expired_holds(self):
+        product = self.make_product(5, shard_count=2)
+        self.add_to_cart(product, 4)
+        reservations.reserve_cart(self.cart)
+        self.expire_holds()
+        other, other_cart = self.make_buyer('other@example.com')
+        self.add_to_cart(product, 3, cart=other_cart)
+
+        self.place_order(other_cart)
+
+        self.assertEqual(self.on_hand(product), 2)
+        self.assertFalse(StockHold.objects.exists())
+        self.assertLedgerBalanced(product)
+
+    def test_clearing_the_cart_releases_its_holds(self):
+        product = self.make_product(5)
+        self.add_to_cart(product, 3)
+        self.assertEqual(self.client.post('/api/cart/reserve/').status_code, 201)
+        self.assertEqual(self.on_hand(product), 2)
+
+        self.assertEqual(self.client.delete('/api/cart/clear/').status_code, 200)
+        self.assertEqual(self.on_hand(product), 5)
+        self.assertLedgerBalanced(product)
+
+
+class IdempotencyKeyTests(ShopTestCase):
+    url = '/api/orders/create_order/'
+
+    def create_order(self, key, data=SHIPPING):
+        return self.client.post(self.url, data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replays_the_first_response(self):
+        product = self.make_product(5)
+        self.add_to_cart(product, 2)
+
+        first = self.create_order('order-1')
+        self.assertEqual(first.status_code, 201, first.data)
+        self.add_to_cart(product, 1)
+        replayed = self.create_order('order-1')
+        # Once the cache has lost it, the stored row still answers
+        cache.clear()
+        from_db = self.create_order('order-1')
+
+        for response in (replayed, from_db):
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response['Idempotent-Replayed'], 'true')
+            self.assertEqual(response.json()['order_id'], first.data['order_id'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.on_hand(product), 3)
+
+    def test_key_reused_for_another_request(self):
+        self.add_to_cart(self.make_product(5), 1)
+        self.assertEqual(self.create_order('order-1').status_code, 201)
+
+        response = self.create_order('order-1', {**SHIPPING, 'shipping_city': 'Shelbyville'})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0)
+    def test_request_still_in_flight(self):
+        self.add_to_cart(self.make_product(5), 1)
+        IdempotencyKey.objects.create(
+            user=self.user,
+            key_hash=idempotency._digest(f'{self.url}\norder-1'),
+            request_hash=idempotency._digest('{}'),
+            expires_at=timezone.now() + timedelta(minutes=5),
+        )
+
+        response = self.create_order('order-1')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Order.objects.exists())
+
+    def test_stock_conflicts_are_not_stored(self):
+        product = self.make_product(1)
+        self.add_to_cart(product, 2)
+        self.assertEqual(self.create_order('order-1').status_code, 409)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        inventory.adjust(product.id, 'receipt', 1)
+        response = self.create_order('order-1')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+
+@override_settings(PAYMENT_GATEWAY='fake', FAKE_GATEWAY_FAILURE_RATE=0)
+class RefundRestockTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        gateways._gateway = None
+        self.shirt, self.mug = self.make_product(10), self.make_product(10, price='5.00', shard_count=2)
+        self.add_to_cart(self.shirt, 3)
+        self.add_to_cart(self.mug, 2)
+        self.order = self.place_order()
+        # Refunds are only approved for paid orders
+        Order.objects.filter(id=self.order.id).update(is_paid=True, stripe_payment_intent='pi_fake_refundtest')
+
+    def request_refund(self, amount, returned=()):
+        request = RefundRequest.objects.create(
+            order=self.order, order_number=self.order.order_number, user=self.user,
+            amount_requested=Decimal(amount), reason='other'
+        )
+        RefundRequestItem.objects.bulk_create([
+            RefundRequestItem(
+                refund_request=request, order_item=self.order.items.get(product=product),
+                product=product, quantity=quantity
+            )
+            for product, quantity in returned
+        ])
+        return request
+
+    def refund(self, *requests, restock=True):
+        approved = refunds.approve([request.id for request in requests], restock=restock)
+        refunds.process_batch()
+        return approved
+
+    def test_restocks_the_returned_items(self):
+        request = self.request_refund('20.00', [(self.shirt, 2)])
+
+        self.assertEqual(self.refund(request), [request.id])
+
+        request.refresh_from_db()
+        self.assertEqual(request.status, 'processed')
+        self.assertEqual((self.on_hand(self.shirt), self.on_hand(self.mug)), (9, 8))
+        self.assertEqual(
+            list(StockMovement.objects.filter(kind='return').values_list('product_id', 'quantity')),
+            [(self.shirt.id, 2)]
+        )
+        self.assertLedgerBalanced(self.shirt, self.mug)
+
+    def test_whole_order_refund_restocks_every_line(self):
+        request = self.request_refund('40.00')
+
+        self.assertEqual(self.refund(request), [request.id])
+
+        self.assertEqual((self.on_hand(self.shirt), self.on_hand(self.mug)), (10, 10))
+        self.assertLedgerBalanced(self.shirt, self.mug)
+
+    def test_partial_refund_without_items_is_not_restocked(self):
+        request = self.request_refund('10.00')
+
+        self.assertEqual(self.refund(request), [])
+
+        request.refresh_from_db()
+        self.assertEqual(request.status, 'pending')
+        self.assertEqual((self.on_hand(self.shirt), self.on_hand(self.mug)), (7, 8))
+
+    def test_never_restocks_more_than_was_sold(self):
+        first = self.request_refund('10.00', [(self.shirt, 2)])
+        second = self.request_refund('10.00', [(self.shirt, 2)])
+
+        self.assertEqual(self.refund(first, second), [first.id, second.id])
+
+        self.assertEqual(self.on_hand(self.shirt), 10)
+        self.assertLedgerBalanced(self.shirt)
+
+    def test_refund_without_restock(self):
+        request = self.request_refund('20.00', [(self.shirt, 2)])
+
+        self.assertEqual(self.refund(request, restock=False), [request.id])
+
+        request.refresh_from_db()
+        self.assertEqual(request.status, 'processed')
+        self.assertEqual(self.on_hand(self.shirt), 7)
+
+
+class FlashSaleAdmissionTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product(3)
+        self.sale = FlashSale.objects.create(product=self.product, admit_rate=2, max_waiting=10)
+
+    def join(self, count):
+        return [
+            flash_sales.join(self.product.id, self.make_buyer(f'fan{n}@example.com')[0])
+            for n in range(count)
+        ]
+
+    def admit(self):
+        # As if the admitter had last run a second ago
+        FlashSale.objects.filter(id=self.sale.id, admitted_at__isnull=False).update(
+            admitted_at=timezone.now() - timedelta(seconds=1)
+        )
+        return flash_sales.admit(self.sale.id)
+
+    def statuses(self):
+        return list(FlashSaleTicket.objects.order_by('position').values_list('status', flat=True))
+
+    def test_join_hands_out_positions_in_order(self):
+        tickets = self.join(3)
+
+        self.assertEqual([ticket.position for ticket in tickets], [1, 2, 3])
+        self.sale.refresh_from_db()
+        self.assertEqual((self.sale.joined, self.sale.admitted), (3, 0))
+        self.assertEqual([flash_sales.ahead(ticket) for ticket in tickets], [0, 1, 2])
+        # Joining again returns the live ticket
+        self.assertEqual(flash_sales.join(self.product.id, tickets[0].user).id, tickets[0].id)
+
+    def test_admits_at_the_admit_rate(self):
+        self.join(3)
+
+        self.assertEqual(self.admit(), 2)
+        self.assertEqual(self.statuses(), ['admitted', 'admitted', 'waiting'])
+        self.assertEqual(self.admit(), 1)
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.admitted, 3)
+
+    def test_never_admits_more_users_than_units(self):
+        FlashSale.objects.filter(id=self.sale.id).update(admit_rate=10)
+        self.join(5)
+
+        self.assertEqual(self.admit(), 3)
+        self.assertEqual(self.admit(), 0)
+        self.assertEqual(self.statuses(), ['admitted'] * 3 + ['waiting'] * 2)
+
+        # A lapsed admission frees its place for the next user in line
+        FlashSaleTicket.objects.filter(position=1).update(expires_at=timezone.now())
+        self.assertEqual(self.admit(), 1)
+        self.assertEqual(self.statuses(), ['expired'] + ['admitted'] * 3 + ['waiting'])
+
+    def test_sold_out(self):
+        self.join(2)
+        inventory.adjust(self.product.id, 'adjustment', -3)
+
+        self.assertEqual(self.admit(), 0)
+        self.assertEqual(self.statuses(), ['sold_out', 'sold_out'])
+        with self.assertRaises(flash_sales.SoldOut):
+            flash_sales.join(self.product.id, self.user)
+
+    def test_queue_full(self):
+        FlashSale.objects.filter(id=self.sale.id).update(max_waiting=2)
+        self.join(2)
+
+        with self.assertRaises(flash_sales.QueueFull):
+            flash_sales.join(self.product.id, self.user)
+
+    def test_checkout_needs_an_admitted_token(self):
+        self.add_to_cart(self.product, 1)
+        ticket = flash_sales.join(self.product.id, self.user)
+        url = '/api/orders/create_order/'
+
+        response = self.client.post(url, SHIPPING, format='json', HTTP_WAITING_ROOM_TOKEN=ticket.token)
+        self.assertEqual(response.status_code, 429)
+
+        self.admit()
+        response = self.client.post(url, SHIPPING, format='json', HTTP_WAITING_ROOM_TOKEN=ticket.token)
+        self.assertEqual(response.status_code, 201, response.data)
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.status, 'used')
+        self.assertEqual(self.on_hand(self.product), 2)
+
+
+@override_settings(LOW_STOCK_DIGEST_DELAY=60, LOW_STOCK_ALERT_EMAILS=[])
+class LowStockDigestTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        Category.objects.filter(id=self.category.id).update(buyer_email='buyer@example.com')
+
+    def run_low(self, product, minutes_ago):
+        """Sell the product down to its minimum, flagged as low ``minutes_ago``"""
+        inventory.adjust(product.id, 'adjustment', -(self.on_hand(product) - product.min_stock_level))
+        Product.objects.filter(id=product.id).update(
+            low_stock_since=timezone.now() - timedelta(minutes=minutes_ago)
+        )
+
+    def reported(self, digest):
+        return digest.products, [message.subject for message in mail.outbox]
+
+    def test_stock_changes_set_and_clear_the_flag(self):
+        product = self.make_product(10, min_stock_level=5)
+        self.assertIsNone(product.low_stock_since)
+
+        inventory.adjust(product.id, 'adjustment', -5)
+        product.refresh_from_db()
+        self.assertIsNotNone(product.low_stock_since)
+
+        inventory.adjust(product.id, 'receipt', 1)
+        product.refresh_from_db()
+        self.assertIsNone(product.low_stock_since)
+
+    def test_reports_products_that_ran_low_before_the_cutoff(self):
+        settled, recent = self.make_product(10), self.make_product(10)
+        inactive = self.make_product(10, is_active=False)
+        self.run_low(settled, minutes_ago=5)
+        self.run_low(inactive, minutes_ago=5)
+        # Inside LOW_STOCK_DIGEST_DELAY: its transaction may not have committed yet
+        self.run_low(recent, minutes_ago=0)
+
+        digest = stock_alerts.send_digests()
+
+        self.assertEqual(self.reported(digest), (1, ['Low stock in Gadgets: 1 products']))
+        self.assertIn(settled.name, mail.outbox[0].body)
+        self.assertEqual(mail.outbox[0].to, ['buyer@example.com'])
+        self.assertLess(digest.cutoff, timezone.now() - timedelta(seconds=59))
+
+    def test_next_run_starts_at_the_last_cutoff(self):
+        settled, recent = self.make_product(10), self.make_product(10)
+        self.run_low(settled, minutes_ago=5)
+        self.run_low(recent, minutes_ago=0)
+        stock_alerts.send_digests()
+        mail.outbox.clear()
+
+        # Ten minutes later
+        LowStockDigest.objects.update(cutoff=F('cutoff') - timedelta(minutes=10))
+        Product.objects.update(low_stock_since=F('low_stock_since') - timedelta(minutes=10))
+        digest = stock_alerts.send_digests()
+
+        self.assertEqual(self.reported(digest), (1, ['Low stock in Gadgets: 1 products']))
+        self.assertIn(recent.name, mail.outbox[0].body)
+        self.assertNotIn(settled.name, mail.outbox[0].body)
+
+        mail.outbox.clear()
+        self.assertEqual(self.reported(stock_alerts.send_digests()), (0, []))
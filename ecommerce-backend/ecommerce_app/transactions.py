@@ -0,0 +1,65 @@
+"""
+``PaymentTransaction`` bookkeeping.
+
+The payment outbox records a pending payment when it creates a PaymentIntent;
+the webhook handlers and ``confirm_payment`` complete or fail it once the
+gateway reports the outcome. Reconciliation compares these rows with the
+gateway's own records.
+"""
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import PaymentTransaction
+
+
+def to_amount(minor_units):
+    """Gateway amount (cents) as a Decimal in the currency's major unit"""
+    return (Decimal(minor_units) / 100).quantize(Decimal('0.01'))
+
+
+def _created(intent):
+    if intent.get('created') is None:
+        return timezone.now()
+    return datetime.fromtimestamp(intent['created'], tz=dt_timezone.utc)
+
+
+def _defaults(order, intent):
+    return {
+        'order': order,
+        'order_number': order.order_number,
+        'amount': to_amount(intent['amount']) if intent.get('amount') is not None else order.total_amount,
+        'currency': intent.get('currency') or 'usd',
+        'created_at': _created(intent),
+    }
+
+
+def record_payment_intent(order, gateway, intent):
+    """Record a newly created PaymentIntent; never downgrades an outcome already recorded"""
+    PaymentTransaction.objects.get_or_create(
+        gateway=gateway,
+        gateway_transaction_id=intent['id'],
+        defaults={'transaction_type': 'payment', 'status': 'pending', **_defaults(order, intent)},
+    )
+
+
+def record_payment_outcome(order, gateway, intent, status):
+    """Mark the PaymentIntent's transaction ``completed`` or ``failed``, creating it if needed"""
+    updates = {'status': status, 'processed_at': timezone.now(), 'updated_at': timezone.now()}
+    if PaymentTransaction.objects.filter(gateway=gateway, gateway_transaction_id=intent['id']).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            PaymentTransaction.objects.create(
+                gateway=gateway,
+                gateway_transaction_id=intent['id'],
+                transaction_type='payment',
+                status=status,
+                processed_at=updates['processed_at'],
+                **_defaults(order, intent)
+            )
+    except IntegrityError:
+        # Recorded by the outbox in the meantime
+        PaymentTransaction.objects.filter(gateway=gateway, gateway_transaction_id=intent['id']).update(**updates)
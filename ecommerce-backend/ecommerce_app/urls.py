@@ -1,11 +1,19 @@
+from django.conf import settings
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
 from . import views
 
+# asgi.py serves the async login and registration views, which do not hold a
+# worker while the password hashes; WSGI keeps the DRF ones
+if settings.AUTH_ASYNC_VIEWS:
+    registration_view, login_view = views.AsyncUserRegistrationView, views.AsyncUserLoginView
+else:
+    registration_view, login_view = views.UserRegistrationView, views.UserLoginView
+
 urlpatterns = [
     # Authentication URLs
-    path('auth/register/', views.UserRegistrationView.as_view(), name='user-register'),
-    path('auth/login/', views.UserLoginView.as_view(), name='user-login'),
+    path('auth/register/', registration_view.as_view(), name='user-register'),
+    path('auth/login/', login_view.as_view(), name='user-login'),
     path('auth/token/refresh/', TokenRefreshView.as_view(), name='token-refresh'),
     path('auth/profile/', views.UserProfileView.as_view(), name='user-profile'),
     
@@ -29,10 +37,27 @@ urlpatterns = [
     path('api/cart/update_item/', views.CartViewSet.as_view({'patch': 'update_item'}), name='cart-update-item'),
     path('api/cart/remove_item/', views.CartViewSet.as_view({'delete': 'remove_item'}), name='cart-remove-item'),
     path('api/cart/clear/', views.CartViewSet.as_view({'delete': 'clear'}), name='cart-clear'),
+    path('api/cart/reserve/', views.CartViewSet.as_view({'post': 'reserve'}), name='cart-reserve'),
     
     # Order URLs
     path('api/orders/', views.OrderViewSet.as_view({'get': 'list', 'post': 'create'}), name='order-list'),
     path('api/orders/<int:pk>/', views.OrderViewSet.as_view({'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}), name='order-detail'),
+    path('api/orders/archived/', views.OrderViewSet.as_view({'get': 'archived'}), name='order-archived'),
+    path('api/orders/bulk_status/', views.OrderViewSet.as_view({'post': 'bulk_status'}), name='order-bulk-status'),
     path('api/orders/create_order/', views.OrderViewSet.as_view({'post': 'create_order'}), name='order-create'),
     path('api/orders/<int:pk>/confirm_payment/', views.OrderViewSet.as_view({'post': 'confirm_payment'}), name='order-confirm-payment'),
+    path('api/orders/<int:pk>/payment/', views.OrderViewSet.as_view({'get': 'payment'}), name='order-payment'),
+    
+    # Refund URLs
+    path('api/refunds/', views.RefundRequestViewSet.as_view({'get': 'list', 'post': 'create'}), name='refund-list'),
+    path('api/refunds/<int:pk>/', views.RefundRequestViewSet.as_view({'get': 'retrieve'}), name='refund-detail'),
+    path('api/refunds/approve/', views.RefundRequestViewSet.as_view({'post': 'approve'}), name='refund-approve'),
+    path('api/refunds/reject/', views.RefundRequestViewSet.as_view({'post': 'reject'}), name='refund-reject'),
+    
+    # Flash sales
+    path('api/flash-sales/<int:pk>/join/', views.FlashSaleViewSet.as_view({'post': 'join'}), name='flash-sale-join'),
+    path('api/flash-sales/tickets/<str:token>/', views.FlashSaleViewSet.as_view({'get': 'ticket'}), name='flash-sale-ticket'),
+    
+    # Reports
+    path('api/reports/sales/', views.SalesReportView.as_view(), name='sales-report'),
 ]
@@ -0,0 +1,180 @@
+"""
+Bulk import of customer accounts from another platform.
+
+``import_users`` streams rows from a CSV or NDJSON export and inserts the
+users and their carts with ``bulk_create``, one transaction per batch,
+instead of calling ``create_user`` and creating a cart for each account.
+Emails are normalized (trimmed and lower-cased) and deduplicated: within a
+batch the first row wins, and rows whose email already has an account are
+skipped, whatever the case of the existing email. That second check also
+catches duplicates from earlier batches, so nothing the size of the file is
+kept in memory. It also means an import that failed part way can simply be
+run again.
+
+Passwords are not rehashed on import. ``password`` holds the legacy hash,
+and ``PASSWORD_FORMATS`` wraps it for one of the hashers in ``hashers``.
+The customer's next login verifies it and replaces it with a PBKDF2 hash.
+Rows without a password get an unusable one, and those customers have to
+reset it.
+"""
+import csv
+import json
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.utils.dateparse import parse_date
+
+from .models import Cart, User
+
+PROFILE_FIELDS = [
+    'first_name', 'last_name', 'phone_number', 'date_of_birth', 'address', 'city', 'state', 'postal_code', 'country'
+]
+
+
+def _split_salted(hash):
+    # 'hash:salt', optionally followed by a version as Magento 2 does
+    parts = hash.split(':')
+    if len(parts) < 2 or '$' in parts[1]:
+        raise ValueError('not in hash:salt form')
+    return parts[1], parts[0]
+
+
+def _django(hash):
+    try:
+        identify_hasher(hash)
+    except ValueError:
+        raise ValueError('not a hash from a configured Django hasher')
+    return hash
+
+
+def _bcrypt(hash):
+    if not hash.startswith(('$2a$', '$2b$', '$2y$')):
+        raise ValueError('not a bcrypt hash')
+    # $2y$ is PHP's name for what the bcrypt library calls $2b$
+    return 'bcrypt$$2b$' + hash[4:]
+
+
+def _phpass(hash):
+    if not hash.startswith(('$P$', '$H$')):
+        raise ValueError('not a phpass hash')
+    return 'phpass$' + hash
+
+
+# How each legacy format is stored for Django's hashers
+PASSWORD_FORMATS = {
+    'django': _django,
+    'md5_salt': lambda hash: 'legacy_md5${}${}'.format(*_split_salted(hash)),
+    'sha256_salt': lambda hash: 'legacy_sha256${}${}'.format(*_split_salted(hash)),
+    'phpass': _phpass,
+    'bcrypt': _bcrypt,
+}
+
+
+class ImportStats:
+    # Rejected rows reported back, the rest are only counted
+    MAX_ERRORS = 100
+
+    def __init__(self):
+        self.created = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, reason):
+        self.rejected += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append((line, reason))
+
+
+def read_rows(file, format):
+    """Yield (line number, row) from an open CSV or NDJSON export; row is None for unparseable lines"""
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def build_user(row, password_format):
+    """Return an unsaved User for an export row; raises ValueError for rows that cannot be imported"""
+    if row is None:
+        raise ValueError('not a JSON object')
+    email = str(row.get('email') or '').strip().lower()
+    try:
+        validate_email(email)
+    except ValidationError:
+        raise ValueError(f'invalid email {email!r}')
+
+    fields = {}
+    for name in PROFILE_FIELDS:
+        value = str(row.get(name) or '').strip()
+        if not value:
+            continue
+        if name == 'date_of_birth':
+            value = parse_date(value)
+            if value is None:
+                raise ValueError('date_of_birth is not a YYYY-MM-DD date')
+        elif len(value) > User._meta.get_field(name).max_length:
+            raise ValueError(f'{name} is longer than {User._meta.get_field(name).max_length} characters')
+        fields[name] = value
+
+    password = str(row.get('password') or '').strip()
+    password_format = row.get('password_format') or password_format
+    if password_format not in PASSWORD_FORMATS:
+        raise ValueError(f'unknown password format {password_format!r}')
+    try:
+        encoded = PASSWORD_FORMATS[password_format](password) if password else make_password(None)
+    except ValueError as e:
+        raise ValueError(f'invalid password: {e}')
+    return User(email=email, password=encoded, **fields)
+
+
+def _insert(batch, stats):
+    with transaction.atomic():
+        # Existing accounts may keep capitals in the local part
+        existing = set(
+            User.objects.annotate(email_lower=Lower('email')).filter(email_lower__in=list(batch))
+            .values_list('email_lower', flat=True)
+        )
+        users = User.objects.bulk_create([user for email, user in batch.items() if email not in existing])
+        Cart.objects.bulk_create([Cart(user=user) for user in users])
+    stats.created += len(users)
+    stats.duplicates += len(existing)
+
+
+def import_users(rows, password_format='django', batch_size=2000, progress=None):
+    """Create users and carts for (line number, row) pairs; returns ImportStats
+
+    ``progress`` is called with the stats after each batch.
+    """
+    stats = ImportStats()
+    batch = {}
+    for line, row in rows:
+        try:
+            user = build_user(row, password_format)
+        except ValueError as e:
+            stats.reject(line, str(e))
+            continue
+        if user.email in batch:
+            stats.duplicates += 1
+            continue
+        batch[user.email] = user
+        if len(batch) >= batch_size:
+            _insert(batch, stats)
+            batch = {}
+            if progress:
+                progress(stats)
+    if batch:
+        _insert(batch, stats)
+    return stats
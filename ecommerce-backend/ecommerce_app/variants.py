@@ -0,0 +1,34 @@
+"""
+Per-product variant aggregates.
+
+Listing "from $X, in stock" for a product with variants would otherwise load
+every variant. Instead each product stores the price range, total stock and
+in-stock flag of its active variants, so variant products cost one row in
+listings like simple products do. ``refresh_aggregates`` recomputes them with
+a single UPDATE for any number of products; it runs whenever a variant is
+saved or deleted and whenever a product's price changes (variants without a
+price of their own sell at the product's price). Call it after bulk variant
+writes, which bypass ``ProductVariant.save``.
+"""
+from django.db.models import Count, Exists, Max, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Product, ProductVariant
+
+
+def refresh_aggregates(product_ids):
+    """Recompute the variant aggregates of the given products; returns how many were updated"""
+    variants = ProductVariant.objects.filter(product=OuterRef('pk'), is_active=True)
+    grouped = variants.order_by().values('product')
+    effective_price = Coalesce('price', 'product__price')
+
+    def aggregate(expression):
+        return Subquery(grouped.annotate(value=expression).values('value'))
+
+    return Product.objects.filter(id__in=list(product_ids)).update(
+        variant_count=Coalesce(aggregate(Count('id')), 0),
+        min_price=aggregate(Min(effective_price)),
+        max_price=aggregate(Max(effective_price)),
+        variant_stock=Coalesce(aggregate(Sum('stock')), 0),
+        variant_in_stock=Exists(variants.filter(stock__gt=0)),
+    )
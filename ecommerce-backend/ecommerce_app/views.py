@@ -2,79 +2,155 @@ from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.tokens import RefreshToken
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.db import transaction
+from django.db.models import Prefetch, Sum
+from asgiref.sync import sync_to_async
 from django.contrib.auth import login
-from .models import User, Category, Product, Cart, CartItem, Order, OrderItem
+from django.contrib.auth.models import update_last_login
+from .models import (
+    User, Category, Product, ProductVariant, Cart, CartItem, Order, ArchivedOrder, RefundRequest, SalesRollup, ProductSalesRollup,
+    FlashSale, FlashSaleTicket
+)
 from .serializers import (
-    CategorySerializer, ProductSerializer, CartSerializer, CartItemSerializer,
-    OrderSerializer, CreateOrderSerializer, UserRegistrationSerializer,
-    UserLoginSerializer, UserSerializer, UserProfileUpdateSerializer
+    CategorySerializer, ProductSerializer, ProductDetailSerializer, CartSerializer, CartItemSerializer,
+    OrderSerializer, OrderSummarySerializer, ArchivedOrderSerializer, ArchivedOrderSummarySerializer,
+    BulkOrderStatusSerializer, CreateOrderSerializer, RefundRequestSerializer, BulkRefundReviewSerializer,
+    SalesReportQuerySerializer, UserRegistrationSerializer, UserLoginSerializer, UserSerializer,
+    UserProfileUpdateSerializer, FlashSaleTicketSerializer
 )
-import stripe
+from . import checkout, flash_sales, order_numbers, order_status, outbox, passwords, refunds, reservations, webhooks
+from .authentication import StatelessJWTAuthentication, tokens_for
+from .gateways import CircuitOpen, GatewayError, InvalidWebhook, get_gateway
+from .idempotency import idempotent
+from .pagination import OrderHistoryPagination
+from .transactions import record_payment_outcome
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse
+from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 import json
 import logging
+from datetime import datetime, time, timedelta
 
-# Set up Stripe API
-stripe.api_key = settings.STRIPE_SECRET_KEY
 logger = logging.getLogger(__name__)
 
 
+def _form_data(request):
+    if request.content_type == 'application/json':
+        return json.loads(request.body or b'{}')
+    return request.POST
+
+
+def _hashing_busy(e):
+    return JsonResponse({'error': str(e)}, status=503, headers={'Retry-After': str(e.retry_after)})
+
+
+def _auth_data(message, user):
+    refresh = tokens_for(user)
+    return {
+        'message': message,
+        'user': UserSerializer(user).data,
+        'tokens': {
+            'access': str(refresh.access_token),
+            'refresh': str(refresh)
+        }
+    }
+
+
+INVALID_LOGIN = {'non_field_errors': ['Invalid email or password.']}
+
+
 class UserRegistrationView(APIView):
     permission_classes = [permissions.AllowAny]
-    
+
     def post(self, request):
         serializer = UserRegistrationSerializer(data=request.data)
-        if serializer.is_valid():
-            user = serializer.save()
-            
-            # Generate tokens
-            refresh = RefreshToken.for_user(user)
-            access_token = refresh.access_token
-            
-            return Response({
-                'message': 'User registered successfully',
-                'user': UserSerializer(user).data,
-                'tokens': {
-                    'access': str(access_token),
-                    'refresh': str(refresh)
-                }
-            }, status=status.HTTP_201_CREATED)
-        
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            encoded_password = passwords.make_password(serializer.validated_data['password'])
+        except passwords.Busy as e:
+            return _hashing_busy(e)
+        user = serializer.save(encoded_password=encoded_password)
+        return Response(_auth_data('User registered successfully', user), status=status.HTTP_201_CREATED)
 
 
 class UserLoginView(APIView):
     permission_classes = [permissions.AllowAny]
-    
+
     def post(self, request):
-        serializer = UserLoginSerializer(data=request.data, context={'request': request})
-        if serializer.is_valid():
-            user = serializer.validated_data['user']
-            
-            # Update last login
+        serializer = UserLoginSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            user = passwords.authenticate(**serializer.validated_data)
+        except passwords.Busy as e:
+            return _hashing_busy(e)
+        if user is None:
+            return Response(INVALID_LOGIN, status=status.HTTP_400_BAD_REQUEST)
+
+        if settings.AUTH_LOGIN_SESSION:
+            # Also logs the user in to session-authenticated pages
             login(request, user)
-            
-            # Generate tokens
-            refresh = RefreshToken.for_user(user)
-            access_token = refresh.access_token
-            
-            return Response({
-                'message': 'Login successful',
-                'user': UserSerializer(user).data,
-                'tokens': {
-                    'access': str(access_token),
-                    'refresh': str(refresh)
-                }
-            }, status=status.HTTP_200_OK)
-        
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            update_last_login(None, user)
+        return Response(_auth_data('Login successful', user), status=status.HTTP_200_OK)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncUserRegistrationView(View):
+    """``UserRegistrationView`` for ASGI: the worker serves other requests while the password is hashed"""
+
+    async def post(self, request):
+        try:
+            serializer = UserRegistrationSerializer(data=_form_data(request))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+        if not await sync_to_async(serializer.is_valid)():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            encoded_password = await passwords.amake_password(serializer.validated_data['password'])
+        except passwords.Busy as e:
+            return _hashing_busy(e)
+        user = await sync_to_async(serializer.save)(encoded_password=encoded_password)
+        data = await sync_to_async(_auth_data)('User registered successfully', user)
+        return JsonResponse(data, status=status.HTTP_201_CREATED)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncUserLoginView(View):
+    """``UserLoginView`` for ASGI: the worker serves other requests while the password is checked"""
+
+    async def post(self, request):
+        try:
+            serializer = UserLoginSerializer(data=_form_data(request))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            user = await passwords.aauthenticate(**serializer.validated_data)
+        except passwords.Busy as e:
+            return _hashing_busy(e)
+        if user is None:
+            return JsonResponse(INVALID_LOGIN, status=status.HTTP_400_BAD_REQUEST)
+
+        if settings.AUTH_LOGIN_SESSION:
+            # Also logs the user in to session-authenticated pages
+            await sync_to_async(login)(request, user)
+        else:
+            await sync_to_async(update_last_login)(None, user)
+        data = await sync_to_async(_auth_data)('Login successful', user)
+        return JsonResponse(data, status=status.HTTP_200_OK)
 
 
 class UserProfileView(APIView):
@@ -85,6 +161,8 @@ class UserProfileView(APIView):
         return Response(serializer.data)
     
     def put(self, request):
+        # request.user may be the cached copy; save over the current row
+        request.user.refresh_from_db()
         serializer = UserProfileUpdateSerializer(request.user, data=request.data)
         if serializer.is_valid():
             serializer.save()
@@ -95,6 +173,8 @@ class UserProfileView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     def patch(self, request):
+        # request.user may be the cached copy; save over the current row
+        request.user.refresh_from_db()
         serializer = UserProfileUpdateSerializer(request.user, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
@@ -125,13 +205,24 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
             queryset = queryset.filter(category=category)
         if search is not None:
             queryset = queryset.filter(name__icontains=search)
+        if self.action == 'retrieve':
+            queryset = queryset.prefetch_related(Prefetch(
+                'variants', queryset=ProductVariant.objects.filter(is_active=True).order_by('id')
+            ))
             
         return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return ProductDetailSerializer
+        return ProductSerializer
     
 
 
 class CartViewSet(viewsets.ModelViewSet):
     serializer_class = CartSerializer
+    # Their reads only filter by the user, so may skip the user lookup
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
@@ -156,8 +247,8 @@ class CartViewSet(viewsets.ModelViewSet):
             quantity = serializer.validated_data['quantity']
             product = get_object_or_404(Product, id=product_id, is_active=True)
             
-            # Check stock
-            if product.stock < quantity:
+            # Check stock not held by other checkouts
+            if reservations.available_stock(product, exclude_user=request.user) < quantity:
                 return Response(
                     {'error': 'Insufficient stock'},
                     status=status.HTTP_400_BAD_REQUEST
@@ -189,8 +280,8 @@ class CartViewSet(viewsets.ModelViewSet):
             cart_item.delete()
             return Response({'message': 'Item removed from cart'})
         
-        # Check stock
-        if cart_item.product.stock < quantity:
+        # Check stock not held by other checkouts
+        if reservations.available_stock(cart_item.product, exclude_user=request.user) < quantity:
             return Response(
                 {'error': 'Insufficient stock'},
                 status=status.HTTP_400_BAD_REQUEST
@@ -215,90 +306,149 @@ class CartViewSet(viewsets.ModelViewSet):
     def clear(self, request):
         cart = get_object_or_404(Cart, user=request.user)
         cart.items.all().delete()
+        reservations.release_user_holds(request.user)
         return Response({'message': 'Cart cleared'})
 
+    @action(detail=False, methods=['post'])
+    def reserve(self, request):
+        cart = get_object_or_404(Cart, user=request.user)
+
+        if not cart.items.exists():
+            return Response(
+                {'error': 'Cart is empty'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            holds, expires_at = reservations.reserve_cart(cart)
+        except reservations.InsufficientStock as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        return Response({
+            'message': 'Items reserved',
+            'expires_at': expires_at,
+            'items': [
+                {'product_id': hold.product_id, 'quantity': hold.quantity}
+                for hold in holds
+            ]
+        }, status=status.HTTP_201_CREATED)
+
 
 class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
+    # Their reads only filter by the user, so may skip the user lookup
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = OrderHistoryPagination
 
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user).prefetch_related(
+        queryset = Order.objects.filter(user=self.request.user)
+        if self.action == 'list':
+            # Summary projection: one row per order, items are not loaded
+            return queryset.only(*OrderSummarySerializer.Meta.fields)
+        return queryset.prefetch_related(
             'items__product__category'
         ).select_related('user')
 
+    def get_permissions(self):
+        if self.action == 'bulk_status':
+            return [permissions.IsAdminUser()]
+        return super().get_permissions()
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return OrderSummarySerializer
+        return super().get_serializer_class()
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            # Old delivered orders live in the archive
+            archived = get_object_or_404(
+                ArchivedOrder.objects.select_related('user'),
+                id=kwargs['pk'], user=request.user
+            )
+            return Response(ArchivedOrderSerializer(archived).data)
+
+    @action(detail=False, methods=['get'])
+    def archived(self, request):
+        queryset = ArchivedOrder.objects.filter(user=request.user).only(
+            *ArchivedOrderSummarySerializer.Meta.fields
+        )
+        page = self.paginate_queryset(queryset)
+        serializer = ArchivedOrderSummarySerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     @action(detail=False, methods=['post'])
+    @idempotent
     def create_order(self, request):
         serializer = CreateOrderSerializer(data=request.data, context={'request': request})
         
         if serializer.is_valid():
-            with transaction.atomic():
-                cart = get_object_or_404(Cart, user=request.user)
-                
-                if not cart.items.exists():
-                    return Response(
-                        {'error': 'Cart is empty'},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-                
-                # Create order
-                order = Order.objects.create(
-                    user=request.user,
-                    total_amount=cart.total_price,
-                    shipping_address=serializer.validated_data['shipping_address'],
-                    shipping_city=serializer.validated_data['shipping_city'],
-                    shipping_postal_code=serializer.validated_data['shipping_postal_code'],
-                    shipping_country=serializer.validated_data['shipping_country']
+            cart = get_object_or_404(Cart, user=request.user)
+            
+            # Flash-sale products are only sold to users admitted from the waiting room,
+            # checked before any expensive work
+            tokens = [token.strip() for token in request.headers.get(flash_sales.HEADER, '').split(',')]
+            try:
+                tickets = flash_sales.check_admission(
+                    request.user, cart.items.values('product_id'), tokens
                 )
-                
-                # Create order items and update stock
-                for cart_item in cart.items.all():
-                    if cart_item.product.stock < cart_item.quantity:
-                        return Response(
-                            {'error': f'Insufficient stock for {cart_item.product.name}'},
-                            status=status.HTTP_400_BAD_REQUEST
-                        )
-                    
-                    OrderItem.objects.create(
-                        order=order,
-                        product=cart_item.product,
-                        quantity=cart_item.quantity,
-                        price=cart_item.product.price
-                    )
-                    
-                    # Update product stock
-                    cart_item.product.stock -= cart_item.quantity
-                    cart_item.product.save()
-                
-                # Create Stripe Payment Intent
-                try:
-                    intent = stripe.PaymentIntent.create(
-                        amount=int(order.total_amount * 100),  # Convert to cents
-                        currency='usd',
-                        metadata={'order_id': order.id}
+            except flash_sales.NotAdmitted as e:
+                return self._not_admitted(e)
+            
+            order_number = order_numbers.allocate()
+            
+            try:
+                with transaction.atomic():
+                    order = checkout.place_order(
+                        cart, serializer.validated_data, order_number=order_number
                     )
+                    flash_sales.spend(tickets)
                     
-                    order.stripe_payment_intent = intent.id
-                    order.save()
+                    # The PaymentIntent is created by the outbox worker once
+                    # this transaction has committed
+                    outbox.enqueue_payment_intent(order)
                     
                     # Clear cart
                     cart.items.all().delete()
-                    
-                    return Response({
-                        'order_id': order.id,
-                        'client_secret': intent.client_secret,
-                        'amount': order.total_amount
-                    }, status=status.HTTP_201_CREATED)
-                    
-                except stripe.error.StripeError as e:
-                    return Response(
-                        {'error': f'Payment processing error: {str(e)}'},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
+            except checkout.EmptyCart as e:
+                return Response(
+                    {'error': str(e)},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            except reservations.InsufficientStock as e:
+                # As when reserving; may succeed once stock frees up
+                return Response(
+                    {'error': str(e)},
+                    status=status.HTTP_409_CONFLICT
+                )
+            except flash_sales.NotAdmitted as e:
+                return self._not_admitted(e)
+            
+            return Response({
+                'order_id': order.id,
+                'order_number': order.order_number,
+                'client_secret': None,
+                'payment_status': 'pending',
+                'payment_url': reverse('order-payment', kwargs={'pk': order.id}),
+                'amount': order.total_amount
+            }, status=status.HTTP_201_CREATED)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def _not_admitted(self, error):
+        return Response({
+            'error': str(error),
+            'join_url': reverse('flash-sale-join', kwargs={'pk': error.product.id})
+        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+
     @action(detail=True, methods=['post'])
+    @idempotent
     def confirm_payment(self, request, pk=None):
         order = self.get_object()
         payment_intent_id = request.data.get('payment_intent_id')
@@ -310,13 +460,19 @@ class OrderViewSet(viewsets.ModelViewSet):
             )
         
         try:
-            # Verify payment with Stripe
-            intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+            # Verify payment with the gateway
+            gateway = get_gateway()
+            intent = gateway.retrieve_payment_intent(payment_intent_id)
             
-            if intent.status == 'succeeded':
-                order.is_paid = True
-                order.status = 'processing'
-                order.save()
+            if intent['status'] == 'succeeded':
+                record_payment_outcome(order, gateway.name, intent, 'completed')
+                try:
+                    order_status.transition(
+                        order, 'processing', changed_by=request.user,
+                        notes='Payment confirmed', is_paid=True
+                    )
+                except order_status.InvalidTransition as e:
+                    return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
                 
                 return Response({
                     'message': 'Payment confirmed',
@@ -328,11 +484,164 @@ class OrderViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
                 
-        except stripe.error.StripeError as e:
+        except CircuitOpen as e:
+            # Stripe is down: tell the client to come back rather than fail the payment
+            return Response(
+                {'error': 'Payment verification is temporarily unavailable'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(int(e.retry_after) + 1)}
+            )
+        except GatewayError as e:
             return Response(
                 {'error': f'Payment verification error: {str(e)}'},
-                status=status.HTTP_400_BAD_REQUEST
+                status=status.HTTP_503_SERVICE_UNAVAILABLE if e.retryable else status.HTTP_400_BAD_REQUEST
+            )
+
+    @action(detail=False, methods=['post'])
+    def bulk_status(self, request):
+        """Move many orders to one status, e.g. everything scanned as shipped"""
+        serializer = BulkOrderStatusSerializer(data=request.data)
+        
+        if serializer.is_valid():
+            order_ids = serializer.validated_data['order_ids']
+            moved = order_status.bulk_transition(
+                order_ids,
+                serializer.validated_data['status'],
+                changed_by=request.user,
+                notes=serializer.validated_data['notes']
+            )
+            return Response({
+                'updated': len(moved),
+                'skipped': sorted(set(order_ids) - set(moved))
+            })
+        
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=['get'])
+    def payment(self, request, pk=None):
+        """Poll for the PaymentIntent queued by create_order"""
+        order = self.get_object()
+        return Response(outbox.payment_status(order))
+
+
+class RefundRequestViewSet(viewsets.ModelViewSet):
+    serializer_class = RefundRequestSerializer
+    # Their reads only filter by the user, so may skip the user lookup
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = OrderHistoryPagination
+
+    def get_queryset(self):
+        return RefundRequest.objects.filter(user=self.request.user).prefetch_related('items')
+
+    def get_permissions(self):
+        if self.action in ('approve', 'reject'):
+            return [permissions.IsAdminUser()]
+        return super().get_permissions()
+
+    @action(detail=False, methods=['post'])
+    def approve(self, request):
+        """Approve many requests for process_refunds to pay out"""
+        serializer = BulkRefundReviewSerializer(data=request.data)
+        
+        if serializer.is_valid():
+            request_ids = serializer.validated_data['request_ids']
+            approved = refunds.approve(
+                request_ids,
+                reviewed_by=request.user,
+                notes=serializer.validated_data['notes'],
+                restock=serializer.validated_data['restock']
+            )
+            return Response({
+                'approved': len(approved),
+                'skipped': sorted(set(request_ids) - set(approved))
+            })
+        
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['post'])
+    def reject(self, request):
+        serializer = BulkRefundReviewSerializer(data=request.data)
+        
+        if serializer.is_valid():
+            rejected = refunds.reject(
+                serializer.validated_data['request_ids'],
+                reviewed_by=request.user,
+                notes=serializer.validated_data['notes']
             )
+            return Response({'rejected': rejected})
+        
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class FlashSaleViewSet(viewsets.GenericViewSet):
+    """Waiting room of flash-sale products: join the queue, then poll the ticket"""
+    serializer_class = FlashSaleTicketSerializer
+    # Their reads only filter by the user, so may skip the user lookup
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return FlashSaleTicket.objects.filter(user=self.request.user).select_related('sale')
+
+    @action(detail=True, methods=['post'])
+    def join(self, request, pk=None):
+        """Queue for the flash sale of product ``pk``; joining again returns the same ticket"""
+        try:
+            ticket = flash_sales.join(pk, request.user)
+        except FlashSale.DoesNotExist:
+            return Response(
+                {'error': 'This product is not in a flash sale'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        except flash_sales.QueueFull as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(e.retry_after)}
+            )
+        except flash_sales.SoldOut as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+        
+        return Response(self.get_serializer(ticket).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'])
+    def ticket(self, request, token=None):
+        """Poll a ticket's place in the queue until it is admitted"""
+        ticket = get_object_or_404(self.get_queryset(), token=token)
+        return Response(self.get_serializer(ticket).data)
+
+
+class SalesReportView(APIView):
+    """Revenue, best sellers and category mix, read from the sales rollups"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        serializer = SalesReportQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        params = serializer.validated_data
+        start = timezone.make_aware(datetime.combine(params['start'], time()))
+        end = timezone.make_aware(datetime.combine(params['end'], time())) + timedelta(days=1)
+        window = {'period': params['period'], 'period_start__gte': start, 'period_start__lt': end}
+
+        lines = ProductSalesRollup.objects.filter(**window)
+        return Response({
+            'totals': list(
+                SalesRollup.objects.filter(**window).values('period_start', 'order_count', 'units', 'revenue')
+            ),
+            'top_products': list(
+                lines.values('product_id', 'product__name')
+                .annotate(units=Sum('units'), revenue=Sum('revenue'))
+                .order_by('-units')[:params['limit']]
+            ),
+            'categories': list(
+                lines.values('category_id', 'category__name')
+                .annotate(units=Sum('units'), revenue=Sum('revenue'))
+                .order_by('-revenue')
+            ),
+        })
 
 
 class StripeConfigView(APIView):
@@ -349,55 +658,15 @@ class StripeConfigView(APIView):
 def stripe_webhook(request):
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
-    endpoint_secret = settings.STRIPE_WEBHOOK_SECRET
+    gateway = get_gateway()
 
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
-        )
-    except ValueError:
-        # Invalid payload
-        logger.error('Invalid payload in webhook')
-        return HttpResponse(status=400)
-    except stripe.error.SignatureVerificationError:
-        # Invalid signature
-        logger.error('Invalid signature in webhook')
+        event = gateway.parse_webhook(payload, sig_header)
+    except InvalidWebhook as e:
+        logger.error(f'{e} in webhook')
         return HttpResponse(status=400)
 
-    # Handle the event
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        order_id = payment_intent['metadata'].get('order_id')
-        
-        if order_id:
-            try:
-                order = Order.objects.get(id=order_id)
-                order.is_paid = True
-                order.status = 'processing'
-                order.save()
-                logger.info(f'Payment confirmed for order {order_id}')
-            except Order.DoesNotExist:
-                logger.error(f'Order {order_id} not found for payment intent {payment_intent["id"]}')
-                
-    elif event['type'] == 'payment_intent.payment_failed':
-        payment_intent = event['data']['object']
-        order_id = payment_intent['metadata'].get('order_id')
-        
-        if order_id:
-            try:
-                order = Order.objects.get(id=order_id)
-                order.status = 'cancelled'
-                order.save()
-                
-                # Restore stock
-                for item in order.items.all():
-                    item.product.stock += item.quantity
-                    item.product.save()
-                    
-                logger.info(f'Payment failed for order {order_id}, stock restored')
-            except Order.DoesNotExist:
-                logger.error(f'Order {order_id} not found for failed payment intent {payment_intent["id"]}')
-    else:
-        logger.info(f'Unhandled event type: {event["type"]}')
+    # Stored for the process_webhooks workers; the gateway only needs the 200
+    webhooks.ingest(gateway.name, event)
 
     return HttpResponse(status=200)
@@ -0,0 +1,158 @@
+"""
+Durable queue for payment gateway webhooks.
+
+The webhook view only verifies the signature and stores the event with
+``ingest`` (a redelivered event is dropped by the unique gateway + event id),
+so the gateway gets its 200 at once. ``process_webhooks`` then handles the
+stored events with a pool of workers. Events for the same order are handled
+one at a time in the order the gateway created them; failures are retried with
+backoff and end up ``dead`` after ``PAYMENT_WEBHOOK_MAX_ATTEMPTS``.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from . import order_status
+from .models import Order, PaymentWebhook
+from .transactions import record_payment_outcome
+
+logger = logging.getLogger(__name__)
+
+LEASE = timedelta(seconds=60)
+
+
+def _order_ref(event):
+    metadata = event.get('data', {}).get('object', {}).get('metadata') or {}
+    try:
+        return int(metadata['order_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def ingest(gateway, event):
+    """Store a verified gateway event; duplicates are ignored"""
+    PaymentWebhook.objects.bulk_create([
+        PaymentWebhook(
+            gateway=gateway,
+            event_id=event['id'],
+            event_type=event['type'],
+            event_data=event,
+            order_ref=_order_ref(event),
+            event_created=datetime.fromtimestamp(event['created'], tz=dt_timezone.utc),
+        )
+    ], ignore_conflicts=True)
+
+
+def claim(batch_size):
+    """Lease up to ``batch_size`` due events that no earlier event of their order is waiting on"""
+    now = timezone.now()
+    earlier = PaymentWebhook.objects.filter(
+        Q(event_created__lt=OuterRef('event_created'))
+        | Q(event_created=OuterRef('event_created'), id__lt=OuterRef('id')),
+        order_ref=OuterRef('order_ref'),
+        status='pending',
+    )
+    with transaction.atomic():
+        webhooks = list(
+            PaymentWebhook.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', available_at__lte=now)
+            .exclude(Exists(earlier))
+            .order_by('available_at')[:batch_size]
+        )
+        PaymentWebhook.objects.filter(id__in=[webhook.id for webhook in webhooks]).update(
+            available_at=now + LEASE, attempts=F('attempts') + 1
+        )
+    for webhook in webhooks:
+        webhook.attempts += 1
+    return webhooks
+
+
+def _payment_succeeded(webhook):
+    order = Order.objects.filter(id=webhook.order_ref).first()
+    if order is None:
+        return f'Order {webhook.order_ref} not found'
+    record_payment_outcome(order, webhook.gateway, webhook.event_data['data']['object'], 'completed')
+    try:
+        order_status.transition(order, 'processing', notes='Payment succeeded', is_paid=True)
+    except order_status.InvalidTransition as e:
+        return str(e)
+    logger.info(f'Payment confirmed for order {order.id}')
+    return ''
+
+
+def _payment_failed(webhook):
+    order = Order.objects.filter(id=webhook.order_ref).first()
+    if order is None:
+        return f'Order {webhook.order_ref} not found'
+    record_payment_outcome(order, webhook.gateway, webhook.event_data['data']['object'], 'failed')
+    try:
+        # Cancelling restores the stock
+        if order_status.transition(order, 'cancelled', notes='Payment failed'):
+            logger.info(f'Payment failed for order {order.id}, stock restored')
+    except order_status.InvalidTransition as e:
+        return str(e)
+    return ''
+
+
+HANDLERS = {
+    'payment_intent.succeeded': _payment_succeeded,
+    'payment_intent.payment_failed': _payment_failed,
+}
+
+
+def process_webhook(webhook):
+    handler = HANDLERS.get(webhook.event_type)
+    try:
+        with transaction.atomic():
+            if handler is None:
+                logger.info(f'Unhandled event type: {webhook.event_type}')
+                note = ''
+            else:
+                note = handler(webhook)
+            if note:
+                logger.error(f'{webhook.gateway} event {webhook.event_id}: {note}')
+            webhook.status = 'processed'
+            webhook.processed_at = timezone.now()
+            webhook.error_message = note
+            webhook.save(update_fields=['status', 'processed_at', 'error_message'])
+        return True
+    except Exception as e:
+        logger.exception(f'Failed to process {webhook.gateway} event {webhook.event_id}')
+        webhook.error_message = str(e)
+        if webhook.attempts >= settings.PAYMENT_WEBHOOK_MAX_ATTEMPTS:
+            webhook.status = 'dead'
+        else:
+            webhook.available_at = timezone.now() + timedelta(seconds=2 ** webhook.attempts)
+        webhook.save(update_fields=['status', 'available_at', 'error_message'])
+        return False
+
+
+def _process_in_thread(webhook):
+    try:
+        return process_webhook(webhook)
+    finally:
+        connections.close_all()
+
+
+def process_batch(batch_size=100, workers=1):
+    """Claim and process one batch; returns the number of events claimed"""
+    webhooks = claim(batch_size)
+    if workers > 1 and len(webhooks) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_process_in_thread, webhooks))
+    else:
+        for webhook in webhooks:
+            process_webhook(webhook)
+    return len(webhooks)
+
+
+def retry_dead(queryset):
+    """Put dead events back in the queue"""
+    return queryset.filter(status='dead').update(
+        status='pending', attempts=0, available_at=timezone.now(), error_message=''
+    )
@@ -91,9 +91,8 @@ class Order(models.Model):
 
     def generate_order_number(self):
         """Generate unique order number"""
-        import time
-        timestamp = str(int(time.time()))
-        return f"ORD-{timestamp[-6:]}"
+        from ecommerce_app.order_numbers import allocate
+        return allocate()
 
     @property
     def customer_name(self):
@@ -7,6 +7,9 @@ import { Elements } from '@stripe/react-stripe-js';
 import CheckoutForm from '../components/CheckoutForm';
 import API from '../services/api';
 
+// Polls for the payment details once a second; give up after this many
+const PAYMENT_POLL_ATTEMPTS = 60;
+
 const Checkout = () => {
   const { cart, isLoading: cartLoading } = useCart();
   const { isAuthenticated, user } = useAuth();
@@ -17,6 +20,8 @@ const Checkout = () => {
   const [checkoutData, setCheckoutData] = useState(null);
   const [isLoading, setIsLoading] = useState(true);
   const [error, setError] = useState('');
+  // Lets the server recognise a retried order submission
+  const [idempotencyKey] = useState(() => window.crypto.randomUUID());
   const [shippingInfo, setShippingInfo] = useState({
     shipping_address: '',
     shipping_city: '',
@@ -44,6 +49,17 @@ const Checkout = () => {
     initializeStripe();
   }, [isAuthenticated, navigate]);
 
+  useEffect(() => {
+    if (!isAuthenticated || !cart || !cart.items || cart.items.length === 0) {
+      return;
+    }
+
+    // Hold the cart's stock while the user fills in the checkout form
+    API.post('/api/cart/reserve/').catch((err) => {
+      setError(err.response?.data?.error || 'Some items are no longer available');
+    });
+  }, [isAuthenticated, cart]);
+
   useEffect(() => {
     // Pre-fill shipping info with user data if available
     if (user) {
@@ -69,9 +85,32 @@ const Checkout = () => {
 
     try {
       setIsLoading(true);
-      const response = await API.post('/api/orders/create_order/', shippingInfo);
-      
-      setClientSecret(response.data.client_secret);
+      const response = await API.post('/api/orders/create_order/', shippingInfo, {
+        headers: { 'Idempotency-Key': idempotencyKey }
+      });
+
+      // The payment intent is created in the background; poll until it is ready
+      let payment = { status: 'pending', client_secret: response.data.client_secret };
+      for (let attempt = 0; attempt < PAYMENT_POLL_ATTEMPTS; attempt++) {
+        if (payment.client_secret || payment.status !== 'pending') {
+          break;
+        }
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+        payment = (await API.get(response.data.payment_url)).data;
+      }
+
+      if (!payment.client_secret && payment.status === 'pending') {
+        // Placing the order again with the same key picks this one back up
+        setError('Payment is taking longer than expected. Please try again in a moment.');
+        return;
+      }
+
+      if (payment.status === 'failed') {
+        setError(payment.error || 'Failed to start payment');
+        return;
+      }
+
+      setClientSecret(payment.client_secret);
       setCheckoutData({
         orderId: response.data.order_id,
         totalAmount: response.data.amount
@@ -88,6 +88,7 @@ export const cartAPI = {
   removeItem: (itemId) =>
     api.delete('/api/cart/remove_item/', { data: { item_id: itemId } }),
   clearCart: () => api.delete('/api/cart/clear/'),
+  reserve: () => api.post('/api/cart/reserve/'),
 };
 
 // Orders API
@@ -95,6 +96,7 @@ export const ordersAPI = {
   getOrders: () => api.get('/api/orders/'),
   getOrder: (id) => api.get(`/api/orders/${id}/`),
   createOrder: (orderData) => api.post('/api/orders/create_order/', orderData),
+  getPayment: (orderId) => api.get(`/api/orders/${orderId}/payment/`),
   confirmPayment: (orderId, paymentIntentId) =>
     api.post(`/api/orders/${orderId}/confirm_payment/`, {
       payment_intent_id: paymentIntentId,